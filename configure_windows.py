@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import os, sys, subprocess, shutil, time, argparse, getpass, ctypes, winreg, signal
+import hashlib, json, tempfile, urllib.request, zipfile, xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # ---------------- utils ----------------
 def is_admin():
@@ -52,6 +54,19 @@ def reg_delete_tree(hive, path):
     except FileNotFoundError:
         pass
 
+def reg_get(hive, path, name):
+    """Value of name under path, or None when the key or value is missing."""
+    try:
+        key = winreg.OpenKey(hive, path, 0, winreg.KEY_READ)
+    except FileNotFoundError:
+        return None
+    try:
+        return winreg.QueryValueEx(key, name)[0]
+    except FileNotFoundError:
+        return None
+    finally:
+        winreg.CloseKey(key)
+
 def reg_set(hive, path, name, value, kind=winreg.REG_SZ):
     key = winreg.CreateKeyEx(hive, path, 0, winreg.KEY_SET_VALUE)
     winreg.SetValueEx(key, name, 0, kind, value)
@@ -109,12 +124,117 @@ def remove_builtin_capability(try_remove=True):
     except RuntimeError as e:
         print(f"DISM timed out/failed (continuing): {e}")
 
+# ---------------- offline package cache ----------------
+# A cache directory holds the .nupkg files plus packages.json ({"files": {name: sha256}}).
+# Populate it once with --populate-cache, then provision every VM from it with
+# --package-source pointing at the directory, a share, or any HTTP server serving it.
+PACKAGE_FEED = "https://community.chocolatey.org/api/v2/package"
+PACKAGE_MANIFEST = "packages.json"
+DEFAULT_PACKAGE_CACHE = r"C:\ProgramData\privacyfirst\packages"
+DEFAULT_PACKAGES = ("chocolatey", "openssh")
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def nupkg_identity(path):
+    """(id, version) from the .nuspec inside a .nupkg."""
+    with zipfile.ZipFile(path) as z:
+        nuspec = next(n for n in z.namelist() if n.endswith(".nuspec") and "/" not in n)
+        root = ET.fromstring(z.read(nuspec))
+    meta = next(el for el in root.iter() if el.tag.endswith("metadata"))
+    field = lambda name: next(el.text for el in meta if el.tag.endswith(name)).strip()
+    return field("id").lower(), field("version")
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, PACKAGE_MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f).get("files", {})
+    except FileNotFoundError:
+        return {}
+
+def populate_cache(directory, packages=DEFAULT_PACKAGES):
+    """Download packages ("id" or "id==version") from the public feed into directory and record their hashes."""
+    print(f"\n=== Populating package cache {directory} ===")
+    ensure_dir(directory)
+    files = read_manifest(directory)
+    for spec in packages:
+        pkg, _, version = spec.partition("==")
+        url = f"{PACKAGE_FEED}/{pkg}" + (f"/{version}" if version else "")
+        part = os.path.join(directory, f"{pkg}.download")
+        print(f"-> {url}")
+        urllib.request.urlretrieve(url, part)
+        pkg_id, pkg_version = nupkg_identity(part)
+        name = f"{pkg_id}.{pkg_version}.nupkg"
+        os.replace(part, os.path.join(directory, name))
+        files[name] = sha256_file(os.path.join(directory, name))
+        print(f"{name}  {files[name]}")
+    with open(os.path.join(directory, PACKAGE_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({"files": files}, f, indent=2, sort_keys=True)
+
+def prepare_package_source(source, cache=DEFAULT_PACKAGE_CACHE):
+    """Local directory of hash-verified packages from source (a directory or an http(s) URL).
+
+    URLs are mirrored into cache; files already there with the right hash are not fetched again.
+    """
+    print(f"\n=== Verifying package source {source} ===")
+    remote = source.lower().startswith(("http://", "https://"))
+    if remote:
+        ensure_dir(cache)
+        base = source.rstrip("/")
+        with urllib.request.urlopen(f"{base}/{PACKAGE_MANIFEST}", timeout=30) as r:
+            files = json.load(r).get("files", {})
+        with open(os.path.join(cache, PACKAGE_MANIFEST), "w", encoding="utf-8") as f:
+            json.dump({"files": files}, f, indent=2, sort_keys=True)
+        directory = cache
+    else:
+        files = read_manifest(source)
+        directory = source
+    if not files:
+        raise RuntimeError(f"No {PACKAGE_MANIFEST} with package hashes in {source}")
+    for name, digest in sorted(files.items()):
+        path = os.path.join(directory, name)
+        if remote and not (os.path.exists(path) and sha256_file(path) == digest):
+            print(f"-> {base}/{name}")
+            urllib.request.urlretrieve(f"{base}/{name}", path + ".part")
+            os.replace(path + ".part", path)
+        if not os.path.exists(path):
+            raise RuntimeError(f"Package {name} listed in {PACKAGE_MANIFEST} is missing from {directory}")
+        if sha256_file(path) != digest:
+            raise RuntimeError(f"Hash mismatch for {name}: expected {digest}")
+        print(f"{name} OK")
+    return directory
+
+def find_package(directory, pkg_id):
+    prefix = pkg_id + "."
+    names = [n for n in read_manifest(directory) if n.lower().startswith(prefix) and n[len(prefix):len(prefix) + 1].isdigit()]
+    if not names:
+        raise RuntimeError(f"No {pkg_id} package in {directory}")
+    version = lambda n: tuple(int(x) if x.isdigit() else -1 for x in n[len(prefix):-len(".nupkg")].split("."))
+    return os.path.join(directory, max(names, key=version))
+
 # ---------------- install & configure ----------------
-def ensure_choco():
+def ensure_choco(package_dir=None):
     print("\n=== Ensuring Chocolatey ===")
     if shutil.which("choco"):
         print("Chocolatey OK.")
         return
+    if package_dir:
+        # Chocolatey's documented offline install: unpack its nupkg and run the bundled installer.
+        nupkg = find_package(package_dir, "chocolatey")
+        unpacked = tempfile.mkdtemp(prefix="choco-")
+        with zipfile.ZipFile(nupkg) as z:
+            z.extractall(unpacked)
+        run(["powershell","-NoProfile","-ExecutionPolicy","Bypass","-File",os.path.join(unpacked,"tools","chocolateyInstall.ps1")])
+        shutil.rmtree(unpacked, ignore_errors=True)
+        # choco.exe is on the machine PATH now, but not yet in this process's.
+        os.environ["PATH"] += os.pathsep + os.path.join(os.environ.get("ProgramData", r"C:\ProgramData"), "chocolatey", "bin")
+        if not shutil.which("choco"):
+            raise RuntimeError("Chocolatey offline installation failed")
+        return
     ps = r"""Set-ExecutionPolicy Bypass -Scope Process -Force;
 [Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12;
 iex ((New-Object System.Net.WebClient).DownloadString('https://community.chocolatey.org/install.ps1'))"""
@@ -122,11 +242,12 @@ iex ((New-Object System.Net.WebClient).DownloadString('https://community.chocola
     if not shutil.which("choco"):
         raise RuntimeError("Chocolatey installation failed")
 
-def install_openssh():
+def install_openssh(package_dir=None):
     print("\n=== Installing Win32-OpenSSH via Chocolatey ===")
     params = "/SSHServerFeature /SSHAgentFeature /Path"
+    source = f' --source "{package_dir}"' if package_dir else ""
     # --force in case remnants confuse choco
-    run(f'choco install openssh -y --force --params "\'{params}\'"')
+    run(f'choco install openssh -y --force{source} --params "\'{params}\'"')
     # Ensure helper scripts ran
     install_ps = r"C:\Program Files\OpenSSH-Win64\install-sshd.ps1"
     if os.path.exists(install_ps):
@@ -148,20 +269,20 @@ def register_and_start_services():
     time.sleep(1)
     run("sc start sshd", check=False)
 
-def set_default_shell():
-    print("\n=== Setting default SSH shell ===")
+def desired_shell():
     pwsh7 = r"C:\Program Files\PowerShell\7\pwsh.exe"
     ps5   = r"C:\Windows\System32\WindowsPowerShell\v1.0\powershell.exe"
-    shell = pwsh7 if os.path.exists(pwsh7) else ps5
+    return pwsh7 if os.path.exists(pwsh7) else ps5
+
+def set_default_shell():
+    print("\n=== Setting default SSH shell ===")
+    shell = desired_shell()
     reg_set(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\OpenSSH", "DefaultShell", shell, winreg.REG_SZ)
     print(f"DefaultShell: {shell}")
 
-def write_sshd_config():
-    print("\n=== Writing sshd_config (password auth enabled) ===")
-    cfg_dir = r"C:\ProgramData\ssh"
-    cfg     = os.path.join(cfg_dir, "sshd_config")
-    ensure_dir(cfg_dir)
-    content = """Port 22
+SSHD_CONFIG_DIR = r"C:\ProgramData\ssh"
+SSHD_CONFIG = os.path.join(SSHD_CONFIG_DIR, "sshd_config")
+SSHD_CONFIG_CONTENT = """Port 22
 AddressFamily any
 ListenAddress 0.0.0.0
 ListenAddress ::
@@ -171,14 +292,21 @@ StrictModes yes
 Subsystem sftp sftp-server.exe
 UseDNS no
 """
-    with open(cfg, "w", encoding="ascii", newline="\r\n") as f:
-        f.write(content)
-    # restart
-    run("sc stop sshd", check=False); time.sleep(1); run("sc start sshd", check=False)
+
+def write_sshd_config(restart=True):
+    print("\n=== Writing sshd_config (password auth enabled) ===")
+    ensure_dir(SSHD_CONFIG_DIR)
+    with open(SSHD_CONFIG, "w", encoding="ascii", newline="\r\n") as f:
+        f.write(SSHD_CONFIG_CONTENT)
+    if restart:
+        run("sc stop sshd", check=False); time.sleep(1); run("sc start sshd", check=False)
+
+def firewall_profiles(also_public=False):
+    return "Any" if also_public else "Domain,Private"
 
 def open_firewall(also_public=False, allow_icmp=False):
     print("\n=== Opening Windows Firewall for SSH ===")
-    profiles = "Any" if also_public else "Domain,Private"
+    profiles = firewall_profiles(also_public)
     run(r'netsh advfirewall firewall delete rule name="OpenSSH Server (sshd)"', check=False)
     run(fr'netsh advfirewall firewall add rule name="OpenSSH Server (sshd)" dir=in action=allow protocol=TCP localport=22 profile={profiles}')
     if allow_icmp:
@@ -186,9 +314,11 @@ def open_firewall(also_public=False, allow_icmp=False):
         run(fr'netsh advfirewall firewall add rule name="Allow ICMPv4 Echo In" dir=in action=allow enable=yes protocol=ICMPv4:8,any profile={profiles}', check=False)
     print(f"Firewall: SSH open on profiles: {profiles}")
 
+WINLOGON_KEY = r"SOFTWARE\Microsoft\Windows NT\CurrentVersion\Winlogon"
+
 def set_auto_logon(user, domain, password_plain):
     print("\n=== Configuring Windows auto-logon ===")
-    key = r"SOFTWARE\Microsoft\Windows NT\CurrentVersion\Winlogon"
+    key = WINLOGON_KEY
     reg_set(winreg.HKEY_LOCAL_MACHINE, key, "AutoAdminLogon", "1", winreg.REG_SZ)
     reg_set(winreg.HKEY_LOCAL_MACHINE, key, "DefaultUserName", user, winreg.REG_SZ)
     reg_set(winreg.HKEY_LOCAL_MACHINE, key, "DefaultPassword", password_plain, winreg.REG_SZ)
@@ -206,24 +336,216 @@ def verify_sshd():
         run(r'netstat -ano | findstr /R /C:":22 .*LISTENING"', check=False)
         sys.exit(2)
 
+# ---------------- converge (probe, plan, run only what differs) ----------------
+CHOCO_SSHD = r"C:\Program Files\OpenSSH-Win64\sshd.exe"
+HOST_KEY = os.path.join(SSHD_CONFIG_DIR, "ssh_host_ed25519_key")
+SSH_RULE = "OpenSSH Server (sshd)"
+ICMP_RULE = "Allow ICMPv4 Echo In"
+
+def check(step, what, current, desired, ok=None, secret=False):
+    ok = current == desired if ok is None else ok
+    return {"step": step, "what": what, "current": current, "desired": desired, "ok": ok, "secret": secret}
+
+def probe_install():
+    image = reg_get(winreg.HKEY_LOCAL_MACHINE, r"SYSTEM\CurrentControlSet\Services\sshd", "ImagePath") or ""
+    choco = "OpenSSH-Win64" in image and os.path.exists(CHOCO_SSHD)
+    return [check("install", "sshd service", image or "missing", CHOCO_SSHD, ok=choco)]
+
+def probe_host_keys():
+    return [check("host_keys", "host keys", os.path.exists(HOST_KEY), True)]
+
+def probe_sshd_config():
+    try:
+        with open(SSHD_CONFIG, "r", encoding="ascii", errors="replace") as f:
+            current = f.read().replace("\r\n", "\n")
+    except FileNotFoundError:
+        current = None
+    return [check("sshd_config", "sshd_config", "as desired" if current == SSHD_CONFIG_CONTENT else ("missing" if current is None else "differs"), "as desired")]
+
+def probe_services():
+    checks = []
+    for svc in ("ssh-agent", "sshd"):
+        start = reg_get(winreg.HKEY_LOCAL_MACHINE, rf"SYSTEM\CurrentControlSet\Services\{svc}", "Start")
+        state = run(f"sc query {svc}", check=False).stdout.upper()
+        checks.append(check("services", f"{svc} start type", "auto" if start == 2 else start, "auto"))
+        checks.append(check("services", f"{svc} running", "RUNNING" in state, True))
+    return checks
+
+def firewall_rules(name):
+    """Rules called name as dicts of netsh's 'Field: value' lines (lower-cased fields)."""
+    out = run(f'netsh advfirewall firewall show rule name="{name}" verbose', check=False).stdout
+    rules = []
+    for line in out.splitlines():
+        field, sep, value = line.partition(":")
+        if not sep:
+            continue
+        field = field.strip().lower()
+        if field == "rule name":
+            rules.append({})
+        elif rules:
+            rules[-1][field] = value.strip()
+    return rules
+
+def rule_summary(rules):
+    if not rules:
+        return "missing"
+    if len(rules) > 1:
+        return f"{len(rules)} duplicate rules"
+    rule = rules[0]
+    profiles = ",".join(sorted(p.strip().lower() for p in rule.get("profiles", "").split(",")))
+    return f"{rule.get('enabled', '').lower()} {rule.get('direction', '').lower()} {rule.get('action', '').lower()} {rule.get('protocol', '').lower()}:{rule.get('localport', '').lower()} {profiles}"
+
+def probe_firewall(also_public, allow_icmp):
+    profiles = "domain,private,public" if also_public else "domain,private"
+    checks = [check("firewall", SSH_RULE, rule_summary(firewall_rules(SSH_RULE)), f"yes in allow tcp:22 {profiles}")]
+    icmp = firewall_rules(ICMP_RULE)
+    checks.append(check("firewall", ICMP_RULE, "present" if icmp else "missing", "present" if allow_icmp else "missing"))
+    return checks
+
+def probe_default_shell():
+    current = reg_get(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\OpenSSH", "DefaultShell")
+    return [check("default_shell", "DefaultShell", current, desired_shell())]
+
+def probe_auto_logon(user, domain, password_plain):
+    get = lambda name: reg_get(winreg.HKEY_LOCAL_MACHINE, WINLOGON_KEY, name)
+    count = get("AutoLogonCount")
+    return [
+        check("auto_logon", "AutoAdminLogon", get("AutoAdminLogon"), "1"),
+        check("auto_logon", "DefaultUserName", get("DefaultUserName"), user),
+        check("auto_logon", "DefaultDomainName", get("DefaultDomainName"), domain),
+        check("auto_logon", "DefaultPassword", get("DefaultPassword"), password_plain, secret=True),
+        # Winlogon counts AutoLogonCount down on every auto-logon and deletes it at zero, so a
+        # consumed count is the expected state after the first boot, not drift.
+        check("auto_logon", "AutoLogonCount", count, 1, ok=count in (None, 0, 1)),
+    ]
+
+def probe_state(args, pw):
+    print("\n=== Probing current state ===")
+    probes = [
+        probe_install, probe_host_keys, probe_sshd_config, probe_services, probe_default_shell,
+        lambda: probe_firewall(args.also_public, args.allow_icmp),
+        lambda: probe_auto_logon(args.user, args.domain, pw),
+    ]
+    with ThreadPoolExecutor(max_workers=len(probes)) as pool:
+        return [c for checks in pool.map(lambda probe: probe(), probes) for c in checks]
+
+def print_diff(checks):
+    print("\n=== Diff (current -> desired) ===")
+    for c in checks:
+        if c["ok"]:
+            print(f"  [ok]     {c['what']}")
+        elif c["secret"]:
+            print(f"  [change] {c['what']}: (hidden)")
+        else:
+            print(f"  [change] {c['what']}: {c['current']} -> {c['desired']}")
+
+def reinstall(args):
+    # Anything but a Chocolatey sshd (built-in capability, half-removed install) gets the full wipe first.
+    # Packages are verified before anything is removed.
+    package_dir = prepare_package_source(args.package_source, args.package_cache) if args.package_source else None
+    kill_processes(); remove_services(); remove_firewall_rules(); uninstall_choco_package()
+    remove_folders(); remove_registry(); remove_builtin_capability(try_remove=(not args.skip_dism))
+    ensure_choco(package_dir); install_openssh(package_dir)
+
+def converge_firewall(args):
+    open_firewall(also_public=args.also_public, allow_icmp=args.allow_icmp)
+    if not args.allow_icmp:
+        run(fr'netsh advfirewall firewall delete rule name="{ICMP_RULE}"', check=False)
+
+def converge_services(restart_sshd):
+    register_and_start_services()
+    if restart_sshd:
+        run("sc stop sshd", check=False); time.sleep(1); run("sc start sshd", check=False)
+
+def compute_plan(checks, args, pw):
+    """Steps {name: (deps, action)} that bring the checks that differ to the desired state."""
+    changed = {c["step"] for c in checks if not c["ok"]}
+    if "install" in changed:
+        # The wipe removes keys, config and the OpenSSH registry key, so everything after it must run.
+        changed |= {"host_keys", "sshd_config", "services", "default_shell", "firewall"}
+    if "sshd_config" in changed:
+        changed.add("services")
+    steps = {
+        "install": ([], lambda: reinstall(args)),
+        "host_keys": (["install"], generate_host_keys),
+        "sshd_config": (["install"], lambda: write_sshd_config(restart=False)),
+        "services": (["install", "host_keys", "sshd_config"], lambda: converge_services("sshd_config" in changed)),
+        "default_shell": (["install"], set_default_shell),
+        "firewall": (["install"], lambda: converge_firewall(args)),
+        "auto_logon": ([], lambda: set_auto_logon(args.user, args.domain, pw)),
+    }
+    return {name: ([d for d in deps if d in changed], action) for name, (deps, action) in steps.items() if name in changed}
+
+def run_plan(plan, jobs=4):
+    """Run each step once its dependencies finished; independent steps run side by side."""
+    done, running = set(), {}
+    pending = dict(plan)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            for name, (deps, action) in list(pending.items()):
+                if all(d in done for d in deps):
+                    running[pool.submit(action)] = name
+                    del pending[name]
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()  # a failed step stops the run
+                done.add(name)
+
+def converge(args, pw):
+    started = time.time()
+    checks = probe_state(args, pw)
+    print_diff(checks)
+    plan = compute_plan(checks, args, pw)
+    if args.plan:
+        print("\nPlan: " + (", ".join(plan) if plan else "nothing to do"))
+        return
+    if not plan:
+        print(f"\nAlready converged (checked in {time.time() - started:.1f}s).")
+    else:
+        print("\n=== Applying: " + ", ".join(plan) + " ===")
+        run_plan(plan, jobs=args.jobs)
+    verify_sshd()
+    print(f"\n=== Converged in {time.time() - started:.1f}s ===")
+
 # ---------------- main ----------------
 def main():
     if os.name != "nt":
         print("Windows only."); sys.exit(1)
-    if not is_admin():
-        print("Please run in an elevated (Administrator) shell."); sys.exit(1)
 
-    ap = argparse.ArgumentParser(description="Idempotent OpenSSH setup on Windows (wipe+install+configure)")
-    ap.add_argument("--user", required=True, help="User for Windows auto-logon and SSH login")
+    ap = argparse.ArgumentParser(description="Idempotent OpenSSH setup on Windows (wipe+install+configure, or --converge to change only what differs)")
+    ap.add_argument("--user", help="User for Windows auto-logon and SSH login (required unless --populate-cache)")
     ap.add_argument("--domain", default=os.environ.get("COMPUTERNAME",""), help="Domain/computer for autologon (default: this computer)")
     ap.add_argument("--password", help="Autologon password (if omitted you'll be prompted)")
     ap.add_argument("--also-public", action="store_true", help="Also open SSH on Public firewall profile")
     ap.add_argument("--allow-icmp", action="store_true", help="Allow inbound ping")
     ap.add_argument("--skip-dism", action="store_true", help="Skip DISM removal of built-in capability (avoids 24H2 hangs)")
+    ap.add_argument("--converge", action="store_true", help="Probe the current state and run only the steps that differ instead of wiping")
+    ap.add_argument("--plan", action="store_true", help="With --converge: print the diff and the steps it would run, change nothing")
+    ap.add_argument("--jobs", type=int, default=4, help="Independent converge steps run at once")
+    ap.add_argument("--package-source", help="Directory, share or http(s) URL with hash-verified nupkgs; install without the public feed")
+    ap.add_argument("--package-cache", default=DEFAULT_PACKAGE_CACHE, help="Where packages from an http(s) --package-source are kept")
+    ap.add_argument("--populate-cache", metavar="DIR", help="Download the packages into DIR with their hashes and exit")
+    ap.add_argument("--packages", nargs="+", default=list(DEFAULT_PACKAGES), help="Packages for --populate-cache, as id or id==version")
     args = ap.parse_args()
 
+    if args.populate_cache:
+        populate_cache(args.populate_cache, args.packages)
+        return
+    if not args.user:
+        ap.error("--user is required")
+    if not is_admin():
+        print("Please run in an elevated (Administrator) shell."); sys.exit(1)
+
     pw = args.password or getpass.getpass(f"Enter password for {args.domain}\\{args.user}: ")
 
+    if args.converge or args.plan:
+        converge(args, pw)
+        return
+
+    # Verify the offline packages before the wipe so a broken cache cannot leave the VM without OpenSSH.
+    package_dir = prepare_package_source(args.package_source, args.package_cache) if args.package_source else None
+
     # Full wipe — always safe to re-run
     kill_processes()
     remove_services()
@@ -234,8 +556,8 @@ def main():
     remove_builtin_capability(try_remove=(not args.skip_dism))
 
     # Fresh install + config
-    ensure_choco()
-    install_openssh()
+    ensure_choco(package_dir)
+    install_openssh(package_dir)
     generate_host_keys()
     register_and_start_services()
     set_default_shell()
@@ -0,0 +1,242 @@
+import argparse
+import gzip
+import os
+import re
+import shutil
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+from artifact_sync import DEFAULT_CACHE_PATH, HashCache
+
+DEFAULT_GZIP_CACHE = os.path.join(os.path.expanduser("~"), ".privacyfirst", "gzip")
+# Only keep a gzip variant when it saves at least this fraction of the original size.
+GZIP_MIN_SAVING = 0.1
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ArtifactRequestHandler(BaseHTTPRequestHandler):
+    """HTTP/1.1 file handler: keep-alive, single byte ranges, SHA-256 ETags, gzip variants.
+
+    ETags are the quoted SHA-256 of the file (``"<hex>-gzip"`` for the compressed
+    variant), so a client can send the hash of its local copy as ``If-None-Match``
+    and get a 304 instead of the body. Range requests are always answered from the
+    uncompressed file so a resumed download can simply be appended.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "PrivacyFirstArtifacts/1.0"
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def log_message(self, format, *args):  # noqa: A002
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _serve(self, send_body: bool):
+        path = self._resolve(urlsplit(self.path).path)
+        if path is None:
+            self._send_empty(HTTPStatus.NOT_FOUND)
+            return
+        digest = self.server.digest(path)
+        etag = f'"{digest}"'
+        size = os.path.getsize(path)
+
+        if self._matches(self.headers.get("If-None-Match"), digest):
+            self._send_empty(HTTPStatus.NOT_MODIFIED, {"ETag": etag})
+            return
+
+        byte_range = None
+        range_header = self.headers.get("Range")
+        if range_header and self._if_range_holds(etag):
+            byte_range = self._parse_range(range_header, size)
+            if byte_range is None:
+                self._send_empty(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, {"Content-Range": f"bytes */{size}"})
+                return
+
+        headers = {"ETag": etag, "Accept-Ranges": "bytes", "Vary": "Accept-Encoding"}
+        body_path = path
+        if byte_range is None and self._accepts_gzip():
+            variant = self.server.gzip_variant(path, digest)
+            if variant is not None:
+                body_path = variant
+                size = os.path.getsize(variant)
+                headers["ETag"] = f'"{digest}-gzip"'
+                headers["Content-Encoding"] = "gzip"
+
+        if byte_range is None:
+            status, offset, length = HTTPStatus.OK, 0, size
+        else:
+            start, end = byte_range
+            status, offset, length = HTTPStatus.PARTIAL_CONTENT, start, end - start + 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body and length:
+            with open(body_path, "rb") as handle:
+                # socket.sendfile uses os.sendfile where the platform has it and falls back to send().
+                self.connection.sendfile(handle, offset, length)
+
+    def _resolve(self, url_path: str):
+        name = unquote(url_path).lstrip("/")
+        root = self.server.directory
+        path = os.path.realpath(os.path.join(root, name))
+        if not name or os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            return None
+        return path
+
+    @staticmethod
+    def _matches(header, digest: str) -> bool:
+        if not header:
+            return False
+        if header.strip() == "*":
+            return True
+        # Weak comparison: a client hashing its decompressed copy matches both variants.
+        candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+        return f'"{digest}"' in candidates or f'"{digest}-gzip"' in candidates
+
+    def _if_range_holds(self, etag: str) -> bool:
+        if_range = self.headers.get("If-Range")
+        return if_range is None or if_range.strip() == etag
+
+    @staticmethod
+    def _parse_range(header: str, size: int):
+        match = RANGE_PATTERN.match(header.strip())
+        if not match or size == 0:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        elif last:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            return None
+        if start > end or start >= size:
+            return None
+        return start, end
+
+    def _accepts_gzip(self) -> bool:
+        encodings = self.headers.get("Accept-Encoding", "")
+        return any(item.split(";")[0].strip() == "gzip" for item in encodings.split(","))
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class ArtifactHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, directory: str, hash_cache: HashCache, gzip_dir: str, verbose: bool = False):
+        super().__init__(address, ArtifactRequestHandler)
+        self.directory = os.path.realpath(directory)
+        self.hash_cache = hash_cache
+        self.gzip_dir = gzip_dir
+        self.verbose = verbose
+        self._gzip_lock = threading.Lock()
+
+    def digest(self, path: str) -> str:
+        digest = self.hash_cache.digest(path)
+        self.hash_cache.save()
+        return digest
+
+    def gzip_variant(self, path: str, digest: str):
+        """Path of the cached gzip copy of ``path``, created on first use; None when not worth it."""
+        if not self.gzip_dir:
+            return None
+        variant = os.path.join(self.gzip_dir, f"{digest}.gz")
+        skipped = f"{variant}.skip"
+        with self._gzip_lock:
+            if os.path.exists(skipped):
+                return None
+            if not os.path.exists(variant):
+                os.makedirs(self.gzip_dir, exist_ok=True)
+                tmp_path = f"{variant}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(path, "rb") as source, gzip.open(tmp_path, "wb", compresslevel=6) as target:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+                if os.path.getsize(tmp_path) > os.path.getsize(path) * (1 - GZIP_MIN_SAVING):
+                    os.remove(tmp_path)
+                    open(skipped, "w").close()
+                    return None
+                os.replace(tmp_path, variant)
+        return variant
+
+    def precompress(self, names):
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                self.gzip_variant(path, self.digest(path))
+
+
+class ArtifactServer(threading.Thread):
+    def __init__(
+        self,
+        directory: str,
+        bind_ip: str,
+        port: int,
+        *,
+        hash_cache: HashCache = None,
+        gzip_dir: str = DEFAULT_GZIP_CACHE,
+        verbose: bool = False,
+    ):
+        super().__init__(daemon=True)
+        self._server = ArtifactHTTPServer(
+            (bind_ip, port),
+            directory,
+            hash_cache or HashCache(DEFAULT_CACHE_PATH),
+            gzip_dir,
+            verbose=verbose,
+        )
+
+    def precompress(self, names):
+        started = time.time()
+        self._server.precompress(names)
+        return time.time() - started
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve build artifacts to VMs over HTTP/1.1")
+    parser.add_argument("--directory", required=True)
+    parser.add_argument("--bind", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9910)
+    parser.add_argument("--gzip-cache", default=DEFAULT_GZIP_CACHE, help="Directory for gzip variants")
+    parser.add_argument("--no-gzip", action="store_true", help="Never serve gzip variants")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = ArtifactServer(args.directory, args.bind, args.port, gzip_dir=None if args.no_gzip else args.gzip_cache, verbose=True)
+    print(f"Serving {args.directory} on {args.bind}:{args.port}")
+    server.start()
+    try:
+        while server.is_alive():
+            server.join(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".privacyfirst", "artifact_hashes.json")
+
+
+def sha256_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """SHA-256 digests of local files, reused while a file's (mtime, size) is unchanged."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as handle:
+                self._entries = json.load(handle)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def digest(self, path: str) -> str:
+        full_path = os.path.abspath(path)
+        stat = os.stat(full_path)
+        with self._lock:
+            entry = self._entries.get(full_path)
+            if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                return entry["sha256"]
+        digest = sha256_file(full_path)
+        with self._lock:
+            self._entries[full_path] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest}
+            self._dirty = True
+        return digest
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as handle:
+                json.dump(self._entries, handle)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+def local_manifest(build_path: str, files, cache: HashCache):
+    manifest = {name: cache.digest(os.path.join(build_path, name)) for name in files}
+    cache.save()
+    return manifest
+
+
+def remote_manifest_script(remote_dir: str, files) -> str:
+    file_list = ", ".join("'" + name.replace("'", "''") + "'" for name in files)
+    return f"""
+$ErrorActionPreference = 'Stop'
+$dest = '{remote_dir}'
+$hashes = @{{}}
+foreach ($name in @({file_list})) {{
+    $path = Join-Path $dest $name
+    if (Test-Path -LiteralPath $path -PathType Leaf) {{
+        $hashes[$name] = (Get-FileHash -LiteralPath $path -Algorithm SHA256).Hash.ToLowerInvariant()
+    }}
+}}
+$hashes | ConvertTo-Json -Compress
+"""
+
+
+def changed_files(local, remote):
+    return [name for name, digest in local.items() if remote.get(name) != digest]
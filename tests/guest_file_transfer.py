@@ -0,0 +1,164 @@
+import base64
+import hashlib
+import json
+import ntpath
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ps_command import powershell_args
+
+# PVE's agent/file-write takes at most 61440 characters of content; 45 KiB of raw
+# bytes is exactly that once base64 encoded.
+CHUNK_SIZE = 45 * 1024
+PARTS_DIR = ".pf_parts"
+MANIFEST_FILE = "manifest.json"
+
+
+def run_guest_command(
+    client,
+    node,
+    vmid,
+    command,
+    args,
+    timeout=300,
+    min_interval=0.1,
+    max_interval=2.0,
+    backoff=1.5,
+):
+    """Run ``command`` through agent/exec and poll exec-status, quickly at first then backing off."""
+    payload = {
+        "command": command,
+        "extra-args": args,
+    }
+    resp = client.post(f"/nodes/{node}/qemu/{vmid}/agent/exec", json_body=payload)
+    pid = resp["pid"]
+    deadline = time.time() + timeout
+    interval = min_interval
+    while time.time() < deadline:
+        status = client.get(f"/nodes/{node}/qemu/{vmid}/agent/exec-status", params={"pid": pid})
+        if status.get("exited"):
+            out_data = status.get("out-data")
+            err_data = status.get("err-data")
+            stdout = base64.b64decode(out_data).decode(errors="ignore") if out_data else ""
+            stderr = base64.b64decode(err_data).decode(errors="ignore") if err_data else ""
+            return status.get("exitcode"), stdout, stderr
+        time.sleep(min(interval, max(0.0, deadline - time.time())))
+        interval = min(max_interval, interval * backoff)
+    raise TimeoutError("Guest command timed out")
+
+
+def run_guest_powershell(client, node, vmid, script, timeout=300):
+    return run_guest_command(client, node, vmid, "powershell.exe", powershell_args(script), timeout=timeout)
+
+
+def plan_chunks(build_path, files, chunk_size=CHUNK_SIZE):
+    """Return ``(manifest, chunks)``: per-file SHA-256/size/part count and ``(file_index, part, offset, length)``."""
+    manifest = []
+    chunks = []
+    for index, name in enumerate(files):
+        path = os.path.join(build_path, name)
+        size = os.path.getsize(path)
+        digest = hashlib.sha256()
+        with open(path, "rb") as handle:
+            for block in iter(lambda: handle.read(1024 * 1024), b""):
+                digest.update(block)
+        parts = -(-size // chunk_size)
+        manifest.append({"name": name, "sha256": digest.hexdigest(), "size": size, "parts": parts})
+        for part in range(parts):
+            offset = part * chunk_size
+            chunks.append((index, part, offset, min(chunk_size, size - offset)))
+    return manifest, chunks
+
+
+def part_path(remote_dir, file_index, part):
+    return ntpath.join(remote_dir, PARTS_DIR, f"{file_index:03d}.{part:05d}")
+
+
+def assemble_script(remote_dir):
+    # The manifest is written next to the parts, so the command line stays the same size however many files there are.
+    return f"""
+$ErrorActionPreference = 'Stop'
+$dest = '{remote_dir}'
+$partsDir = Join-Path $dest '{PARTS_DIR}'
+$manifest = @(Get-Content -Raw -LiteralPath (Join-Path $partsDir '{MANIFEST_FILE}') | ConvertFrom-Json)
+$results = @()
+for ($index = 0; $index -lt $manifest.Count; $index++) {{
+    $entry = $manifest[$index]
+    $target = Join-Path $dest $entry.name
+    $parent = Split-Path -Parent $target
+    if (-not (Test-Path -LiteralPath $parent)) {{ New-Item -ItemType Directory -Path $parent -Force | Out-Null }}
+    $output = [System.IO.File]::Open($target, [System.IO.FileMode]::Create, [System.IO.FileAccess]::Write)
+    try {{
+        for ($part = 0; $part -lt $entry.parts; $part++) {{
+            $bytes = [System.IO.File]::ReadAllBytes((Join-Path $partsDir ('{{0:D3}}.{{1:D5}}' -f $index, $part)))
+            $output.Write($bytes, 0, $bytes.Length)
+        }}
+    }} finally {{
+        $output.Close()
+    }}
+    $actual = (Get-FileHash -LiteralPath $target -Algorithm SHA256).Hash.ToLowerInvariant()
+    $results += [PSCustomObject]@{{ Name = $entry.name; Ok = ($actual -eq $entry.sha256); Sha256 = $actual }}
+}}
+Remove-Item -LiteralPath $partsDir -Recurse -Force
+ConvertTo-Json -InputObject @($results) -Compress
+"""
+
+
+def push_files(
+    client,
+    node,
+    vmid,
+    build_path,
+    files,
+    remote_dir,
+    workers=4,
+    chunk_size=CHUNK_SIZE,
+    timeout=300,
+    plan=None,
+):
+    """Copy ``files`` into the guest with agent/file-write only, no guest networking required.
+
+    Each file is cut into chunks that are written as separate part files by
+    ``workers`` concurrent requests (file-write always truncates, so parts cannot
+    be appended in place). The manifest is written the same way; one guest
+    command then reads it, joins the parts and checks every file's SHA-256. ``plan`` is a precomputed ``plan_chunks`` result, so the
+    hashing can happen while the VM is still booting. Returns ``(bytes_sent, seconds)``.
+    """
+    started = time.time()
+    manifest, chunks = plan or plan_chunks(build_path, files, chunk_size)
+    manifest_json = json.dumps(manifest)
+    if len(manifest_json) > CHUNK_SIZE:
+        raise ValueError(f"Transfer manifest of {len(files)} files does not fit in one agent/file-write")
+    prepare = f"New-Item -ItemType Directory -Path '{ntpath.join(remote_dir, PARTS_DIR)}' -Force | Out-Null"
+    exitcode, _, stderr = run_guest_powershell(client, node, vmid, prepare, timeout=timeout)
+    if exitcode != 0:
+        raise RuntimeError(f"Could not create {remote_dir} in the guest: {stderr.strip()}")
+
+    def write_file(path, data):
+        client.post(
+            f"/nodes/{node}/qemu/{vmid}/agent/file-write",
+            data_body={"file": path, "content": base64.b64encode(data).decode(), "encode": 0},
+        )
+        return len(data)
+
+    def write_chunk(chunk):
+        index, part, offset, length = chunk
+        with open(os.path.join(build_path, manifest[index]["name"]), "rb") as handle:
+            handle.seek(offset)
+            data = handle.read(length)
+        return write_file(part_path(remote_dir, index, part), data)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        written = pool.submit(write_file, ntpath.join(remote_dir, PARTS_DIR, MANIFEST_FILE), manifest_json.encode("utf-8"))
+        sent = sum(pool.map(write_chunk, chunks))
+        written.result()
+
+    exitcode, stdout, stderr = run_guest_powershell(client, node, vmid, assemble_script(remote_dir), timeout=timeout)
+    if exitcode != 0:
+        raise RuntimeError(f"Assembling artifacts in the guest failed: {stderr.strip() or stdout.strip()}")
+    results = json.loads(stdout)
+    bad = [result["Name"] for result in results if not result["Ok"]]
+    if bad:
+        raise RuntimeError(f"Checksum mismatch after guest-agent transfer: {', '.join(bad)}")
+    return sent, time.time() - started
@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+from proxmox_tasks import upid_label, upid_node
+from proxmox_tickets import DEFAULT_TICKET_CACHE, TICKET_RENEW_AFTER, TicketCache, needs_renewal
+
+
+class AsyncProxmoxClient:
+    """asyncio Proxmox API client sharing one login and a pool of keep-alive connections.
+
+    Any number of coroutines may call ``get``/``post``/``delete`` concurrently; at most
+    ``max_connections`` TLS connections to the node are opened and then reused.
+    Tickets come from ``tickets`` when a fresh one is cached, and are renewed an
+    hour after issue, well before PVE's two-hour expiry.
+    """
+
+    def __init__(self, host: str, user: str, password: str, tickets: TicketCache = None, max_connections: int = 8):
+        self.base = f"https://{host}:8006/api2/json"
+        self.host = host
+        self.user = user
+        self.password = password
+        self.tickets = tickets
+        self.max_connections = max_connections
+        self.ticket = None
+        self.csrf = None
+        self.issued = None
+        self.session = None
+        self._login_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ssl=False, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, raise_for_status=False)
+        await self.login()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    # ---------------- auth ----------------
+    async def login(self, force: bool = False):
+        issued = self.issued
+        async with self._login_lock:
+            # Another coroutine may have renewed while this one waited for the lock.
+            if self.issued != issued and not force:
+                return
+            cached = self.tickets.get(self.host, self.user) if self.tickets and not force else None
+            if cached and not needs_renewal(cached):
+                self._apply_ticket(cached["ticket"], cached["csrf"], cached["issued"])
+                return
+            payload = None
+            if cached or self.ticket:
+                try:
+                    payload = await self._request_ticket(cached["ticket"] if cached else self.ticket)
+                except aiohttp.ClientResponseError:
+                    payload = None
+            if payload is None:
+                payload = await self._request_ticket(self.password)
+            issued = time.time()
+            self._apply_ticket(payload["ticket"], payload["CSRFPreventionToken"], issued)
+            if self.tickets:
+                self.tickets.put(self.host, self.user, payload["ticket"], payload["CSRFPreventionToken"], issued)
+
+    async def _request_ticket(self, password: str):
+        async with self.session.post(
+            f"{self.base}/access/ticket",
+            data={"username": self.user, "password": password},
+        ) as resp:
+            resp.raise_for_status()
+            return (await resp.json())["data"]
+
+    def _apply_ticket(self, ticket: str, csrf: str, issued: float):
+        self.ticket = ticket
+        self.csrf = csrf
+        self.issued = issued
+
+    def headers(self):
+        return {
+            "Cookie": f"PVEAuthCookie={self.ticket}",
+            "CSRFPreventionToken": self.csrf,
+        }
+
+    # ---------------- requests ----------------
+    async def _request(self, method: str, path: str, **kwargs):
+        if self.issued is None or time.time() - self.issued >= TICKET_RENEW_AFTER:
+            await self.login()
+        for attempt in range(2):
+            async with self.session.request(method, f"{self.base}{path}", headers=self.headers(), **kwargs) as resp:
+                if resp.status == 401 and attempt == 0:
+                    if self.tickets:
+                        self.tickets.drop(self.host, self.user)
+                    await self.login(force=True)
+                    continue
+                resp.raise_for_status()
+                body = await resp.read()
+                if not body:
+                    return None
+                return (await resp.json())["data"]
+
+    async def get(self, path: str, params=None):
+        return await self._request("GET", path, params=params)
+
+    async def post(self, path: str, *, json_body=None, data_body=None, params=None):
+        kwargs = {}
+        if json_body is not None:
+            kwargs["json"] = json_body
+        if data_body is not None:
+            kwargs["data"] = data_body
+        if params is not None:
+            kwargs["params"] = params
+        return await self._request("POST", path, **kwargs)
+
+    async def delete(self, path: str, params=None):
+        return await self._request("DELETE", path, params=params)
+
+    # ---------------- tasks ----------------
+    async def wait_task(
+        self,
+        node: str,
+        upid: str,
+        timeout: int = 600,
+        min_interval: float = 0.25,
+        max_interval: float = 5.0,
+        backoff: float = 1.6,
+        show_log: bool = True,
+    ):
+        """Poll one task like TaskWaiter does, without holding a connection between polls."""
+        node = upid_node(upid, node)
+        label = upid_label(upid)
+        base = f"/nodes/{node}/tasks/{upid}"
+        deadline = time.time() + timeout
+        started = time.time()
+        interval = min_interval
+        offset = 0
+        state = None
+        while True:
+            status = await self.get(f"{base}/status")
+            if status.get("status") != state:
+                state = status.get("status")
+                print(f"  Proxmox task state: {state} ({label})")
+            lines = await self.get(f"{base}/log", params={"start": offset, "limit": 500}) or []
+            for entry in lines:
+                offset = max(offset, int(entry.get("n", offset)))
+                text = entry.get("t", "")
+                if show_log and text and text != "no content":
+                    print(f"    [{label}] {text}")
+            if state == "stopped":
+                return {
+                    "label": label,
+                    "exitstatus": status.get("exitstatus", "OK"),
+                    "seconds": round(time.time() - started, 2),
+                }
+            if time.time() >= deadline:
+                raise TimeoutError(f"Proxmox task timed out: {label}")
+            interval = min_interval if lines else min(max_interval, interval * backoff)
+            await asyncio.sleep(min(interval, max(0.0, deadline - time.time())))
+
+    async def wait_tasks(self, node: str, upids, timeout: int = 600, raise_on_failure: bool = True, **kwargs):
+        results = await asyncio.gather(*(self.wait_task(node, upid, timeout=timeout, **kwargs) for upid in upids))
+        results = dict(zip(upids, results))
+        failed = [result for result in results.values() if result["exitstatus"] != "OK"]
+        if raise_on_failure and failed:
+            details = "; ".join(f"{result['label']}: {result['exitstatus']}" for result in failed)
+            raise RuntimeError(f"Proxmox task failed: {details}")
+        return results
+
+
+async def rollback_vm(client: AsyncProxmoxClient, node: str, vmid: int, snapshot: str, start: bool):
+    upid = await client.post(f"/nodes/{node}/qemu/{vmid}/snapshot/{snapshot}/rollback")
+    await client.wait_task(node, upid, show_log=False)
+    print(f"  VM {vmid} rolled back to {snapshot}")
+    if start:
+        status = await client.get(f"/nodes/{node}/qemu/{vmid}/status/current")
+        if status.get("status") != "running":
+            await client.wait_task(node, await client.post(f"/nodes/{node}/qemu/{vmid}/status/start"), show_log=False)
+        print(f"  VM {vmid} running")
+
+
+async def run_rollbacks(args):
+    tickets = None if args.no_ticket_cache else TicketCache(args.ticket_cache)
+    started = time.time()
+    async with AsyncProxmoxClient(
+        args.proxmox_host,
+        args.proxmox_user,
+        args.proxmox_password,
+        tickets=tickets,
+        max_connections=args.max_connections,
+    ) as client:
+        node = args.node or (await client.get("/nodes"))[0]["node"]
+        results = await asyncio.gather(
+            *(rollback_vm(client, node, vmid, args.snapshot, args.start) for vmid in args.vmids),
+            return_exceptions=True,
+        )
+    failed = 0
+    for vmid, result in zip(args.vmids, results):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"  VM {vmid} failed: {result}")
+    print(f"Rolled back {len(args.vmids) - failed}/{len(args.vmids)} VMs in {time.time() - started:.1f}s")
+    return 1 if failed else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Roll back many Proxmox VMs concurrently over one pooled session")
+    parser.add_argument("--proxmox-host", required=True)
+    parser.add_argument("--proxmox-user", required=True)
+    parser.add_argument("--proxmox-password", required=True)
+    parser.add_argument("--node", help="Proxmox node name (defaults to the first node)")
+    parser.add_argument("--vmids", type=int, nargs="+", required=True)
+    parser.add_argument("--snapshot", default="baseline")
+    parser.add_argument("--start", action="store_true", help="Start each VM after rolling it back")
+    parser.add_argument("--max-connections", type=int, default=8, help="Keep-alive connections shared by all requests")
+    parser.add_argument("--ticket-cache", default=DEFAULT_TICKET_CACHE, help="File caching Proxmox auth tickets")
+    parser.add_argument("--no-ticket-cache", action="store_true", help="Always log in with the password")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(run_rollbacks(parse_args())))
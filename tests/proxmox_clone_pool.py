@@ -0,0 +1,225 @@
+import ipaddress
+import queue
+import socket
+import threading
+import time
+
+from proxmox_tasks import TaskWaiter
+
+# Only the guest's own loopback is skipped, so the simulator's 127.1.x.y guests still qualify.
+LOOPBACK = ipaddress.ip_address("127.0.0.1")
+
+
+class PooledVM:
+    def __init__(self, vmid: int, ip: str, ready_seconds: float):
+        self.vmid = vmid
+        self.ip = ip
+        self.ready_seconds = ready_seconds
+
+    def __repr__(self):
+        return f"PooledVM(vmid={self.vmid}, ip={self.ip})"
+
+
+class ClonePool(threading.Thread):
+    """Keep ``size`` booted clones of a template VM ready and recycle them after use.
+
+    ``client`` is anything with ProxmoxClient's path-based ``get``/``post``/``delete``
+    (``ProxmoxClient`` itself, or ``ProxmoxerRest`` around a proxmoxer API).
+    Linked clones need ``template_vmid`` to be a Proxmox template; for a plain VM
+    pass ``snapshot`` and the pool falls back to full clones of that snapshot.
+    """
+
+    def __init__(
+        self,
+        client,
+        node: str,
+        template_vmid: int,
+        size: int,
+        *,
+        snapshot=None,
+        transport: str = "ssh",
+        name_prefix: str = "pf-pool",
+        boot_timeout: int = 600,
+        ssh_port: int = 22,
+    ):
+        super().__init__(daemon=True)
+        if transport not in ("ssh", "agent"):
+            raise ValueError(f"Unsupported pool transport: {transport}")
+        self.client = client
+        self.node = node
+        self.template_vmid = template_vmid
+        self.size = size
+        self.snapshot = snapshot
+        self.transport = transport
+        self.name_prefix = name_prefix
+        self.boot_timeout = boot_timeout
+        self.ssh_port = ssh_port
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._provisioning = 0
+        self._leased = set()
+        self._workers = set()
+        self._linked = None
+
+    # ---------------- public API ----------------
+    def acquire(self, timeout: int = 900) -> PooledVM:
+        vm = self._ready.get(timeout=timeout)
+        with self._lock:
+            self._leased.add(vm.vmid)
+        self._wakeup.set()
+        return vm
+
+    def release(self, vm: PooledVM):
+        with self._lock:
+            self._leased.discard(vm.vmid)
+        self._spawn(self._destroy, vm.vmid)
+
+    def close(self):
+        """Stop refilling and return once every clone this pool created is destroyed."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join()
+        # In-flight provisions see the stop flag and destroy their clone; releases finish their destroy.
+        while True:
+            with self._lock:
+                workers = list(self._workers)
+            if not workers:
+                break
+            for worker in workers:
+                worker.join()
+        while True:
+            try:
+                vm = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            self._destroy(vm.vmid)
+
+    def run(self):
+        while not self._stopping.is_set():
+            with self._lock:
+                missing = self.size - self._ready.qsize() - self._provisioning
+                self._provisioning += max(0, missing)
+            for _ in range(max(0, missing)):
+                self._spawn(self._provision)
+            self._wakeup.wait(timeout=30)
+            self._wakeup.clear()
+
+    def _spawn(self, target, *args):
+        def work():
+            try:
+                target(*args)
+            finally:
+                with self._lock:
+                    self._workers.discard(thread)
+
+        thread = threading.Thread(target=work, daemon=True)
+        with self._lock:
+            self._workers.add(thread)
+        thread.start()
+
+    # ---------------- provisioning ----------------
+    def _uses_linked_clones(self) -> bool:
+        if self._linked is None:
+            config = self.client.get(f"/nodes/{self.node}/qemu/{self.template_vmid}/config")
+            self._linked = bool(int(config.get("template", 0) or 0))
+            if not self._linked and not self.snapshot:
+                raise RuntimeError(
+                    f"VM {self.template_vmid} is not a template; pass a snapshot to clone from instead"
+                )
+            if not self._linked:
+                print(f"  VM {self.template_vmid} is not a template, falling back to full clones of {self.snapshot}")
+        return self._linked
+
+    def _clone(self) -> int:
+        body = {"name": f"{self.name_prefix}-{self.template_vmid}"}
+        if self._uses_linked_clones():
+            body["full"] = 0
+        else:
+            body["full"] = 1
+            body["snapname"] = self.snapshot
+        # nextid is only reserved once the clone task has been created, so allocate under the lock.
+        with self._lock:
+            newid = int(self.client.get("/cluster/nextid"))
+            body["newid"] = newid
+            upid = self.client.post(f"/nodes/{self.node}/qemu/{self.template_vmid}/clone", data_body=body)
+        self._wait_task(upid)
+        return newid
+
+    def _provision(self):
+        started = time.time()
+        vmid = None
+        try:
+            vmid = self._clone()
+            print(f"  Pool clone {vmid} created, booting ...")
+            self._wait_task(self.client.post(f"/nodes/{self.node}/qemu/{vmid}/status/start"))
+            ip = self._wait_for_guest(vmid)
+            vm = PooledVM(vmid, ip, time.time() - started)
+            print(f"  Pool clone {vmid} ready at {ip} after {vm.ready_seconds:.0f}s")
+            with self._lock:
+                stopping = self._stopping.is_set()
+                if not stopping:
+                    self._ready.put(vm)
+            if stopping:
+                # Arrived after close(); nobody will acquire it.
+                self._destroy(vmid)
+        except Exception as exc:  # noqa: BLE001
+            if vmid is not None:
+                self._destroy(vmid)
+            if not self._stopping.is_set():
+                print(f"  Pool clone provisioning failed: {exc}")
+                self._stopping.wait(10)
+        finally:
+            with self._lock:
+                self._provisioning -= 1
+            self._wakeup.set()
+
+    def _wait_for_guest(self, vmid: int) -> str:
+        deadline = time.time() + self.boot_timeout
+        ip = None
+        while time.time() < deadline and not self._stopping.is_set():
+            try:
+                if ip is None:
+                    ip = self._guest_ip(vmid)
+                if ip and (self.transport == "agent" or _port_open(ip, self.ssh_port)):
+                    return ip
+            except Exception:  # noqa: BLE001
+                pass
+            time.sleep(2)
+        raise TimeoutError(f"Clone {vmid} did not become ready for {self.transport}")
+
+    def _guest_ip(self, vmid: int):
+        data = self.client.get(f"/nodes/{self.node}/qemu/{vmid}/agent/network-get-interfaces")
+        interfaces = data.get("result", []) if isinstance(data, dict) else data
+        for iface in interfaces:
+            for address in iface.get("ip-addresses") or []:
+                if address.get("ip-address-type") != "ipv4":
+                    continue
+                ip = ipaddress.ip_address(address["ip-address"])
+                if ip != LOOPBACK and not ip.is_link_local:
+                    return str(ip)
+        return None
+
+    def _destroy(self, vmid: int):
+        try:
+            status = self.client.get(f"/nodes/{self.node}/qemu/{vmid}/status/current")
+            if status.get("status") == "running":
+                self._wait_task(self.client.post(f"/nodes/{self.node}/qemu/{vmid}/status/stop"))
+            self._wait_task(self.client.delete(f"/nodes/{self.node}/qemu/{vmid}", params={"purge": 1}))
+            print(f"  Pool clone {vmid} destroyed")
+        except Exception as exc:  # noqa: BLE001
+            print(f"  Failed to destroy pool clone {vmid}: {exc}")
+        self._wakeup.set()
+
+    def _wait_task(self, upid, timeout: int = 600):
+        TaskWaiter(self.client, self.node, show_log=False).add(upid).wait(timeout=timeout)
+
+
+def _port_open(host: str, port: int, timeout: float = 2.0) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
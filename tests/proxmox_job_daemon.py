@@ -0,0 +1,563 @@
+import argparse
+import bisect
+import itertools
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from proxmox_matrix_runner import execute_job, job_namespace, load_spec
+from proxmox_ssh_runner import (
+    add_common_arguments,
+    connect_proxmox,
+    deploy_and_run,
+    find_artifacts,
+    lookup_node,
+    prepare_vm,
+    resolve_remote_dir,
+    save_result,
+)
+from run_timing import configure as configure_timing
+from ssh_broker import BrokerServer, parse_address
+
+DEFAULT_DAEMON_ADDRESS = "127.0.0.1:8724"
+# Per-job settings a submission may override; everything else comes from the daemon's command line.
+JOB_OVERRIDES = (
+    "snapshot",
+    "executable",
+    "build_path",
+    "files",
+    "remote_dir",
+    "command_timeout",
+    "warm",
+    "delta_sync",
+    "bundle",
+    "detach",
+    "post_launch_wait",
+)
+# Type of every field a submission may carry; numeric strings are accepted for integers.
+SPEC_FIELDS = {
+    "priority": int,
+    "vmid": int,
+    "program_args": list,
+    "rollback": bool,
+    "snapshot": str,
+    "executable": str,
+    "build_path": str,
+    "files": list,
+    "remote_dir": str,
+    "command_timeout": int,
+    "warm": bool,
+    "delta_sync": bool,
+    "bundle": bool,
+    "detach": bool,
+    "post_launch_wait": int,
+}
+MAX_FINISHED_JOBS = 1000
+MAX_JOB_EVENTS = 20000
+# A finished job keeps only the tail of its output in memory; the full logs are in the result store.
+MAX_RETAINED_OUTPUT = 200
+
+
+def validate_spec(spec, vmids):
+    """The submitted job ``spec`` with integers coerced; ValueError names the first bad field."""
+    if not isinstance(spec, dict):
+        raise ValueError("Job spec must be a JSON object")
+    unknown = sorted(set(spec) - set(SPEC_FIELDS))
+    if unknown:
+        raise ValueError(f"Unknown job fields: {', '.join(unknown)}")
+    clean = {}
+    for key, value in spec.items():
+        if value is None:
+            continue
+        kind = SPEC_FIELDS[key]
+        if kind is int:
+            try:
+                if isinstance(value, bool) or not isinstance(value, (int, str)):
+                    raise ValueError
+                value = int(value)
+            except ValueError:
+                raise ValueError(f"{key} must be an integer, got {value!r}") from None
+        elif kind is list:
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise ValueError(f"{key} must be a list of strings")
+        elif not isinstance(value, kind):
+            raise ValueError(f"{key} must be a {kind.__name__}, got {value!r}")
+        clean[key] = value
+    if clean.get("command_timeout") is not None and clean["command_timeout"] <= 0:
+        raise ValueError("command_timeout must be positive")
+    if clean.get("vmid") is not None and clean["vmid"] not in vmids:
+        raise ValueError(f"VM {clean['vmid']} is not managed by this daemon")
+    return clean
+
+
+class Job:
+    """One submitted run: its spec, state and an append-only event log callers can follow.
+
+    ``spec`` has been through ``validate_spec``. Events carry a ``seq`` that keeps counting
+    when ``trim`` drops old output, so followers resume by sequence number, not list index.
+    """
+
+    def __init__(self, spec, seq):
+        self.id = uuid.uuid4().hex[:12]
+        self.seq = seq
+        self.priority = spec.get("priority", 0)
+        self.vmid = spec.get("vmid")
+        self.program_args = spec.get("program_args", [])
+        # Skipping the rollback keeps the guest (and its pooled SSH transport) from the previous job.
+        self.rollback = spec.get("rollback", True)
+        self.overrides = {key: spec[key] for key in JOB_OVERRIDES if key in spec}
+        self.state = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.assigned_vmid = None
+        self.entry = None
+        self.events = []
+        self.next_seq = 0
+        self.events_dropped = 0
+        self._cond = threading.Condition()
+        self.emit("state", state="queued")
+
+    def emit(self, kind, **fields):
+        with self._cond:
+            if len(self.events) < MAX_JOB_EVENTS or kind != "output":
+                self.events.append(dict(fields, seq=self.next_seq, type=kind, time=round(time.time(), 3)))
+                self.next_seq += 1
+            else:
+                self.events_dropped += 1
+            self._cond.notify_all()
+
+    def on_line(self, stream_name, line):
+        self.emit("output", stream=stream_name, line=line)
+
+    def set_state(self, state, **fields):
+        self.state = state
+        self.emit("state", state=state, **fields)
+
+    @property
+    def done(self):
+        return self.state in ("finished", "cancelled")
+
+    def events_after(self, seq, timeout):
+        """Events numbered ``seq`` and later, waiting up to ``timeout`` for one while the job runs."""
+        with self._cond:
+            if self.next_seq <= seq and not self.done:
+                self._cond.wait(timeout)
+            if not self.events_dropped:
+                return self.events[seq:]
+            return [event for event in self.events if event["seq"] >= seq]
+
+    def trim(self):
+        """Keep the state and phase events and the last ``MAX_RETAINED_OUTPUT`` output lines."""
+        with self._cond:
+            excess = sum(event["type"] == "output" for event in self.events) - MAX_RETAINED_OUTPUT
+            if excess <= 0:
+                return
+            kept = []
+            for event in self.events:
+                if event["type"] == "output" and excess > 0:
+                    excess -= 1
+                    self.events_dropped += 1
+                else:
+                    kept.append(event)
+            self.events = kept
+
+    def describe(self, full=False):
+        data = {
+            "id": self.id,
+            "state": self.state,
+            "priority": self.priority,
+            "vmid": self.assigned_vmid or self.vmid,
+            "program_args": self.program_args,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if self.events_dropped:
+            data["events_dropped"] = self.events_dropped
+        if self.entry is not None:
+            data["status"] = self.entry["status"]
+            data["duration_seconds"] = self.entry["duration_seconds"]
+            if full:
+                data["result"] = self.entry
+        return data
+
+
+class JobQueue:
+    """Jobs ordered by priority (highest first), then submission order; some are pinned to a VMID."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queued = []
+        self._jobs = {}
+        self._finished = []
+        self._seq = itertools.count()
+
+    def submit(self, spec):
+        job = Job(spec, next(self._seq))
+        with self._cond:
+            self._jobs[job.id] = job
+            # seq is unique, so the Job itself is never compared.
+            bisect.insort(self._queued, (-job.priority, job.seq, job))
+            self._cond.notify_all()
+        return job
+
+    def position(self, job):
+        with self._cond:
+            for index, (_, _, queued) in enumerate(self._queued):
+                if queued is job:
+                    return index
+            return None
+
+    def take(self, vmid):
+        """Block until a job this VM may run is queued and hand it out."""
+        with self._cond:
+            while True:
+                for index, (_, _, job) in enumerate(self._queued):
+                    if job.vmid is None or job.vmid == vmid:
+                        del self._queued[index]
+                        return job
+                self._cond.wait()
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            entry = next((item for item in self._queued if item[2] is job), None)
+            if entry is None:
+                return False
+            self._queued.remove(entry)
+        job.set_state("cancelled")
+        self.retire(job)
+        return True
+
+    def retire(self, job):
+        job.trim()
+        with self._cond:
+            self._finished.append(job)
+            while len(self._finished) > MAX_FINISHED_JOBS:
+                self._jobs.pop(self._finished.pop(0).id, None)
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._cond:
+            return sorted(self._jobs.values(), key=lambda item: item.submitted)
+
+
+class JobDaemon:
+    """Run queued jobs on a fixed set of VMs, one job per VM at a time.
+
+    The Proxmox session and node lookup are set up once and shared by every job.
+    SSH transports are shared too when ``--ssh-broker`` points at a broker or
+    ``--local-broker`` starts one in-process; otherwise each job connects directly.
+    """
+
+    def __init__(self, args, vms):
+        self.args = args
+        self.vms = {int(vm["vmid"]): dict(vm, busy=None) for vm in vms}
+        self.queue = JobQueue()
+        self.proxmox = connect_proxmox(args)
+        self.node = lookup_node(self.proxmox)
+        self.broker = None
+        if args.local_broker and not args.ssh_broker:
+            self.broker = BrokerServer(("127.0.0.1", 0))
+            threading.Thread(target=self.broker.serve_forever, daemon=True).start()
+            args.ssh_broker = f"127.0.0.1:{self.broker.server_address[1]}"
+        # Output has to reach the job's event log, so always stream it.
+        args.stream_output = True
+
+    def start(self):
+        for vmid in self.vms:
+            threading.Thread(target=self._worker, args=(vmid,), daemon=True).start()
+
+    def close(self):
+        if self.broker is not None:
+            self.broker.shutdown()
+            self.broker.server_close()
+
+    def status(self):
+        return [
+            {"vmid": vmid, "vm_ip": vm["vm_ip"], "job": vm["busy"]}
+            for vmid, vm in sorted(self.vms.items())
+        ]
+
+    def _worker(self, vmid):
+        vm = self.vms[vmid]
+        while True:
+            job = self.queue.take(vmid)
+            vm["busy"] = job.id
+            job.assigned_vmid = vmid
+            job.started = time.time()
+            job.set_state("running", vmid=vmid)
+            try:
+                job.entry = self._run(job, vm)
+            finally:
+                vm["busy"] = None
+                job.finished = time.time()
+                job.set_state("finished", status=job.entry["status"] if job.entry else "error")
+                self.queue.retire(job)
+
+    def _run(self, job, vm):
+        job_args = job_namespace(
+            self.args,
+            {
+                "vmid": job.assigned_vmid,
+                "vm_ip": vm["vm_ip"],
+                "ssh_port": vm.get("ssh_port"),
+                "snapshot": job.overrides.get("snapshot", self.args.snapshot),
+                "program_args": job.program_args,
+            },
+        )
+        for key, value in job.overrides.items():
+            setattr(job_args, key, value)
+        description = {
+            "vmid": job.assigned_vmid,
+            "vm_ip": vm["vm_ip"],
+            "snapshot": job_args.snapshot,
+            "program_args": job.program_args,
+            "job": job.id,
+        }
+
+        artifacts = []
+
+        def runner():
+            artifacts.extend(find_artifacts(job_args.build_path, job_args.files))
+            remote_dir = resolve_remote_dir(job_args)
+            if job.rollback:
+                job.emit("phase", phase="prepare_vm")
+                prepare_vm(self.proxmox, self.node, job_args)
+            job.emit("phase", phase="deploy_and_run")
+            return deploy_and_run(job_args, artifacts, remote_dir, fresh_session=job.rollback, on_line=job.on_line)
+
+        return execute_job(
+            description,
+            runner,
+            record=lambda entry, result: save_result(job_args, artifacts, entry, result, runner="daemon"),
+            run_id=job.id,
+        )
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    server_version = "PrivacyFirstJobDaemon/1.0"
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job(self, job_id):
+        job = self.server.daemon.queue.get(job_id)
+        if job is None:
+            self._send_json(404, {"error": f"Unknown job {job_id}"})
+        return job
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json(404, {"error": "Not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            spec = validate_spec(json.loads(self.rfile.read(length) or b"{}"), self.server.daemon.vms)
+        except ValueError as exc:
+            self._send_json(400, {"error": str(exc)})
+            return
+        queue = self.server.daemon.queue
+        job = queue.submit(spec)
+        self._send_json(201, {"id": job.id, "state": job.state, "position": queue.position(job)})
+
+    def do_DELETE(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "jobs":
+            self._send_json(404, {"error": "Not found"})
+            return
+        if self._job(parts[1]) is None:
+            return
+        if not self.server.daemon.queue.cancel(parts[1]):
+            self._send_json(409, {"error": "Job is no longer queued"})
+            return
+        self._send_json(200, {"id": parts[1], "state": "cancelled"})
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        parts = path.strip("/").split("/")
+        daemon = self.server.daemon
+        if parts == ["jobs"]:
+            self._send_json(200, {"jobs": [job.describe() for job in daemon.queue.jobs()]})
+        elif parts == ["vms"]:
+            self._send_json(200, {"vms": daemon.status()})
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self._job(parts[1])
+            if job is not None:
+                self._send_json(200, job.describe(full=True))
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+            job = self._job(parts[1])
+            if job is not None:
+                self._stream_events(job, follow="follow=0" not in query)
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def _stream_events(self, job, follow=True):
+        # One JSON object per line; the response ends with the connection once the job is done.
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        seq = 0
+        try:
+            while True:
+                events = job.events_after(seq, timeout=15)
+                for event in events:
+                    self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+                if events:
+                    seq = events[-1]["seq"] + 1
+                self.wfile.flush()
+                if not follow or (job.done and seq >= job.next_seq):
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+
+class DaemonServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, daemon):
+        super().__init__(address, DaemonHandler)
+        self.daemon = daemon
+
+
+# ---------------- client side ----------------
+def daemon_request(address, method, path, payload=None):
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(
+        f"http://{address}{path}",
+        data=data,
+        method=method,
+        headers={"Content-Type": "application/json"} if data else {},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as exc:
+        raise RuntimeError(json.loads(exc.read() or b"{}").get("error", str(exc))) from exc
+
+
+def follow_job(address, job_id):
+    """Print a job's events as they arrive; returns its final status."""
+    status = None
+    with urllib.request.urlopen(f"http://{address}/jobs/{job_id}/events") as response:
+        for raw in response:
+            event = json.loads(raw)
+            if event["type"] == "output":
+                print(event["line"] if event["stream"] == "stdout" else f"[stderr] {event['line']}", flush=True)
+            elif event["type"] == "phase":
+                print(f"[job {job_id}] {event['phase']}", flush=True)
+            elif event["type"] == "state":
+                extra = f" on VM {event['vmid']}" if "vmid" in event else ""
+                status = event.get("status", status)
+                print(f"[job {job_id}] {event['state']}{extra}{': ' + status if status else ''}", flush=True)
+    return status
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Queue PrivacyFirst runs and schedule them across Proxmox VMs")
+    sub = parser.add_subparsers(dest="command_name", required=True)
+
+    serve = sub.add_parser("serve", help="Run the daemon")
+    add_common_arguments(serve)
+    serve.add_argument("--spec", required=True, help="Matrix-style JSON file whose vms the daemon schedules onto")
+    serve.add_argument("--snapshot", default="baseline", help="Snapshot jobs roll back to unless they override it")
+    serve.add_argument("--listen", default=DEFAULT_DAEMON_ADDRESS, help="host:port for the HTTP API")
+    serve.add_argument(
+        "--local-broker",
+        action="store_true",
+        help="Keep SSH transports in an in-process broker shared by all jobs (ignored with --ssh-broker)",
+    )
+
+    submit = sub.add_parser("submit", help="Queue a job")
+    submit.add_argument("--daemon", default=DEFAULT_DAEMON_ADDRESS)
+    submit.add_argument("--priority", type=int, default=0, help="Higher runs first")
+    submit.add_argument("--vmid", type=int, help="Pin the job to one VM")
+    submit.add_argument("--no-rollback", action="store_true", help="Reuse the VM as the previous job left it")
+    submit.add_argument("--set", action="append", default=[], help="Override a runner setting, e.g. snapshot=clean")
+    submit.add_argument("--follow", action="store_true", help="Stream the job's output and state until it finishes")
+    submit.add_argument("program_args", nargs=argparse.REMAINDER, help="-- arguments for the executable")
+
+    status = sub.add_parser("status", help="List jobs and VMs, or follow one job")
+    status.add_argument("--daemon", default=DEFAULT_DAEMON_ADDRESS)
+    status.add_argument("job_id", nargs="?")
+    status.add_argument("--follow", action="store_true")
+
+    cancel = sub.add_parser("cancel", help="Drop a queued job")
+    cancel.add_argument("--daemon", default=DEFAULT_DAEMON_ADDRESS)
+    cancel.add_argument("job_id")
+    return parser.parse_args(argv)
+
+
+def parse_override(text):
+    key, _, value = text.partition("=")
+    try:
+        return key.replace("-", "_"), json.loads(value)
+    except json.JSONDecodeError:
+        return key.replace("-", "_"), value
+
+
+def serve(args):
+    configure_timing(args.timings)
+    vms, _, _ = load_spec(args.spec)
+    daemon = JobDaemon(args, vms)
+    daemon.start()
+    server = DaemonServer(parse_address(args.listen), daemon)
+    print(f"Job daemon listening on http://{args.listen} with {len(daemon.vms)} VMs", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command_name == "serve":
+        serve(args)
+        return
+    if args.command_name == "submit":
+        program_args = args.program_args[1:] if args.program_args[:1] == ["--"] else args.program_args
+        spec = dict(parse_override(item) for item in args.set)
+        spec.update(priority=args.priority, vmid=args.vmid, program_args=program_args, rollback=not args.no_rollback)
+        reply = daemon_request(args.daemon, "POST", "/jobs", spec)
+        print(f"Job {reply['id']} queued at position {reply['position']}")
+        if args.follow:
+            status = follow_job(args.daemon, reply["id"])
+            sys.exit(0 if status == "pass" else 1)
+    elif args.command_name == "status":
+        if args.job_id and args.follow:
+            follow_job(args.daemon, args.job_id)
+        elif args.job_id:
+            print(json.dumps(daemon_request(args.daemon, "GET", f"/jobs/{args.job_id}"), indent=2))
+        else:
+            for vm in daemon_request(args.daemon, "GET", "/vms")["vms"]:
+                print(f"  VM {vm['vmid']} ({vm['vm_ip']}): {vm['job'] or 'idle'}")
+            for job in daemon_request(args.daemon, "GET", "/jobs")["jobs"]:
+                status = job.get("status", "")
+                print(f"  {job['id']} p{job['priority']} {job['state']:<9} {status:<7} vm {job['vmid'] or '-'} {job['program_args']}")
+    elif args.command_name == "cancel":
+        print(daemon_request(args.daemon, "DELETE", f"/jobs/{args.job_id}"))
+
+
+if __name__ == "__main__":
+    main()
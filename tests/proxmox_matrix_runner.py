@@ -0,0 +1,263 @@
+import argparse
+import copy
+import itertools
+import json
+import queue
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from proxmox_clone_pool import ClonePool
+from proxmox_rest import ProxmoxerRest
+from proxmox_ssh_runner import (
+    add_common_arguments,
+    connect_proxmox,
+    deploy_and_run,
+    find_artifacts,
+    resolve_remote_dir,
+    run_on_vm,
+    save_result,
+    summarize_result,
+)
+from proxmox_tasks import wait_for_tasks
+from run_timing import configure as configure_timing, run_scope, span
+
+# Example spec:
+# {
+#   "vms": [{"vmid": 102, "vm_ip": "192.168.0.52"}, {"vmid": 103, "vm_ip": "192.168.0.53"}],
+#   "snapshots": ["baseline"],
+#   "program_args": [[], ["--operation", "registry-hwids"]]
+# }
+# With --pool-template the "vms" and "snapshots" keys are ignored: every
+# program_args set runs on a fresh linked clone handed out by the pool.
+# A vm entry may also carry "ssh_port" to override --vm-ssh-port for that VM.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run PrivacyFirst across a matrix of VMs, snapshots and argument sets concurrently"
+    )
+    add_common_arguments(parser)
+    parser.add_argument("--spec", required=True, help="JSON file describing vms, snapshots and program_args")
+    parser.add_argument("--max-workers", type=int, default=0, help="VMs driven concurrently (default: all of them)")
+    parser.add_argument("--report", help="Write the merged JSON report to this path")
+    parser.add_argument("--shutdown-vms", action="store_true", help="Shut down every VM once its jobs finish")
+    parser.add_argument("--pool-template", type=int, help="Run jobs on warm clones of this template VMID")
+    parser.add_argument("--pool-size", type=int, default=2, help="Booted clones to keep ready")
+    parser.add_argument("--pool-snapshot", help="Snapshot to full-clone when the pool source is not a template")
+    return parser.parse_args()
+
+
+def load_spec(path, require_vms=True):
+    with open(path, "r", encoding="utf-8") as handle:
+        spec = json.load(handle)
+    vms = spec.get("vms") or []
+    if require_vms and not vms:
+        raise ValueError(f"Matrix spec {path} lists no vms")
+    for vm in vms:
+        if "vmid" not in vm or "vm_ip" not in vm:
+            raise ValueError(f"Matrix spec entry needs vmid and vm_ip: {vm}")
+    snapshots = spec.get("snapshots") or ["baseline"]
+    arg_sets = spec.get("program_args") or [[]]
+    return vms, snapshots, arg_sets
+
+
+def build_jobs(vms, snapshots, arg_sets):
+    jobs = []
+    for vm, snapshot, program_args in itertools.product(vms, snapshots, arg_sets):
+        job = {
+            "vmid": int(vm["vmid"]),
+            "vm_ip": vm["vm_ip"],
+            "snapshot": snapshot,
+            "program_args": list(program_args),
+        }
+        if vm.get("ssh_port"):
+            job["ssh_port"] = int(vm["ssh_port"])
+        jobs.append(job)
+    return jobs
+
+
+def job_namespace(base_args, job):
+    job_args = copy.copy(base_args)
+    job_args.vmid = job["vmid"]
+    job_args.vm_ip = job["vm_ip"]
+    if job.get("ssh_port"):
+        job_args.vm_ssh_port = job["ssh_port"]
+    job_args.snapshot = job["snapshot"]
+    job_args.program_args = job["program_args"]
+    return job_args
+
+
+def run_job(proxmox, node, base_args, job, artifacts, remote_dir):
+    return execute_job(
+        job,
+        lambda: run_on_vm(proxmox, node, job_namespace(base_args, job), artifacts, remote_dir),
+        record=lambda entry, result: save_result(base_args, artifacts, entry, result, runner="matrix"),
+    )
+
+
+def run_pool_job(pool, base_args, program_args, artifacts, remote_dir):
+    try:
+        vm = pool.acquire()
+    except queue.Empty:
+        return {
+            "vmid": 0,
+            "vm_ip": None,
+            "snapshot": "pool",
+            "program_args": list(program_args),
+            "status": "error",
+            "error": "No pool clone became ready",
+            "duration_seconds": 0.0,
+        }
+    job = {"vmid": vm.vmid, "vm_ip": vm.ip, "snapshot": "pool", "program_args": list(program_args)}
+    try:
+        return execute_job(
+            job,
+            # Every clone is new and its IP may be recycled, so never reuse a brokered session.
+            lambda: deploy_and_run(job_namespace(base_args, job), artifacts, remote_dir, fresh_session=True),
+            record=lambda entry, result: save_result(base_args, artifacts, entry, result, runner="matrix"),
+        )
+    finally:
+        pool.release(vm)
+
+
+def execute_job(job, runner, record=None, run_id=None):
+    """Run one job under its own timing run id; ``record(entry, result)`` stores the outcome."""
+    entry = dict(job)
+    result = None
+    started = time.time()
+    print(f"[vm {job['vmid']}] starting {job['snapshot']} {job['program_args']}")
+    with run_scope(run_id or uuid.uuid4().hex[:12]):
+        try:
+            result = runner()
+        except Exception as exc:  # noqa: BLE001
+            entry["error"] = str(exc)
+            entry["status"] = "error"
+        else:
+            summary = summarize_result(result)
+            entry["exit_code"] = result.get("ExitCode")
+            entry["summary"] = summary
+            entry["status"] = summary.get("overall_status", "unknown")
+        entry["duration_seconds"] = round(time.time() - started, 1)
+        print(f"[vm {job['vmid']}] finished with status {entry['status']} in {entry['duration_seconds']}s")
+        if record is not None:
+            record(entry, result)
+    return entry
+
+
+def run_vm_jobs(proxmox, node, base_args, jobs, artifacts, remote_dir):
+    # Jobs on the same VMID share one disk and snapshot tree, so they run back to back.
+    return [run_job(proxmox, node, base_args, job, artifacts, remote_dir) for job in jobs]
+
+
+def merge_report(entries, wall_seconds):
+    totals = {"pass": 0, "fail": 0, "error": 0, "unknown": 0}
+    warning_count = 0
+    error_count = 0
+    for entry in entries:
+        totals[entry["status"]] = totals.get(entry["status"], 0) + 1
+        summary = entry.get("summary") or {}
+        warning_count += summary.get("warning_count", len(summary.get("warnings") or []))
+        error_count += summary.get("error_count", len(summary.get("errors") or []))
+    overall = "pass" if entries and totals["pass"] == len(entries) else "fail"
+    return {
+        "overall_status": overall,
+        "totals": totals,
+        "warning_count": warning_count,
+        "error_count": error_count,
+        "wall_seconds": round(wall_seconds, 1),
+        "job_seconds": round(sum(entry["duration_seconds"] for entry in entries), 1),
+        "jobs": entries,
+    }
+
+
+def run_matrix(proxmox, node, args, jobs, artifacts, remote_dir):
+    jobs_by_vm = {}
+    for job in jobs:
+        jobs_by_vm.setdefault(job["vmid"], []).append(job)
+    max_workers = args.max_workers if args.max_workers > 0 else len(jobs_by_vm)
+    print(f"Running {len(jobs)} jobs on {len(jobs_by_vm)} VMs with {max_workers} workers ...")
+
+    entries = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(run_vm_jobs, proxmox, node, args, vm_jobs, artifacts, remote_dir)
+            for vm_jobs in jobs_by_vm.values()
+        ]
+        for future in as_completed(futures):
+            entries.extend(future.result())
+    return entries
+
+
+def run_pooled(proxmox, node, args, arg_sets, artifacts, remote_dir):
+    clone_pool = ClonePool(
+        ProxmoxerRest(proxmox),
+        node,
+        args.pool_template,
+        args.pool_size,
+        snapshot=args.pool_snapshot,
+        ssh_port=args.vm_ssh_port,
+    )
+    clone_pool.start()
+    max_workers = args.max_workers if args.max_workers > 0 else args.pool_size
+    print(f"Running {len(arg_sets)} jobs on clones of VM {args.pool_template} with {max_workers} workers ...")
+
+    entries = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(run_pool_job, clone_pool, args, program_args, artifacts, remote_dir)
+                for program_args in arg_sets
+            ]
+            for future in as_completed(futures):
+                entries.append(future.result())
+    finally:
+        clone_pool.close()
+    return entries
+
+
+def main():
+    args = parse_args()
+    configure_timing(args.timings)
+
+    use_pool = args.pool_template is not None
+    vms, snapshots, arg_sets = load_spec(args.spec, require_vms=not use_pool)
+    artifacts = find_artifacts(args.build_path, args.files)
+    remote_dir = resolve_remote_dir(args)
+
+    proxmox = connect_proxmox(args)
+    node = proxmox.nodes.get()[0]["node"]
+    print(f"Using Proxmox node {node}")
+
+    started = time.time()
+    if use_pool:
+        entries = run_pooled(proxmox, node, args, arg_sets, artifacts, remote_dir)
+    else:
+        jobs = build_jobs(vms, snapshots, arg_sets)
+        entries = run_matrix(proxmox, node, args, jobs, artifacts, remote_dir)
+    entries.sort(key=lambda entry: (entry["vmid"], entry["snapshot"], entry["program_args"]))
+    report = merge_report(entries, time.time() - started)
+
+    print("Matrix Report:")
+    print(json.dumps({key: value for key, value in report.items() if key != "jobs"}, indent=2))
+    for entry in entries:
+        print(f"  vm {entry['vmid']} {entry['snapshot']} {entry['program_args']}: {entry['status']}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, indent=2)
+        print(f"Report written to {args.report}")
+
+    if args.shutdown_vms and not use_pool:
+        upids = []
+        for vmid in sorted({int(vm["vmid"]) for vm in vms}):
+            print(f"Shutting down VM {vmid} ...")
+            upids.append(proxmox.nodes(node).qemu(vmid).status.shutdown.post())
+        with span("shutdown", vmids=len(upids)):
+            wait_for_tasks(ProxmoxerRest(proxmox), node, upids, raise_on_failure=False, show_log=False)
+
+    if report["overall_status"] != "pass":
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,17 @@ import argparse
 import base64
 import os
 import socket
-import threading
 import time
-from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 
 import requests
-import winrm
+
+from artifact_server import DEFAULT_GZIP_CACHE, ArtifactServer
+from proxmox_tasks import TaskWaiter
+from proxmox_tickets import DEFAULT_TICKET_CACHE, TICKET_RENEW_AFTER, TicketCache, needs_renewal
+from proxmox_warm import warm_resume, warm_snapshot_name
+from run_timing import configure as configure_timing, span
+from stage_graph import StageGraph
+from winrm_shell import WinRMPool, WinRMShell
 
 requests.packages.urllib3.disable_warnings()
 
@@ -36,7 +41,23 @@ def parse_args():
     parser.add_argument("--executable", default="PrivacyFirst.exe")
     parser.add_argument("--remote-dir", default=r"C:\PrivacyFirstPipeline")
     parser.add_argument("--http-port", type=int, default=9910)
+    parser.add_argument("--gzip-cache", default=DEFAULT_GZIP_CACHE, help="Directory for gzip variants of the artifacts")
+    parser.add_argument("--no-gzip", action="store_true", help="Serve artifacts uncompressed")
     parser.add_argument("--shutdown-vm", action="store_true")
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="Resume a RAM-state copy of --snapshot (<snapshot>-warm, built on first use) instead of booting",
+    )
+    parser.add_argument("--refresh-warm", action="store_true", help="Rebuild the warm snapshot before using it")
+    parser.add_argument("--timings", help="Append per-phase timing spans to this JSON lines file")
+    parser.add_argument("--ticket-cache", default=DEFAULT_TICKET_CACHE, help="File caching Proxmox auth tickets")
+    parser.add_argument("--no-ticket-cache", action="store_true", help="Always log in with the password")
+    parser.add_argument(
+        "--stream-output",
+        action="store_true",
+        help="Print the remote script's output as WinRM receives it instead of only at the end",
+    )
     return parser.parse_args()
 
 
@@ -51,22 +72,8 @@ def get_local_ip(target_host: str) -> str:
         sock.close()
 
 
-class ArtifactServer(threading.Thread):
-    def __init__(self, directory: str, bind_ip: str, port: int):
-        super().__init__(daemon=True)
-        handler = type('Handler', (SimpleHTTPRequestHandler,), {'directory': directory})
-        self._server = ThreadingHTTPServer((bind_ip, port), handler)
-
-    def run(self):
-        self._server.serve_forever()
-
-    def stop(self):
-        self._server.shutdown()
-        self._server.server_close()
-
-
 class ProxmoxClient:
-    def __init__(self, host: str, user: str, password: str):
+    def __init__(self, host: str, user: str, password: str, tickets: TicketCache = None):
         self.base = f"https://{host}:8006/api2/json"
         self.session = requests.Session()
         self.session.verify = False
@@ -74,49 +81,75 @@ class ProxmoxClient:
         self.password = password
         self.host = host
         self.csrf = None
+        self.tickets = tickets
+        self.issued = None
 
     def login(self):
+        cached = self.tickets.get(self.host, self.user) if self.tickets else None
+        if cached and not needs_renewal(cached):
+            self._apply_ticket(cached["ticket"], cached["csrf"], cached["issued"])
+            return
+        payload = None
+        if cached:
+            # A still-valid ticket can be exchanged for a fresh one without the password.
+            try:
+                payload = self._request_ticket(cached["ticket"])
+            except requests.HTTPError:
+                payload = None
+        if payload is None:
+            payload = self._request_ticket(self.password)
+        issued = time.time()
+        self._apply_ticket(payload["ticket"], payload["CSRFPreventionToken"], issued)
+        if self.tickets:
+            self.tickets.put(self.host, self.user, payload["ticket"], payload["CSRFPreventionToken"], issued)
+
+    def _request_ticket(self, password: str):
         resp = self.session.post(
             f"{self.base}/access/ticket",
-            data={"username": self.user, "password": self.password}
+            data={"username": self.user, "password": password}
         )
         resp.raise_for_status()
-        payload = resp.json()["data"]
-        self.session.cookies.set("PVEAuthCookie", payload["ticket"], domain=self.host, path="/")
-        self.csrf = payload["CSRFPreventionToken"]
+        return resp.json()["data"]
+
+    def _apply_ticket(self, ticket: str, csrf: str, issued: float):
+        self.session.cookies.set("PVEAuthCookie", ticket, domain=self.host, path="/")
+        self.csrf = csrf
+        self.issued = issued
 
     def headers(self):
         return {"CSRFPreventionToken": self.csrf} if self.csrf else {}
 
-    def get(self, path: str, **kwargs):
-        resp = self.session.get(f"{self.base}{path}", headers=self.headers(), **kwargs)
+    def _request(self, method: str, path: str, **kwargs):
+        if self.issued is not None and time.time() - self.issued >= TICKET_RENEW_AFTER:
+            self.login()
+        resp = self.session.request(method, f"{self.base}{path}", headers=self.headers(), **kwargs)
+        if resp.status_code == 401 and self.tickets:
+            # The cached ticket was rejected (e.g. the cluster rotated its keys); log in once more.
+            self.tickets.drop(self.host, self.user)
+            self.login()
+            resp = self.session.request(method, f"{self.base}{path}", headers=self.headers(), **kwargs)
         resp.raise_for_status()
-        return resp.json()["data"]
+        return resp.json()["data"] if resp.content else None
+
+    def get(self, path: str, **kwargs):
+        return self._request("GET", path, **kwargs)
 
     def post(self, path: str, *, json_body=None, data_body=None, params=None):
-        kwargs = {"headers": self.headers()}
+        kwargs = {}
         if json_body is not None:
             kwargs["json"] = json_body
         if data_body is not None:
             kwargs["data"] = data_body
         if params is not None:
             kwargs["params"] = params
-        resp = self.session.post(f"{self.base}{path}", **kwargs)
-        resp.raise_for_status()
-        return resp.json()["data"] if resp.content else None
+        return self._request("POST", path, **kwargs)
+
+    def delete(self, path: str, params=None):
+        return self._request("DELETE", path, params=params)
 
 
 def wait_for_task(client: ProxmoxClient, node: str, upid: str, timeout: int = 600):
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        status = client.get(f"/nodes/{node}/tasks/{upid}/status")
-        if status.get("status") == "stopped":
-            exitstatus = status.get("exitstatus", "OK")
-            if exitstatus != "OK":
-                raise RuntimeError(f"Proxmox task failed: {exitstatus}")
-            return
-        time.sleep(2)
-    raise TimeoutError("Proxmox task timed out")
+    TaskWaiter(client, node).add(upid).wait(timeout=timeout)
 
 
 def ensure_running(client: ProxmoxClient, node: str, vmid: int, timeout: int = 120):
@@ -132,20 +165,23 @@ def ensure_running(client: ProxmoxClient, node: str, vmid: int, timeout: int = 1
     raise TimeoutError("VM failed to reach running state")
 
 
-def wait_for_winrm(ip: str, user: str, password: str, timeout: int = 120):
-    endpoint = f"http://{ip}:5985/wsman"
+def wait_for_winrm(ip: str, user: str, password: str, timeout: int = 120, pool: WinRMPool = None) -> WinRMShell:
+    """Open a WinRM shell that answers a heartbeat; the caller keeps it for the real work."""
     deadline = time.time() + timeout
     last_err = None
     while time.time() < deadline:
+        shell = pool.acquire(ip) if pool is not None else WinRMShell(ip, user, password)
         try:
-            session = winrm.Session(endpoint, auth=(user, password), transport='ntlm')
-            # light heartbeat command
-            result = session.run_cmd('cmd', ['/c', 'echo ok'])
-            if result.status_code == 0:
-                return session
+            if shell.heartbeat():
+                return shell
+            last_err = "heartbeat failed"
         except Exception as exc:  # noqa: BLE001
             last_err = exc
-            time.sleep(3)
+        if pool is not None:
+            pool.release(shell, discard=True)
+        else:
+            shell.close()
+        time.sleep(3)
     raise RuntimeError(f"WinRM not ready: {last_err}")
 
 
@@ -157,9 +193,70 @@ $dest = '{remote_dir}'
 if (-not (Test-Path $dest)) {{ New-Item -ItemType Directory -Path $dest -Force | Out-Null }}
 $files = @({file_list})
 $baseUrl = 'http://{host}:{port}'
+[System.Net.ServicePointManager]::DefaultConnectionLimit = 4
+function Get-Artifact([string]$name) {{
+    # HttpWebRequest keeps the connection to the artifact server alive between files, sends the
+    # SHA-256 of any copy already on disk as If-None-Match and resumes a .part file with a Range.
+    $target = Join-Path $dest $name
+    $partial = "$target.part"
+    $request = [System.Net.HttpWebRequest]::Create("$baseUrl/$name")
+    $request.KeepAlive = $true
+    $request.AutomaticDecompression = [System.Net.DecompressionMethods]::GZip
+    if (Test-Path -LiteralPath $target) {{
+        $hash = (Get-FileHash -LiteralPath $target -Algorithm SHA256).Hash.ToLowerInvariant()
+        $request.Headers.Add('If-None-Match', '"' + $hash + '"')
+    }}
+    $offset = 0
+    if ((Test-Path -LiteralPath $partial) -and (Test-Path -LiteralPath "$partial.etag")) {{
+        $offset = (Get-Item -LiteralPath $partial).Length
+        $request.AddRange([long]$offset)
+        $request.Headers.Add('If-Range', (Get-Content -LiteralPath "$partial.etag" -Raw).Trim())
+    }}
+    try {{
+        $response = $request.GetResponse()
+    }} catch {{
+        $webError = $_.Exception
+        while ($webError -and -not ($webError -is [System.Net.WebException])) {{ $webError = $webError.InnerException }}
+        if (-not $webError -or -not $webError.Response) {{ throw }}
+        $response = $webError.Response
+    }}
+    try {{
+        $status = [int]$response.StatusCode
+        if ($status -eq 304) {{ return 'unchanged' }}
+        if ($status -eq 416) {{
+            Remove-Item -LiteralPath $partial, "$partial.etag" -Force -ErrorAction SilentlyContinue
+            throw "Range not satisfiable for $name"
+        }}
+        if ($status -ne 200 -and $status -ne 206) {{ throw "HTTP $status for $name" }}
+        $expected = $response.Headers['ETag'].Trim('"') -replace '-gzip$', ''
+        $mode = if ($status -eq 206) {{ [System.IO.FileMode]::Append }} else {{ [System.IO.FileMode]::Create }}
+        # Remember the uncompressed file's ETag so an interrupted download resumes with If-Range.
+        if ($status -eq 200) {{ Set-Content -LiteralPath "$partial.etag" -Value ('"' + $expected + '"') -NoNewline }}
+        $stream = [System.IO.File]::Open($partial, $mode, [System.IO.FileAccess]::Write)
+        try {{ $response.GetResponseStream().CopyTo($stream, 1048576) }} finally {{ $stream.Close() }}
+    }} finally {{
+        $response.Close()
+    }}
+    $actual = (Get-FileHash -LiteralPath $partial -Algorithm SHA256).Hash.ToLowerInvariant()
+    if ($actual -ne $expected) {{
+        Remove-Item -LiteralPath $partial, "$partial.etag" -Force -ErrorAction SilentlyContinue
+        throw "Checksum mismatch for $name"
+    }}
+    Move-Item -LiteralPath $partial -Destination $target -Force
+    Remove-Item -LiteralPath "$partial.etag" -Force -ErrorAction SilentlyContinue
+    if ($status -eq 206) {{ return 'resumed' }} else {{ return 'downloaded' }}
+}}
+$transfers = [ordered]@{{}}
 foreach ($file in $files) {{
-    $source = "$baseUrl/$file"
-    Invoke-WebRequest -Uri $source -OutFile (Join-Path $dest $file) -UseBasicParsing -ErrorAction Stop
+    for ($attempt = 1; ; $attempt++) {{
+        try {{
+            $transfers[$file] = Get-Artifact $file
+            break
+        }} catch {{
+            if ($attempt -ge 3) {{ throw }}
+            Start-Sleep -Seconds $attempt
+        }}
+    }}
 }}
 $exePath = Join-Path $dest '{executable}'
 if (-not (Test-Path $exePath)) {{ throw "Executable not found: $exePath" }}
@@ -172,64 +269,147 @@ $result = [PSCustomObject]@{{
     ExitCode = $proc.ExitCode
     StdOut = if (Test-Path $stdout) {{ Get-Content $stdout -Raw }} else ''
     StdErr = if (Test-Path $stderr) {{ Get-Content $stderr -Raw }} else ''
+    Transfers = $transfers
 }}
 $result | ConvertTo-Json -Depth 5
 """
     return template.format(host=host_ip, port=port, remote_dir=remote_dir, file_list=file_list, executable=executable)
 
 
-def main():
-    args = parse_args()
-
-    if not os.path.isdir(args.build_path):
-        raise FileNotFoundError(f"Build path not found: {args.build_path}")
-
-    artifacts = [f for f in args.files if os.path.isfile(os.path.join(args.build_path, f))]
+def find_artifacts(build_path: str, files):
+    if not os.path.isdir(build_path):
+        raise FileNotFoundError(f"Build path not found: {build_path}")
+    artifacts = [f for f in files if os.path.isfile(os.path.join(build_path, f))]
     if not artifacts:
         raise FileNotFoundError("No artifacts from the list were found in the build directory")
+    return artifacts
+
+
+def start_artifact_server(args, artifacts, host_ip: str) -> ArtifactServer:
+    print(f"Serving artifacts from {host_ip}:{args.http_port}")
+    server = ArtifactServer(
+        args.build_path,
+        host_ip,
+        args.http_port,
+        gzip_dir=None if args.no_gzip else args.gzip_cache,
+    )
+    print(f"Artifacts hashed and compressed in {server.precompress(artifacts):.1f}s")
+    server.start()
+    return server
 
-    client = ProxmoxClient(args.proxmox_host, args.proxmox_user, args.proxmox_password)
-    client.login()
 
+def timed_login(client: ProxmoxClient):
+    with span("login", host=client.host):
+        client.login()
+
+
+def lookup_node(client: ProxmoxClient) -> str:
     node = client.get("/nodes")[0]["node"]
     print(f"Using Proxmox node {node}")
+    return node
+
+
+def prepare_vm(client: ProxmoxClient, node: str, args):
+    if args.warm:
+        print(f"Resuming {warm_snapshot_name(args.snapshot)}...")
+        with span("rollback", vmid=args.vmid, warm=True):
+            seconds = warm_resume(
+                client,
+                node,
+                args.vmid,
+                args.snapshot,
+                # The guest is rolled back after this check, so its shell is not kept.
+                wait_ready=lambda: wait_for_winrm(args.vm_ip, args.vm_user, args.vm_password, timeout=600).close(),
+                refresh=args.refresh_warm,
+            )
+        print(f"VM resumed in {seconds:.1f}s")
+    else:
+        print("Rolling back snapshot...")
+        with span("rollback", vmid=args.vmid):
+            upid = client.post(f"/nodes/{node}/qemu/{args.vmid}/snapshot/{args.snapshot}/rollback")
+            wait_for_task(client, node, upid)
+        print("Snapshot rollback complete")
+
+        print("Ensuring VM is running...")
+        with span("vm_start", vmid=args.vmid):
+            ensure_running(client, node, args.vmid)
+
+
+def connect_winrm(args, pool: WinRMPool) -> WinRMShell:
+    print("Waiting for WinRM...")
+    with span("transport", host=args.vm_ip, kind="winrm"):
+        shell = wait_for_winrm(args.vm_ip, args.vm_user, args.vm_password, pool=pool)
+    print("WinRM shell ready")
+    return shell
 
-    print("Rolling back snapshot...")
-    upid = client.post(f"/nodes/{node}/qemu/{args.vmid}/snapshot/{args.snapshot}/rollback")
-    wait_for_task(client, node, upid)
-    print("Snapshot rollback complete")
 
-    print("Ensuring VM is running...")
-    ensure_running(client, node, args.vmid)
-    print("Waiting for WinRM...")
-    session = wait_for_winrm(args.vm_ip, args.vm_user, args.vm_password)
-    print("WinRM session ready")
+def print_stream_line(stream_name, line):
+    print(line if stream_name == "stdout" else f"[stderr] {line}", flush=True)
 
-    host_ip = get_local_ip(args.proxmox_host)
-    print(f"Serving artifacts from {host_ip}:{args.http_port}")
-    server = ArtifactServer(args.build_path, host_ip, args.http_port)
-    server.start()
-    time.sleep(1)
 
-    script = build_powershell(host_ip, args.http_port, args.remote_dir, artifacts, args.executable)
+def run_script(shell: WinRMShell, script: str, stream: bool = False):
+    # The guest downloads the artifacts inside the same script, so upload is part of this span.
+    # It runs in the shell the heartbeat opened, so no new shell or NTLM handshake is needed.
+    with span("execute", includes_upload=True):
+        return shell.run_ps(script, on_line=print_stream_line if stream else None)
+
 
+def main():
+    args = parse_args()
+    timing = configure_timing(args.timings)
+
+    tickets = None if args.no_ticket_cache else TicketCache(args.ticket_cache)
+    client = ProxmoxClient(args.proxmox_host, args.proxmox_user, args.proxmox_password, tickets=tickets)
+
+    # Artifact hashing, gzip variants and the HTTP server are ready long before the VM is.
+    graph = StageGraph()
+    graph.add("artifacts", lambda: find_artifacts(args.build_path, args.files))
+    graph.add("host_ip", lambda: get_local_ip(args.proxmox_host))
+    graph.add(
+        "server",
+        lambda artifacts, host_ip: start_artifact_server(args, artifacts, host_ip),
+        deps=["artifacts", "host_ip"],
+    )
+    graph.add(
+        "script",
+        lambda artifacts, host_ip: build_powershell(host_ip, args.http_port, args.remote_dir, artifacts, args.executable),
+        deps=["artifacts", "host_ip"],
+    )
+    graph.add("login", lambda: timed_login(client))
+    graph.add("node", lambda _: lookup_node(client), deps=["login"])
+    graph.add("vm", lambda node: prepare_vm(client, node, args), deps=["node"])
+    pool = WinRMPool(args.vm_user, args.vm_password, size=1)
+    graph.add("winrm", lambda _: connect_winrm(args, pool), deps=["vm"])
+    graph.add(
+        "run",
+        lambda shell, script, _: run_script(shell, script, stream=args.stream_output),
+        deps=["winrm", "script", "server"],
+    )
     try:
-        result = session.run_ps(script)
+        graph.run()
     finally:
-        server.stop()
+        if graph.results.get("server") is not None:
+            graph.results["server"].stop()
+        if graph.results.get("winrm") is not None:
+            pool.release(graph.results["winrm"])
+        pool.close()
+        graph.report()
+    node, result = graph.results["node"], graph.results["run"]
 
     stdout = result.std_out.decode(errors='ignore') if isinstance(result.std_out, bytes) else str(result.std_out)
     stderr = result.std_err.decode(errors='ignore') if isinstance(result.std_err, bytes) else str(result.std_err)
     exit_code = result.status_code
 
     print("Exit code:", exit_code)
-    print("STDOUT:\n" + stdout)
+    print("STDOUT:\n" + ("(streamed above)" if args.stream_output else stdout))
     print("STDERR:\n" + stderr)
 
 
     if args.shutdown_vm:
-        client.post(f"/nodes/{node}/qemu/{args.vmid}/status/shutdown")
+        with span("shutdown", vmid=args.vmid):
+            client.post(f"/nodes/{node}/qemu/{args.vmid}/status/shutdown")
         print("Shutdown requested")
+    timing.print_summary()
 
 
 if __name__ == '__main__':
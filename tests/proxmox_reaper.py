@@ -0,0 +1,328 @@
+import argparse
+import heapq
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import proxmoxer
+
+from proxmox_rest import ProxmoxerRest
+from proxmox_tasks import TaskWaiter
+from ssh_broker import parse_address, recv_line, send_line
+
+DEFAULT_REAPER_ADDRESS = "127.0.0.1:8723"
+DEFAULT_REAPER_LOG = os.path.join(os.path.expanduser("~"), ".privacyfirst", "reaper.log")
+# "stop" and "rollback" are disposable: the guest gets no graceful shutdown, which is
+# fine whenever the next run rolls the VM back anyway.
+TEARDOWN_ACTIONS = ("shutdown", "stop", "rollback")
+SHUTDOWN_TIMEOUT = 180
+SPAWN_TIMEOUT = 10.0
+# A cancel that finds the teardown already running waits this long for it to finish.
+CANCEL_WAIT = SHUTDOWN_TIMEOUT + 60
+
+
+def post_teardown(client, node, vmid, action, snapshot=None, shutdown_timeout=SHUTDOWN_TIMEOUT):
+    """Start a shutdown, stop or rollback of ``vmid``; returns the task UPID, or None if already stopped.
+
+    ``client`` is path-based like ProxmoxClient (see ``ProxmoxerRest``). A graceful
+    shutdown that does not finish within ``shutdown_timeout`` is turned into a stop by PVE.
+    """
+    base = f"/nodes/{node}/qemu/{vmid}"
+    if action == "rollback":
+        if not snapshot:
+            raise ValueError("Rollback teardown needs a snapshot")
+        return client.post(f"{base}/snapshot/{snapshot}/rollback")
+    if client.get(f"{base}/status/current").get("status") != "running":
+        return None
+    if action == "shutdown":
+        return client.post(
+            f"{base}/status/shutdown",
+            data_body={"timeout": shutdown_timeout, "forceStop": 1},
+        )
+    if action == "stop":
+        return client.post(f"{base}/status/stop")
+    raise ValueError(f"Unknown teardown action: {action}")
+
+
+def run_teardown(client, node, vmid, action, snapshot=None, shutdown_timeout=SHUTDOWN_TIMEOUT):
+    """Like ``post_teardown`` but wait for the task; returns the final task state."""
+    upid = post_teardown(client, node, vmid, action, snapshot, shutdown_timeout)
+    if upid is None:
+        return "already stopped"
+    results = TaskWaiter(client, node, show_log=False).add(upid).wait(
+        timeout=shutdown_timeout + 60, raise_on_failure=False
+    )
+    return results[upid]["exitstatus"]
+
+
+class Reaper(threading.Thread):
+    """Run scheduled teardowns when they fall due; at most one pending teardown per VM.
+
+    Credentials only live in memory. A new schedule for a VM replaces the pending
+    one, and ``cancel`` drops it, so a VM that is reused before its teardown is due
+    is left alone. A teardown that has already started cannot be called back; ``cancel``
+    waits for it to finish so the caller never races it.
+    """
+
+    def __init__(self, workers=4, idle_exit=0):
+        super().__init__(daemon=True)
+        self.idle_exit = idle_exit
+        self._cond = threading.Condition()
+        self._heap = []
+        self._pending = {}
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._active = {}
+        self._deferred = {}
+        self._last_activity = time.time()
+        self.idle = threading.Event()
+
+    def schedule(self, request):
+        job = {
+            "host": request["host"],
+            "user": request["user"],
+            "password": request["password"],
+            "node": request["node"],
+            "vmid": int(request["vmid"]),
+            "action": request.get("action", "shutdown"),
+            "snapshot": request.get("snapshot"),
+            "due": time.time() + max(0.0, float(request.get("delay", 0))),
+        }
+        if job["action"] not in TEARDOWN_ACTIONS:
+            raise ValueError(f"Unknown teardown action: {job['action']}")
+        key = (job["host"], job["vmid"])
+        with self._cond:
+            replaced = key in self._pending
+            self._pending[key] = job
+            heapq.heappush(self._heap, (job["due"], id(job), job))
+            self._last_activity = time.time()
+            self._cond.notify()
+        note = " (replaces the pending one)" if replaced else ""
+        print(f"[reaper] {job['action']} of VM {job['vmid']} due in {job['due'] - time.time():.0f}s{note}", flush=True)
+        return job["due"]
+
+    def cancel(self, host, vmid, wait=CANCEL_WAIT):
+        """Drop the pending teardown of ``vmid``; True if one was pending.
+
+        When its teardown is already running, wait up to ``wait`` seconds for it to end and
+        raise TimeoutError if it does not.
+        """
+        key = (host, int(vmid))
+        deadline = time.time() + wait
+        with self._cond:
+            job = self._pending.pop(key, None)
+            running = self._active.get(key)
+            if running is not None:
+                print(f"[reaper] {running['action']} of VM {vmid} is running; waiting for it", flush=True)
+            while key in self._active:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"{running['action']} of VM {vmid} still running after {wait:.0f}s")
+                self._cond.wait(remaining)
+            self._last_activity = time.time()
+        if job is not None:
+            print(f"[reaper] Cancelled {job['action']} of VM {vmid}", flush=True)
+        return job is not None
+
+    def pending(self):
+        with self._cond:
+            jobs = sorted(self._pending.values(), key=lambda item: item["due"])
+        return [
+            {"host": job["host"], "vmid": job["vmid"], "action": job["action"], "due_in": round(job["due"] - time.time(), 1)}
+            for job in jobs
+        ]
+
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    # Drop heap entries that were replaced or cancelled.
+                    while self._heap and not self._is_pending(self._heap[0][2]):
+                        heapq.heappop(self._heap)
+                    if self._heap and self._heap[0][0] <= now:
+                        job = heapq.heappop(self._heap)[2]
+                        key = (job["host"], job["vmid"])
+                        if key in self._active:
+                            # The previous teardown of this VM is still going; this one follows it.
+                            self._deferred[key] = job
+                            continue
+                        del self._pending[key]
+                        self._active[key] = job
+                        break
+                    if self.idle_exit and not self._pending and not self._active and now - self._last_activity >= self.idle_exit:
+                        self.idle.set()
+                        return
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    if self.idle_exit and (timeout is None or timeout > self.idle_exit):
+                        timeout = self.idle_exit
+                    self._cond.wait(timeout)
+            self._pool.submit(self._execute, job)
+
+    def _is_pending(self, job) -> bool:
+        return self._pending.get((job["host"], job["vmid"])) is job
+
+    def _client(self, job, fresh=False):
+        key = (job["host"], job["user"])
+        with self._clients_lock:
+            client = self._clients.get(key)
+            if client is None or fresh:
+                client = ProxmoxerRest(
+                    proxmoxer.ProxmoxAPI(job["host"], user=job["user"], password=job["password"], verify_ssl=False)
+                )
+                self._clients[key] = client
+            return client
+
+    def _execute(self, job):
+        started = time.time()
+        try:
+            try:
+                state = run_teardown(self._client(job), job["node"], job["vmid"], job["action"], job["snapshot"])
+            except proxmoxer.AuthenticationError:
+                state = run_teardown(self._client(job, fresh=True), job["node"], job["vmid"], job["action"], job["snapshot"])
+            print(f"[reaper] {job['action']} of VM {job['vmid']}: {state} ({time.time() - started:.1f}s)", flush=True)
+        except Exception as exc:  # noqa: BLE001
+            print(f"[reaper] {job['action']} of VM {job['vmid']} failed: {exc}", flush=True)
+        finally:
+            with self._cond:
+                key = (job["host"], job["vmid"])
+                del self._active[key]
+                deferred = self._deferred.pop(key, None)
+                if deferred is not None:
+                    heapq.heappush(self._heap, (deferred["due"], id(deferred), deferred))
+                self._last_activity = time.time()
+                self._cond.notify_all()
+
+
+class _ReaperHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        try:
+            request = recv_line(sock)
+            op = request.get("op")
+            if op == "schedule":
+                reply = {"ok": True, "due": self.server.reaper.schedule(request)}
+            elif op == "cancel":
+                reply = {"ok": True, "cancelled": self.server.reaper.cancel(request["host"], request["vmid"])}
+            elif op == "list":
+                reply = {"ok": True, "pending": self.server.reaper.pending()}
+            else:
+                raise ValueError(f"Unknown reaper request: {op}")
+        except Exception as exc:  # noqa: BLE001
+            reply = {"ok": False, "error": f"{type(exc).__name__}: {exc}"}
+        try:
+            send_line(sock, reply)
+        except OSError:
+            pass
+
+
+class ReaperServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers=4, idle_exit=0):
+        super().__init__(address, _ReaperHandler)
+        self.reaper = Reaper(workers=workers, idle_exit=idle_exit)
+        self.reaper.start()
+
+
+# ---------------- runner side ----------------
+def reaper_request(address, payload, timeout=10):
+    sock = socket.create_connection(parse_address(address), timeout=timeout)
+    try:
+        send_line(sock, payload)
+        reply = recv_line(sock)
+    finally:
+        sock.close()
+    if not reply.get("ok"):
+        raise RuntimeError(f"Reaper request failed: {reply.get('error')}")
+    return reply
+
+
+def spawn_reaper(address, log_path=DEFAULT_REAPER_LOG, idle_exit=600):
+    """Start a detached reaper that outlives this process and exits once idle."""
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    command = [sys.executable, os.path.abspath(__file__), "--listen", address, "--idle-exit", str(idle_exit)]
+    kwargs = {"start_new_session": True}
+    if os.name == "nt":
+        kwargs = {"creationflags": subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+    with open(log_path, "a", encoding="utf-8") as log:
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=log, close_fds=True, **kwargs)
+
+
+def schedule_teardown(address, host, user, password, node, vmid, action, delay, snapshot=None, spawn=True):
+    """Hand a delayed teardown to the reaper at ``address``, starting one if none is listening."""
+    payload = {
+        "op": "schedule",
+        "host": host,
+        "user": user,
+        "password": password,
+        "node": node,
+        "vmid": vmid,
+        "action": action,
+        "delay": delay,
+        "snapshot": snapshot,
+    }
+    try:
+        return reaper_request(address, payload)
+    except ConnectionRefusedError:
+        if not spawn:
+            raise
+    spawn_reaper(address)
+    deadline = time.time() + SPAWN_TIMEOUT
+    while True:
+        try:
+            return reaper_request(address, payload)
+        except ConnectionRefusedError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.2)
+
+
+def cancel_teardown(address, host, vmid) -> bool:
+    """Drop a pending teardown for ``vmid``; False when there was none or no reaper is running.
+
+    Returns only once a teardown of ``vmid`` that was already running has finished.
+    """
+    try:
+        return reaper_request(address, {"op": "cancel", "host": host, "vmid": vmid}, timeout=CANCEL_WAIT + 10)["cancelled"]
+    except ConnectionRefusedError:
+        return False
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Carry out delayed VM shutdown, stop or rollback for the runners")
+    parser.add_argument("--listen", default=DEFAULT_REAPER_ADDRESS, help="host:port to accept teardown requests on")
+    parser.add_argument("--workers", type=int, default=4, help="Teardowns carried out concurrently")
+    parser.add_argument("--idle-exit", type=int, default=0, help="Exit after this many idle seconds (0 = never)")
+    parser.add_argument("--list", action="store_true", help="Print the pending teardowns of a running reaper and exit")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.list:
+        for job in reaper_request(args.listen, {"op": "list"})["pending"]:
+            print(f"  VM {job['vmid']} on {job['host']}: {job['action']} in {job['due_in']:.0f}s")
+        return
+    server = ReaperServer(parse_address(args.listen), workers=args.workers, idle_exit=args.idle_exit)
+    print(f"Reaper listening on {args.listen}", flush=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        server.reaper.idle.wait()
+        print("Reaper idle, exiting", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
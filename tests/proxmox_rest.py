@@ -0,0 +1,21 @@
+class ProxmoxerRest:
+    """Expose a proxmoxer API through the path-based get/post/delete calls of ProxmoxClient."""
+
+    def __init__(self, proxmox):
+        self.proxmox = proxmox
+
+    def _resource(self, path: str):
+        return self.proxmox(path.strip("/"))
+
+    def get(self, path: str, params=None):
+        return self._resource(path).get(**(params or {}))
+
+    def post(self, path: str, *, json_body=None, data_body=None, params=None):
+        payload = {}
+        for part in (params, data_body, json_body):
+            if part:
+                payload.update(part)
+        return self._resource(path).post(**payload)
+
+    def delete(self, path: str, params=None):
+        return self._resource(path).delete(**(params or {}))
@@ -0,0 +1,855 @@
+import argparse
+import base64
+import datetime
+import hashlib
+import io
+import ipaddress
+import json
+import os
+import random
+import re
+import secrets
+import ssl
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+DEFAULT_NODE = "pve-sim"
+DEFAULT_PASSWORD = "sim"
+# Seconds before --time-scale; "boot" is the time from status/start until SSH and the agent answer,
+# "powershell" the interpreter start every powershell.exe launched over SSH pays.
+DEFAULT_LATENCIES = {
+    "http": 0.005,
+    "login": 0.05,
+    "rollback": 2.0,
+    "start": 1.0,
+    "boot": 20.0,
+    "resume": 1.0,
+    "shutdown": 4.0,
+    "stop": 1.0,
+    "snapshot": 3.0,
+    "delete": 1.0,
+    "clone": 5.0,
+    "exec": 2.0,
+    "powershell": 1.0,
+    "ssh_auth": 0.2,
+}
+# Injection points for --fail: "http" (500 on any API call), "task" or "task:<type>"
+# (task ends with an error), "agent" (agent calls fail), "ssh_auth", "ssh_drop"
+# (connection closed mid-command) and "exec" (program reports failures).
+FAILURE_POINTS = ("http", "task", "agent", "ssh_auth", "ssh_drop", "exec")
+DEFAULT_PROGRAM_OUTPUT = [
+    "[INFO] PrivacyFirst simulated run on VM {vmid}",
+    "[INFO] Applying 12 operations",
+    "[WARN] Simulated warning from VM {vmid}",
+    "Execution complete: 12 succeeded, 0 failed",
+]
+FAILED_PROGRAM_OUTPUT = [
+    "[INFO] PrivacyFirst simulated run on VM {vmid}",
+    "[ERROR] Injected failure on VM {vmid}",
+    "Execution complete: 11 succeeded, 1 failed",
+]
+
+
+class SimConfig:
+    def __init__(self, latencies=None, failures=None, time_scale=1.0, jitter=0.2, password=DEFAULT_PASSWORD, seed=None):
+        self.latencies = dict(DEFAULT_LATENCIES)
+        self.latencies.update(latencies or {})
+        self.failures = dict(failures or {})
+        self.time_scale = time_scale
+        self.jitter = jitter
+        self.password = password
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def latency(self, name: str) -> float:
+        base = self.latencies.get(name, 0.0) * self.time_scale
+        with self._lock:
+            return max(0.0, base * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def fails(self, name: str, detail=None) -> bool:
+        probability = self.failures.get(f"{name}:{detail}", self.failures.get(name, 0.0)) if detail else self.failures.get(name, 0.0)
+        if probability <= 0:
+            return False
+        with self._lock:
+            return self.random.random() < probability
+
+
+def windows_key(path: str) -> str:
+    """Case-insensitive key for a guest path given as C:\\a\\b, C:/a/b or SFTP's /C:/a/b."""
+    normalized = path.replace("/", "\\").lstrip("\\")
+    parts = [part for part in normalized.split("\\") if part and part != "."]
+    resolved = []
+    for part in parts:
+        if part == "..":
+            if len(resolved) > 1:
+                resolved.pop()
+        else:
+            resolved.append(part)
+    return "\\".join(resolved).lower()
+
+
+class SimVM:
+    """One simulated guest: power state, snapshots and an in-memory Windows file system."""
+
+    def __init__(self, vmid: int, name: str, ip: str, template: bool = False):
+        self.vmid = vmid
+        self.name = name
+        self.ip = ip
+        self.template = template
+        self.status = "stopped"
+        self.qmpstatus = "stopped"
+        self.ready_at = None
+        self.snapshots = {}
+        self.files = {}
+        self.dirs = {"c:", "c:\\users"}
+        self.agent_procs = {}
+        self.next_pid = 1000
+        self.lock = threading.RLock()
+        self.sessions = set()
+
+    def guest_ready(self) -> bool:
+        return self.status == "running" and self.ready_at is not None and time.time() >= self.ready_at
+
+    # ---------------- file system ----------------
+    def write_file(self, path: str, data: bytes):
+        key = windows_key(path)
+        with self.lock:
+            self.files[key] = bytes(data)
+            parent = key.rsplit("\\", 1)[0]
+            while parent and parent not in self.dirs:
+                self.dirs.add(parent)
+                parent = parent.rsplit("\\", 1)[0] if "\\" in parent else ""
+
+    def make_dir(self, path: str):
+        self.write_dir(windows_key(path))
+
+    def write_dir(self, key: str):
+        with self.lock:
+            while key and key not in self.dirs:
+                self.dirs.add(key)
+                key = key.rsplit("\\", 1)[0] if "\\" in key else ""
+
+    def remove_tree(self, path: str):
+        key = windows_key(path)
+        with self.lock:
+            for name in [name for name in self.files if name == key or name.startswith(key + "\\")]:
+                del self.files[name]
+            self.dirs = {name for name in self.dirs if name != key and not name.startswith(key + "\\")}
+
+    # ---------------- power and snapshots ----------------
+    def drop_sessions(self):
+        # Anything connected to the previous guest state is gone after a rollback or power-off.
+        with self.lock:
+            sessions, self.sessions = list(self.sessions), set()
+        for transport in sessions:
+            try:
+                transport.close()
+            except Exception:  # noqa: BLE001
+                pass
+
+    def power_off(self):
+        with self.lock:
+            self.status = "stopped"
+            self.qmpstatus = "stopped"
+            self.ready_at = None
+            self.agent_procs.clear()
+        self.drop_sessions()
+
+    def power_on(self, boot_seconds: float):
+        with self.lock:
+            if self.status != "running":
+                self.status = "running"
+                self.qmpstatus = "running"
+                self.ready_at = time.time() + boot_seconds
+
+    def take_snapshot(self, name: str, vmstate: bool, description: str = ""):
+        with self.lock:
+            self.snapshots[name] = {
+                "name": name,
+                "snaptime": int(time.time()),
+                "vmstate": 1 if vmstate and self.status == "running" else 0,
+                "description": description,
+                "files": dict(self.files),
+                "dirs": set(self.dirs),
+            }
+
+    def rollback(self, name: str, resume_seconds: float):
+        with self.lock:
+            snapshot = self.snapshots[name]
+            self.files = dict(snapshot["files"])
+            self.dirs = set(snapshot["dirs"])
+        self.power_off()
+        if snapshot["vmstate"]:
+            self.power_on(0.0)
+            with self.lock:
+                self.ready_at = time.time() + resume_seconds
+
+    def snapshot_list(self):
+        with self.lock:
+            entries = [
+                {key: value for key, value in snapshot.items() if key not in ("files", "dirs")}
+                for snapshot in self.snapshots.values()
+            ]
+        entries.append({"name": "current", "description": "You are here!", "running": int(self.status == "running")})
+        return entries
+
+
+class SimTask:
+    def __init__(self, upid: str, kind: str, duration: float, effect, fail: bool):
+        self.upid = upid
+        self.kind = kind
+        self.started = time.time()
+        self.duration = duration
+        self.fail = fail
+        self.lines = [f"starting task {kind}"]
+        self.exitstatus = None
+        self._timer = threading.Timer(duration, self._finish, args=(effect,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _finish(self, effect):
+        try:
+            if self.fail:
+                raise RuntimeError("injected failure")
+            if effect is not None:
+                effect()
+            self.lines.append("TASK OK")
+            self.exitstatus = "OK"
+        except Exception as exc:  # noqa: BLE001
+            self.lines.append(f"TASK ERROR: {exc}")
+            self.exitstatus = str(exc)
+
+    def status(self):
+        if self.exitstatus is None:
+            return {"status": "running", "upid": self.upid, "type": self.kind}
+        return {"status": "stopped", "exitstatus": self.exitstatus, "upid": self.upid, "type": self.kind}
+
+
+class SimCluster:
+    """Proxmox state shared by the HTTP API and the SSH simulator."""
+
+    def __init__(self, config: SimConfig, node: str = DEFAULT_NODE, ip_base: str = "127.1.0.1"):
+        self.config = config
+        self.node = node
+        self.vms = {}
+        self.tasks = {}
+        self.tickets = {}
+        self.reserved = set()
+        self.lock = threading.Lock()
+        self._next_ip = ipaddress.ip_address(ip_base)
+        self._pid = 0x1000
+        self.vm_added = []
+
+    def allocate_ip(self) -> str:
+        with self.lock:
+            ip = str(self._next_ip)
+            self._next_ip += 1
+            return ip
+
+    def add_vm(self, vmid: int, name=None, template=False, snapshot="baseline", running=False) -> SimVM:
+        vm = SimVM(vmid, name or f"sim-{vmid}", self.allocate_ip(), template=template)
+        if running:
+            vm.power_on(0.0)
+        if snapshot:
+            vm.take_snapshot(snapshot, vmstate=False, description="simulated baseline")
+        with self.lock:
+            self.vms[vmid] = vm
+        for callback in self.vm_added:
+            callback(vm)
+        return vm
+
+    def vm(self, vmid) -> SimVM:
+        vm = self.vms.get(int(vmid))
+        if vm is None:
+            raise LookupError(f"Configuration file 'nodes/{self.node}/qemu-server/{vmid}.conf' does not exist")
+        return vm
+
+    def vm_by_ip(self, ip: str):
+        for vm in list(self.vms.values()):
+            if vm.ip == ip:
+                return vm
+        return None
+
+    def next_vmid(self) -> int:
+        with self.lock:
+            return max(list(self.vms) + list(self.reserved) + [99]) + 1
+
+    def start_task(self, kind: str, vmid, latency_name: str, effect, user="root@pam") -> str:
+        with self.lock:
+            self._pid += 1
+            pid = self._pid
+        now = int(time.time())
+        upid = f"UPID:{self.node}:{pid:08X}:{pid * 7:08X}:{now:08X}:{kind}:{vmid}:{user}:"
+        fail = self.config.fails("task", kind)
+        self.tasks[upid] = SimTask(upid, kind, self.config.latency(latency_name), effect, fail)
+        return upid
+
+    # ---------------- auth ----------------
+    def issue_ticket(self, username: str, password: str):
+        known = self.tickets.get(password)
+        if password != self.config.password and (known is None or known["user"] != username):
+            return None
+        ticket = f"PVE:{username}:{int(time.time()):08X}::{secrets.token_hex(16)}"
+        csrf = f"{int(time.time()):08X}:{secrets.token_hex(12)}"
+        self.tickets[ticket] = {"user": username, "csrf": csrf, "issued": time.time()}
+        return {"ticket": ticket, "CSRFPreventionToken": csrf, "username": username}
+
+    def check_ticket(self, ticket: str, csrf, write: bool) -> bool:
+        entry = self.tickets.get(ticket or "")
+        if entry is None or time.time() - entry["issued"] > 7200:
+            return False
+        return not write or csrf == entry["csrf"]
+
+
+# ---------------- guest emulation ----------------
+ENCODED_COMMAND_RE = re.compile(r"-EncodedCommand\s+(\S+)", re.IGNORECASE)
+DEST_RE = re.compile(r"^\$dest = '([^']*)'", re.MULTILINE)
+BUNDLE_RE = re.compile(r"^\$bundle = '([^']*)'", re.MULTILINE)
+MANIFEST_NAMES_RE = re.compile(r"foreach \(\$name in @\((.*)\)\)")
+ASSEMBLE_MANIFEST_RE = re.compile(r"\$manifest = @\(Get-Content -Raw -LiteralPath \(Join-Path \$partsDir '([^']*)'\)")
+STREAM_FLAG_RE = re.compile(r"if \((\$true|\$false)\) \{\s*\[Console\]::Out\.WriteLine\('R\|'")
+DETACH_FLAG_RE = re.compile(r"if \(\$true\) \{\s*\$waitSeconds")
+EXE_PATH_RE = re.compile(r"^\$exePath = Join-Path \$dest '([^']*)'", re.MULTILINE)
+
+
+def decode_powershell(command_line: str) -> str:
+    match = ENCODED_COMMAND_RE.search(command_line)
+    if not match:
+        return command_line
+    return base64.b64decode(match.group(1)).decode("utf-16le", errors="ignore")
+
+
+class GuestResult:
+    def __init__(self, exitcode=0, stdout_lines=None, stderr="", line_delay=0.0):
+        self.exitcode = exitcode
+        self.stdout_lines = stdout_lines or []
+        self.stderr = stderr
+        self.line_delay = line_delay
+
+    @property
+    def stdout(self) -> str:
+        return "".join(line + "\n" for line in self.stdout_lines)
+
+
+def emulate_powershell(vm: SimVM, config: SimConfig, script: str, user: str = "user") -> GuestResult:
+    """Answer the scripts the runners send with what a Windows guest would print.
+
+    Recognizes the artifact manifest, guest-agent part assembly, bundle expansion
+    and the program launch scripts; anything else succeeds silently.
+    """
+    dest_match = DEST_RE.search(script)
+    dest = dest_match.group(1) if dest_match else f"C:\\Users\\{user}"
+
+    if "Get-FileHash" in script and "$hashes" in script:
+        names_match = MANIFEST_NAMES_RE.search(script)
+        names = re.findall(r"'((?:[^']|'')*)'", names_match.group(1)) if names_match else []
+        hashes = {}
+        for name in (item.replace("''", "'") for item in names):
+            data = vm.files.get(windows_key(f"{dest}\\{name}"))
+            if data is not None:
+                hashes[name] = hashlib.sha256(data).hexdigest()
+        return GuestResult(0, [json.dumps(hashes)])
+
+    assemble = ASSEMBLE_MANIFEST_RE.search(script)
+    if assemble:
+        parts_dir = f"{dest}\\.pf_parts"
+        manifest_data = vm.files.get(windows_key(f"{parts_dir}\\{assemble.group(1)}"))
+        if manifest_data is None:
+            return GuestResult(1, [], f"Could not find file '{parts_dir}\\{assemble.group(1)}'")
+        manifest = json.loads(manifest_data)
+        results = []
+        for index, entry in enumerate(manifest):
+            data = b"".join(
+                vm.files.get(windows_key(f"{parts_dir}\\{index:03d}.{part:05d}"), b"") for part in range(entry["parts"])
+            )
+            vm.write_file(f"{dest}\\{entry['name']}", data)
+            actual = hashlib.sha256(data).hexdigest()
+            results.append({"Name": entry["name"], "Ok": actual == entry["sha256"], "Sha256": actual})
+        vm.remove_tree(parts_dir)
+        return GuestResult(0, [json.dumps(results)])
+
+    bundle = BUNDLE_RE.search(script)
+    if bundle:
+        data = vm.files.get(windows_key(bundle.group(1)))
+        if data is None:
+            return GuestResult(1, [], f"Could not find file '{bundle.group(1)}'")
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for entry in archive.infolist():
+                if not entry.filename.endswith("/"):
+                    vm.write_file(f"{dest}\\{entry.filename}", archive.read(entry))
+        vm.remove_tree(bundle.group(1))
+
+    if "Start-Process" in script or "'R|'" in script:
+        return emulate_program(vm, config, script, dest)
+    return GuestResult(0, [])
+
+
+def emulate_program(vm: SimVM, config: SimConfig, script: str, dest: str) -> GuestResult:
+    executable = EXE_PATH_RE.search(script)
+    if executable and windows_key(f"{dest}\\{executable.group(1)}") not in vm.files:
+        return GuestResult(1, [], f"Executable not found: {dest}\\{executable.group(1)}")
+    failed = config.fails("exec")
+    template = FAILED_PROGRAM_OUTPUT if failed else DEFAULT_PROGRAM_OUTPUT
+    output = [line.format(vmid=vm.vmid) for line in template]
+    seconds = config.latency("exec")
+    result = {
+        "ExitCode": 1 if failed else 0,
+        "StdOut": "\n".join(output),
+        "StdErr": "",
+        "ProcessId": 4000 + vm.vmid,
+        "StillRunning": False,
+        "TimedOut": False,
+    }
+    if DETACH_FLAG_RE.search(script):
+        result.update(StdOut=f"Process launched (PID {result['ProcessId']}) and still running.", StillRunning=True)
+        return GuestResult(0, [json.dumps(result, indent=2)])
+    stream = STREAM_FLAG_RE.search(script)
+    if stream and stream.group(1) == "$true":
+        result["StdOut"] = ""
+        lines = [f"O|{line}" for line in output] + ["R|" + json.dumps(result)]
+        return GuestResult(0, lines, line_delay=seconds / len(lines))
+    return GuestResult(0, [json.dumps(result, indent=2)], line_delay=seconds)
+
+
+# ---------------- HTTP API ----------------
+ROUTES = []
+
+
+def route(method: str, pattern: str):
+    def register(func):
+        ROUTES.append((method, re.compile("^" + pattern + "$"), func))
+        return func
+
+    return register
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def qemu(cluster, params):
+    if params["node"] != cluster.node:
+        raise ApiError(500, f"no such node '{params['node']}'")
+    return cluster.vm(params["vmid"])
+
+
+@route("GET", r"/nodes")
+def list_nodes(cluster, params, body):
+    return [{"node": cluster.node, "status": "online", "maxcpu": os.cpu_count() or 1}]
+
+
+@route("GET", r"/cluster/nextid")
+def next_id(cluster, params, body):
+    return str(cluster.next_vmid())
+
+
+@route("GET", r"/nodes/(?P<node>[^/]+)/qemu")
+def list_vms(cluster, params, body):
+    return [{"vmid": vm.vmid, "name": vm.name, "status": vm.status, "template": int(vm.template)} for vm in cluster.vms.values()]
+
+
+@route("GET", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/config")
+def vm_config(cluster, params, body):
+    vm = qemu(cluster, params)
+    return {"name": vm.name, "template": int(vm.template), "agent": "1"}
+
+
+@route("GET", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/status/current")
+def vm_status(cluster, params, body):
+    vm = qemu(cluster, params)
+    return {"vmid": vm.vmid, "name": vm.name, "status": vm.status, "qmpstatus": vm.qmpstatus, "agent": 1}
+
+
+@route("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/status/(?P<action>start|stop|shutdown|resume|reset)")
+def vm_power(cluster, params, body):
+    vm = qemu(cluster, params)
+    action = params["action"]
+    config = cluster.config
+    if action in ("start", "resume"):
+        boot = config.latency("boot") if action == "start" else 0.0
+        effect = lambda: vm.power_on(boot)  # noqa: E731
+    elif action == "reset":
+        effect = lambda: (vm.power_off(), vm.power_on(config.latency("boot")))  # noqa: E731
+    else:
+        effect = vm.power_off
+    return cluster.start_task(f"qm{action}", vm.vmid, action if action in config.latencies else "stop", effect)
+
+
+@route("GET", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/snapshot")
+def list_snapshots(cluster, params, body):
+    return qemu(cluster, params).snapshot_list()
+
+
+@route("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/snapshot")
+def create_snapshot(cluster, params, body):
+    vm = qemu(cluster, params)
+    name = body.get("snapname")
+    if not name:
+        raise ApiError(400, "snapname: property is missing and it is not optional")
+    vmstate = str(body.get("vmstate", "0")) in ("1", "true")
+    effect = lambda: vm.take_snapshot(name, vmstate, body.get("description", ""))  # noqa: E731
+    return cluster.start_task("qmsnapshot", vm.vmid, "snapshot", effect)
+
+
+@route("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/snapshot/(?P<snapshot>[^/]+)/rollback")
+def rollback_snapshot(cluster, params, body):
+    vm = qemu(cluster, params)
+    name = params["snapshot"]
+    if name not in vm.snapshots:
+        raise ApiError(500, f"snapshot '{name}' does not exist")
+    resume = cluster.config.latency("resume")
+    return cluster.start_task("qmrollback", vm.vmid, "rollback", lambda: vm.rollback(name, resume))
+
+
+@route("DELETE", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/snapshot/(?P<snapshot>[^/]+)")
+def delete_snapshot(cluster, params, body):
+    vm = qemu(cluster, params)
+    name = params["snapshot"]
+    if name not in vm.snapshots:
+        raise ApiError(500, f"snapshot '{name}' does not exist")
+    return cluster.start_task("qmdelsnapshot", vm.vmid, "delete", lambda: vm.snapshots.pop(name, None))
+
+
+@route("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/clone")
+def clone_vm(cluster, params, body):
+    source = qemu(cluster, params)
+    newid = int(body.get("newid") or cluster.next_vmid())
+    with cluster.lock:
+        if newid in cluster.vms or newid in cluster.reserved:
+            raise ApiError(500, f"VM {newid} already exists")
+        # Like PVE, the id is taken as soon as the clone task exists.
+        cluster.reserved.add(newid)
+    snapname = body.get("snapname")
+
+    def effect():
+        cluster.reserved.discard(newid)
+        clone = cluster.add_vm(newid, body.get("name"), snapshot=None)
+        snapshot = source.snapshots.get(snapname) if snapname else None
+        clone.files = dict(snapshot["files"] if snapshot else source.files)
+        clone.dirs = set(snapshot["dirs"] if snapshot else source.dirs)
+
+    return cluster.start_task("qmclone", source.vmid, "clone", effect)
+
+
+@route("DELETE", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)")
+def destroy_vm(cluster, params, body):
+    vm = qemu(cluster, params)
+    if vm.status == "running":
+        raise ApiError(500, f"VM {vm.vmid} is running - destroy failed")
+    return cluster.start_task("qmdestroy", vm.vmid, "delete", lambda: cluster.vms.pop(vm.vmid, None))
+
+
+@route("GET", r"/nodes/(?P<node>[^/]+)/tasks/(?P<upid>[^/]+)/status")
+def task_status(cluster, params, body):
+    task = cluster.tasks.get(params["upid"])
+    if task is None:
+        raise ApiError(500, "no such task")
+    return task.status()
+
+
+@route("GET", r"/nodes/(?P<node>[^/]+)/tasks/(?P<upid>[^/]+)/log")
+def task_log(cluster, params, body):
+    task = cluster.tasks.get(params["upid"])
+    if task is None:
+        raise ApiError(500, "no such task")
+    start = int(body.get("start", 0))
+    limit = int(body.get("limit", 50))
+    return [{"n": index + 1, "t": text} for index, text in enumerate(task.lines)][start:start + limit]
+
+
+def agent_vm(cluster, params):
+    vm = qemu(cluster, params)
+    if not vm.guest_ready() or cluster.config.fails("agent"):
+        raise ApiError(500, "QEMU guest agent is not running")
+    return vm
+
+
+@route("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/agent/ping")
+def agent_ping(cluster, params, body):
+    agent_vm(cluster, params)
+    return {}
+
+
+@route("GET", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/agent/network-get-interfaces")
+def agent_interfaces(cluster, params, body):
+    vm = agent_vm(cluster, params)
+    return {
+        "result": [
+            {"name": "Loopback Pseudo-Interface 1", "ip-addresses": [{"ip-address-type": "ipv4", "ip-address": "127.0.0.1"}]},
+            {"name": "Ethernet", "ip-addresses": [{"ip-address-type": "ipv4", "ip-address": vm.ip}]},
+        ]
+    }
+
+
+@route("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/agent/file-write")
+def agent_file_write(cluster, params, body):
+    vm = agent_vm(cluster, params)
+    content = body.get("content", "")
+    encode = str(body.get("encode", "1")) not in ("0", "false")
+    vm.write_file(body["file"], content.encode("utf-8") if encode else base64.b64decode(content))
+    return None
+
+
+@route("POST", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/agent/exec")
+def agent_exec(cluster, params, body):
+    vm = agent_vm(cluster, params)
+    command = body.get("command")
+    if isinstance(command, list):
+        command = " ".join(command)
+    extra = body.get("extra-args") or []
+    script = decode_powershell(" ".join([command or ""] + [str(item) for item in extra]))
+    result = emulate_powershell(vm, cluster.config, script)
+    with vm.lock:
+        vm.next_pid += 1
+        pid = vm.next_pid
+        vm.agent_procs[pid] = {
+            "result": result,
+            "done_at": time.time() + result.line_delay * max(1, len(result.stdout_lines)) + 0.05,
+        }
+    return {"pid": pid}
+
+
+@route("GET", r"/nodes/(?P<node>[^/]+)/qemu/(?P<vmid>\d+)/agent/exec-status")
+def agent_exec_status(cluster, params, body):
+    vm = agent_vm(cluster, params)
+    proc = vm.agent_procs.get(int(body.get("pid", -1)))
+    if proc is None:
+        raise ApiError(500, "Invalid parameter 'pid'")
+    if time.time() < proc["done_at"]:
+        return {"exited": 0}
+    result = proc["result"]
+    status = {"exited": 1, "exitcode": result.exitcode}
+    stdout = "\n".join(line[2:] if line[:2] in ("O|", "E|") else line for line in result.stdout_lines)
+    if stdout:
+        status["out-data"] = base64.b64encode(stdout.encode()).decode()
+    if result.stderr:
+        status["err-data"] = base64.b64encode(result.stderr.encode()).decode()
+    return status
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "pve-api-daemon/3.0 (simulated)"
+
+    def log_message(self, format, *args):  # noqa: A002
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if not raw:
+            return {}
+        if "json" in (self.headers.get("Content-Type") or ""):
+            return json.loads(raw.decode("utf-8"))
+        return {key: values[-1] for key, values in parse_qs(raw.decode("utf-8"), keep_blank_values=True).items()}
+
+    def _dispatch(self, method: str):
+        cluster = self.server.cluster
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        body = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body.update(self._body())
+        time.sleep(cluster.config.latency("http"))
+        if not path.startswith("/api2/json/"):
+            self._reply(404, None)
+            return
+        path = path[len("/api2/json"):]
+        if path == "/access/ticket" and method == "POST":
+            time.sleep(cluster.config.latency("login"))
+            payload = cluster.issue_ticket(body.get("username", ""), body.get("password", ""))
+            self._reply(200 if payload else 401, payload)
+            return
+        cookie = self.headers.get("Cookie") or ""
+        ticket = next(
+            (unquote(item.split("=", 1)[1]) for item in cookie.split(";") if item.strip().startswith("PVEAuthCookie=")),
+            None,
+        )
+        if not cluster.check_ticket(ticket, self.headers.get("CSRFPreventionToken"), method != "GET"):
+            self._reply(401, None, "authentication failure")
+            return
+        if cluster.config.fails("http"):
+            self._reply(500, None, "injected failure")
+            return
+        for route_method, pattern, func in ROUTES:
+            match = pattern.match(path)
+            if match and route_method == method:
+                try:
+                    self._reply(200, func(cluster, match.groupdict(), body))
+                except ApiError as exc:
+                    self._reply(exc.status, None, str(exc))
+                except LookupError as exc:
+                    self._reply(500, None, str(exc))
+                return
+        self._reply(501, None, f"Method '{method} {path}' not implemented")
+
+    def _reply(self, status: int, data, message=None):
+        payload = json.dumps({"data": data} if message is None else {"data": data, "message": message}).encode()
+        self.send_response(status, message)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+    def __init__(self, address, cluster: SimCluster, certfile: str, keyfile: str, verbose: bool = False):
+        super().__init__(address, ApiHandler)
+        self.cluster = cluster
+        self.verbose = verbose
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+
+def self_signed_certificate(directory: str, host: str):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .sign(key, hashes.SHA256())
+    )
+    certfile = os.path.join(directory, "sim.crt")
+    keyfile = os.path.join(directory, "sim.key")
+    with open(certfile, "wb") as handle:
+        handle.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as handle:
+        handle.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return certfile, keyfile
+
+
+class Simulator:
+    """Proxmox API on ``api_port`` plus one fake sshd per VM IP on ``ssh_port``."""
+
+    def __init__(self, config: SimConfig, api_bind="127.0.0.1", api_port=8006, ssh_port=2222, vm_password="sim", verbose=False):
+        from ssh_simulator import SshSimulator
+
+        self.cluster = SimCluster(config)
+        self.certdir = tempfile.mkdtemp(prefix="pf_sim_")
+        certfile, keyfile = self_signed_certificate(self.certdir, api_bind)
+        self.api = ApiServer((api_bind, api_port), self.cluster, certfile, keyfile, verbose=verbose)
+        self.ssh = SshSimulator(self.cluster, ssh_port, vm_password, verbose=verbose)
+        self.cluster.vm_added.append(self.ssh.listen_for)
+        self._threads = []
+
+    def add_vms(self, count: int, first_vmid: int = 1000, running: bool = False, templates: int = 0):
+        vms = []
+        for index in range(count):
+            vms.append(self.cluster.add_vm(first_vmid + index, running=running, template=index < templates))
+        return vms
+
+    def start(self):
+        for target in (self.api.serve_forever, self.ssh.serve_forever):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self.api.shutdown()
+        self.api.server_close()
+        self.ssh.close()
+
+
+def parse_pairs(items, cast=float):
+    values = {}
+    for item in items or []:
+        key, _, value = item.partition("=")
+        values[key] = cast(value)
+    return values
+
+
+def write_spec(path, vms, ssh_port):
+    spec = {
+        "vms": [{"vmid": vm.vmid, "vm_ip": vm.ip, "ssh_port": ssh_port} for vm in vms if not vm.template],
+        "snapshots": ["baseline"],
+        "program_args": [[]],
+    }
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump(spec, handle, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline Proxmox API + SSH/SFTP stand-in for load-testing the runners")
+    parser.add_argument("--vms", type=int, default=10, help="Simulated VMs to create")
+    parser.add_argument("--first-vmid", type=int, default=1000)
+    parser.add_argument("--templates", type=int, default=0, help="Mark the first N VMs as templates (for --pool-template)")
+    parser.add_argument("--running", action="store_true", help="Start with every VM booted")
+    parser.add_argument("--api-bind", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=8006)
+    parser.add_argument("--ssh-port", type=int, default=2222, help="Port every simulated VM IP listens on for SSH")
+    parser.add_argument("--password", default=DEFAULT_PASSWORD, help="Proxmox password the API accepts")
+    parser.add_argument("--vm-password", default="sim", help="Password the simulated sshd accepts")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Multiply every latency, e.g. 0.1")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random +/- fraction applied to latencies")
+    parser.add_argument("--latency", action="append", help="name=seconds, e.g. boot=30 (see DEFAULT_LATENCIES)")
+    parser.add_argument("--fail", action="append", help="point=probability, e.g. task:qmrollback=0.05 or ssh_drop=0.01")
+    parser.add_argument("--seed", type=int, help="Seed latency jitter and failure injection")
+    parser.add_argument("--write-spec", help="Write a proxmox_matrix_runner.py spec for the simulated VMs")
+    parser.add_argument("--verbose", action="store_true", help="Log every API request")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    failures = parse_pairs(args.fail)
+    unknown = [name for name in failures if name.split(":")[0] not in FAILURE_POINTS]
+    if unknown:
+        raise SystemExit(f"Unknown failure points: {', '.join(unknown)} (choose from {', '.join(FAILURE_POINTS)})")
+    config = SimConfig(parse_pairs(args.latency), failures, args.time_scale, args.jitter, args.password, args.seed)
+    simulator = Simulator(config, args.api_bind, args.api_port, args.ssh_port, args.vm_password, args.verbose)
+    vms = simulator.add_vms(args.vms, args.first_vmid, running=args.running, templates=args.templates)
+    simulator.start()
+    print(f"Simulated Proxmox node {simulator.cluster.node} on https://{args.api_bind}:{args.api_port} (password {args.password})")
+    print(f"{len(vms)} VMs {vms[0].vmid}-{vms[-1].vmid} at {vms[0].ip}-{vms[-1].ip}, sshd on port {args.ssh_port}")
+    if args.write_spec:
+        write_spec(args.write_spec, vms, args.ssh_port)
+        print(f"Matrix spec written to {args.write_spec}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,37 @@ import argparse
 import base64
 import json
 import os
+import random
+import socket
 import time
 import re
+import zipfile
+from collections import deque
 
 import paramiko
 import proxmoxer
 
+from artifact_sync import DEFAULT_CACHE_PATH, HashCache, changed_files, local_manifest, remote_manifest_script
+from ps_command import powershell_command
+from ps_host import host_for
+from proxmox_reaper import DEFAULT_REAPER_ADDRESS, TEARDOWN_ACTIONS, cancel_teardown, post_teardown, schedule_teardown
+from proxmox_rest import ProxmoxerRest
+from proxmox_tasks import TaskWaiter
+from proxmox_tickets import DEFAULT_TICKET_CACHE, TicketCache, connect_cached
+from proxmox_warm import warm_resume, warm_snapshot_name
+from result_store import DEFAULT_RESULT_DB, ResultStore, parse_since
+from run_timing import configure as configure_timing, current_run_id, span, spans_for
+from stage_graph import StageGraph
+from sftp_transfer import connect_kwargs, ensure_parent_dirs, open_sftp, parallel_upload, tune_transport
+from ssh_broker import DEFAULT_BROKER_ADDRESS, connect_via_broker
+
+BUNDLE_NAME = "privacyfirst_bundle.zip"
+BUNDLE_BUFFER_SIZE = 1024 * 1024
+STREAM_TAIL_LINES = 2000
+SSH_PROBE_MIN_DELAY = 0.1
+SSH_PROBE_MAX_DELAY = 1.0
+SSH_AUTH_RETRY_DELAY = 5
+
 ARTIFACTS_DEFAULT = [
     "PrivacyFirst.exe",
     "PrivacyFirst.dll",
@@ -17,24 +42,74 @@ ARTIFACTS_DEFAULT = [
 ]
 
 
-def parse_args():
-    parser = argparse.ArgumentParser(description="Deploy PrivacyFirst artifacts to a Proxmox VM via SSH")
+def add_common_arguments(parser):
     parser.add_argument("--proxmox-host", required=True)
     parser.add_argument("--proxmox-user", required=True)
     parser.add_argument("--proxmox-password", required=True)
-    parser.add_argument("--vmid", type=int, required=True)
-    parser.add_argument("--snapshot", default="baseline")
-    parser.add_argument("--vm-ip", required=True)
+    parser.add_argument("--ticket-cache", default=DEFAULT_TICKET_CACHE, help="File caching Proxmox auth tickets")
+    parser.add_argument("--no-ticket-cache", action="store_true", help="Always log in with the password")
     parser.add_argument("--vm-user", required=True)
     parser.add_argument("--vm-password", required=True)
+    parser.add_argument("--vm-ssh-port", type=int, default=22, help="SSH port on the VM")
     parser.add_argument("--build-path", default=r"c:\repos\privacyfirst\x64\Release")
     parser.add_argument("--remote-dir")
     parser.add_argument("--files", nargs="*", default=ARTIFACTS_DEFAULT)
     parser.add_argument("--executable", default="PrivacyFirst.exe")
-    parser.add_argument("--program-args", nargs=argparse.REMAINDER, help="Arguments passed to the executable")
     parser.add_argument("--command-timeout", type=int, default=300, help="Seconds to wait for the remote process")
     parser.add_argument("--detach", action="store_true", help="Launch the executable and return without waiting for exit")
     parser.add_argument("--post-launch-wait", type=int, default=10, help="Seconds to wait after launch when detaching")
+    parser.add_argument(
+        "--delta-sync",
+        action="store_true",
+        help="Compare SHA-256 manifests and upload only artifacts that differ on the VM",
+    )
+    parser.add_argument("--hash-cache", default=DEFAULT_CACHE_PATH, help="Local artifact hash cache for --delta-sync")
+    parser.add_argument(
+        "--bundle",
+        action="store_true",
+        help="Stream artifacts as one zip and expand it in the remote launch script",
+    )
+    parser.add_argument(
+        "--stream-output",
+        action="store_true",
+        help="Print remote stdout/stderr line by line while the executable runs",
+    )
+    parser.add_argument(
+        "--stream-tail-lines",
+        type=int,
+        default=STREAM_TAIL_LINES,
+        help="Lines of each stream kept for the final result when streaming",
+    )
+    parser.add_argument("--sftp-channels", type=int, default=4, help="Parallel SFTP channels for uploads")
+    parser.add_argument("--ssh-cipher", help="Force one SSH cipher, e.g. aes128-gcm@openssh.com")
+    parser.add_argument("--ssh-compress", action="store_true", help="Enable SSH transport compression")
+    parser.add_argument(
+        "--ps-host",
+        action="store_true",
+        help="Run remote scripts in one long-lived PowerShell per SSH session instead of a new powershell.exe each",
+    )
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="Resume a RAM-state copy of --snapshot (<snapshot>-warm, built on first use) instead of booting",
+    )
+    parser.add_argument("--refresh-warm", action="store_true", help="Rebuild the warm snapshot before using it")
+    parser.add_argument("--timings", help="Append per-phase timing spans to this JSON lines file")
+    parser.add_argument("--results-db", default=DEFAULT_RESULT_DB, help="SQLite file every run is recorded in")
+    parser.add_argument("--no-results-db", action="store_true", help="Do not record runs in the result store")
+    parser.add_argument(
+        "--ssh-broker",
+        help=f"Open channels through a running ssh_broker.py (e.g. {DEFAULT_BROKER_ADDRESS}) instead of reconnecting",
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deploy PrivacyFirst artifacts to a Proxmox VM via SSH")
+    add_common_arguments(parser)
+    parser.add_argument("--vmid", type=int, required=True)
+    parser.add_argument("--snapshot", default="baseline")
+    parser.add_argument("--vm-ip", required=True)
+    parser.add_argument("--program-args", nargs=argparse.REMAINDER, help="Arguments passed to the executable")
     parser.add_argument(
         "--keep-alive-seconds",
         type=int,
@@ -48,25 +123,35 @@ def parse_args():
         help="Automatically shut down the VM after this many seconds (set to 0 to skip)",
     )
     parser.add_argument("--shutdown-vm", action="store_true", help="Force VM shutdown when automation completes")
+    parser.add_argument(
+        "--teardown",
+        choices=TEARDOWN_ACTIONS,
+        default="shutdown",
+        help="How to tear the VM down: graceful shutdown, or disposable stop / rollback to --snapshot",
+    )
+    parser.add_argument(
+        "--reaper",
+        nargs="?",
+        const=DEFAULT_REAPER_ADDRESS,
+        help=f"Hand the keep-alive and shutdown delay to a background proxmox_reaper.py (default {DEFAULT_REAPER_ADDRESS}, "
+        "started on demand) and return immediately",
+    )
+    parser.add_argument(
+        "--no-result-cache",
+        action="store_true",
+        help="Run on the VM even when the result store has a run with identical artifacts, args and snapshot",
+    )
+    parser.add_argument("--result-max-age", help="Only reuse stored results newer than this (7d, 12h, 30m or YYYY-MM-DD)")
+    parser.add_argument(
+        "--reuse-failed-results",
+        action="store_true",
+        help="Also reuse stored runs that completed with status fail (only passing runs are reused by default)",
+    )
     return parser.parse_args()
 
 
 def wait_for_task(proxmox, node, upid, timeout=600):
-    deadline = time.time() + timeout
-    last_status = None
-    while time.time() < deadline:
-        status = proxmox.nodes(node).tasks(upid).status.get()
-        state = status.get("status")
-        if state != last_status:
-            print(f"  Proxmox task state: {state}")
-            last_status = state
-        if state == "stopped":
-            exitstatus = status.get("exitstatus", "OK")
-            if exitstatus != "OK":
-                raise RuntimeError(f"Proxmox task failed: {exitstatus}")
-            return
-        time.sleep(2)
-    raise TimeoutError("Proxmox task timed out")
+    TaskWaiter(ProxmoxerRest(proxmox), node).add(upid).wait(timeout=timeout)
 
 
 def ensure_vm_running(proxmox, node, vmid, timeout=180):
@@ -87,22 +172,97 @@ def ensure_vm_running(proxmox, node, vmid, timeout=180):
     raise TimeoutError("VM failed to reach running state")
 
 
-def wait_for_ssh(host, username, password, timeout=300):
-    deadline = time.time() + timeout
+def probe_ssh(host, port=22, timeout=1.0):
+    """Cheap readiness probe: returns (phase, latency_seconds) without authenticating.
+
+    Phases: ``unreachable`` (no TCP answer yet), ``refused`` (guest network up,
+    sshd not listening), ``no-banner`` (port open but silent) and ``banner``.
+    """
+    started = time.time()
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except ConnectionRefusedError:
+        return "refused", time.time() - started
+    except OSError:
+        return "unreachable", time.time() - started
+    try:
+        sock.settimeout(timeout)
+        banner = sock.recv(256)
+    except OSError:
+        banner = b""
+    finally:
+        sock.close()
+    return ("banner" if banner.startswith(b"SSH-") else "no-banner"), time.time() - started
+
+
+def wait_for_ssh(
+    host,
+    username,
+    password,
+    timeout=300,
+    cipher=None,
+    compress=False,
+    broker=None,
+    port=22,
+    probe_log=None,
+    fresh=False,
+):
+    started = time.time()
+    deadline = started + timeout
     last_error = None
     attempt = 0
+    phase = None
+    phase_started = started
+    phase_durations = {}
+    delay = SSH_PROBE_MIN_DELAY
     while time.time() < deadline:
-        try:
-            attempt += 1
-            print(f"  Attempting SSH connection (try {attempt}) ...")
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(host, username=username, password=password, timeout=15)
+        attempt += 1
+        current, latency = probe_ssh(host, port)
+        if current == "banner":
+            try:
+                connect_started = time.time()
+                if broker:
+                    client = connect_via_broker(
+                        broker, host, username, password, port=port, cipher=cipher, compress=compress, fresh=fresh
+                    )
+                else:
+                    client = paramiko.SSHClient()
+                    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                    client.connect(
+                        host,
+                        port=port,
+                        username=username,
+                        password=password,
+                        timeout=15,
+                        **connect_kwargs(cipher, compress),
+                    )
+                    tune_transport(client.get_transport())
+                current, latency = "authenticated", time.time() - connect_started
+            except Exception as exc:  # noqa: BLE001
+                last_error = exc
+                current = "auth-failed"
+        elapsed = time.time() - started
+        if probe_log is not None:
+            probe_log.append({"attempt": attempt, "phase": current, "latency_ms": round(latency * 1000, 1), "elapsed": round(elapsed, 2)})
+        if current != phase:
+            if phase is not None:
+                phase_durations[phase] = phase_durations.get(phase, 0.0) + (time.time() - phase_started)
+            print(f"  [{elapsed:6.1f}s] SSH probe {attempt}: {current} ({latency * 1000:.0f} ms)")
+            phase, phase_started = current, time.time()
+            delay = SSH_PROBE_MIN_DELAY
+        if current == "authenticated":
+            phases = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in phase_durations.items())
+            print(f"  SSH ready after {elapsed:.1f}s and {attempt} probes ({phases or 'no wait'})")
             return client
-        except Exception as exc:  # noqa: BLE001
-            last_error = exc
-            time.sleep(5)
-    raise RuntimeError(f"SSH not ready: {last_error}")
+        if current == "auth-failed":
+            # sshd answers but rejects us (e.g. services still starting); full logins are expensive.
+            time.sleep(SSH_AUTH_RETRY_DELAY)
+            continue
+        # Jittered exponential backoff, reset on every phase change and capped so a
+        # freshly started sshd is noticed within a second.
+        time.sleep(random.uniform(delay / 2, delay))
+        delay = min(SSH_PROBE_MAX_DELAY, delay * 2)
+    raise RuntimeError(f"SSH not ready after {attempt} probes (last phase {phase}): {last_error}")
 
 
 def to_sftp_path(path):
@@ -114,41 +274,121 @@ def to_sftp_path(path):
     return normalized
 
 
-def ensure_remote_dir(sftp, remote_dir):
-    sftp_path = to_sftp_path(remote_dir)
-    segments = [seg for seg in sftp_path.strip("/").split("/") if seg]
-    if not segments:
-        return
+def deploy_artifacts(ssh_client, build_path, files, remote_dir, hash_cache=None, bundle=False, channels=4, manifest=None):
+    """Upload artifacts; with ``bundle`` return the remote zip that still has to be expanded.
+
+    ``manifest`` is the local ``name -> sha256`` map when it is already known, so delta sync
+    does not hash the build again.
+    """
+    with span("upload", files=len(files), bundle=bool(bundle)) as timing:
+        timing["bytes"] = 0
+        return _upload_artifacts(ssh_client, build_path, files, remote_dir, hash_cache, bundle, channels, manifest, timing)
+
+
+def _upload_artifacts(ssh_client, build_path, files, remote_dir, hash_cache, bundle, channels, manifest, timing):
+    to_upload = list(files)
+    if hash_cache is not None:
+        local = manifest if manifest is not None else local_manifest(build_path, files, hash_cache)
+        remote = query_remote_manifest(ssh_client, remote_dir, files)
+        to_upload = changed_files(local, remote)
+        print(f"Delta sync: {len(files) - len(to_upload)} unchanged, {len(to_upload)} to upload")
+        if not to_upload:
+            return None
+    for name in to_upload:
+        local_path = os.path.join(build_path, name)
+        if not os.path.isfile(local_path):
+            raise FileNotFoundError(f"Artifact missing: {local_path}")
+    transport = ssh_client.get_transport()
+    if bundle:
+        with open_sftp(transport) as sftp:
+            return upload_bundle(sftp, build_path, to_upload, timing)
+    pairs = [
+        (os.path.join(build_path, name), to_sftp_path(os.path.join(remote_dir, name)))
+        for name in to_upload
+    ]
+    # The session that creates the directories goes on to upload as one of the channels.
+    sftp = open_sftp(transport)
+    try:
+        ensure_parent_dirs(sftp, [remote for _, remote in pairs])
+    except Exception:
+        sftp.close()
+        raise
+    sent, seconds = parallel_upload(transport, pairs, channels=channels, sftp=sftp)
+    timing["bytes"] = sent
+    if seconds > 0:
+        print(f"  Uploaded {sent} bytes in {seconds:.2f}s ({sent / 1048576 / seconds:.1f} MB/s)")
+    return None
+
+
+class _StreamWriter:
+    # No tell()/seek(), so zipfile writes data descriptors instead of seeking back.
+    def __init__(self, handle):
+        self._handle = handle
+        self.bytes_written = 0
+
+    def write(self, data):
+        self._handle.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        self._handle.flush()
+
+
+def upload_bundle(sftp, build_path, files, timing=None):
+    # The SFTP session starts in the user's home directory, so no remote mkdir walk is needed.
+    home = sftp.normalize(".")
+    remote_path = f"{home.rstrip('/')}/{BUNDLE_NAME}"
+    raw_size = sum(os.path.getsize(os.path.join(build_path, name)) for name in files)
+    print(f"Uploading {len(files)} artifacts as one bundle ...")
+    with sftp.open(remote_path, "wb", bufsize=BUNDLE_BUFFER_SIZE) as remote:
+        remote.set_pipelined(True)
+        writer = _StreamWriter(remote)
+        with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+            for name in files:
+                archive.write(os.path.join(build_path, name), arcname=name.replace("\\", "/"))
+    print(f"  Bundle sent: {writer.bytes_written} bytes ({raw_size} uncompressed)")
+    if timing is not None:
+        timing["bytes"] = writer.bytes_written
+    return remote_path.lstrip("/").replace("/", "\\")
+
+
+def query_remote_manifest(ssh_client, remote_dir, files):
+    out, err, exit_status = run_remote_powershell(ssh_client, remote_manifest_script(remote_dir, files))
+    if exit_status != 0:
+        print(f"  Remote manifest unavailable ({exit_status}), uploading everything: {err}")
+        return {}
+    try:
+        return json.loads(out) if out else {}
+    except json.JSONDecodeError:
+        print(f"  Remote manifest unreadable, uploading everything: {out}")
+        return {}
+
+
+def powershell_host(ssh_client):
+    """The PowerShell host attached by ``connect_ssh --ps-host``, or None for one-shot powershell.exe."""
+    return getattr(ssh_client, "powershell_host", None)
+
 
-    prefix = ""
-    start_index = 0
-    if segments[0].endswith(":"):
-        prefix = f"/{segments[0]}"
-        start_index = 1
-        try:
-            sftp.stat(prefix)
-        except IOError:
-            pass
-
-    for segment in segments[start_index:]:
-        prefix = f"{prefix}/{segment}" if prefix else f"/{segment}"
-        try:
-            sftp.stat(prefix)
-        except IOError:
-            sftp.mkdir(prefix)
-
-
-def deploy_artifacts(ssh_client, build_path, files, remote_dir):
-    with ssh_client.open_sftp() as sftp:
-        ensure_remote_dir(sftp, remote_dir)
-        for name in files:
-            local_path = os.path.join(build_path, name)
-            if not os.path.isfile(local_path):
-                raise FileNotFoundError(f"Artifact missing: {local_path}")
-            remote_win_path = os.path.join(remote_dir, name)
-            remote_path = to_sftp_path(remote_win_path)
-            print(f"Uploading {name} ...")
-            sftp.put(local_path, remote_path)
+def attach_powershell_host(ssh_client):
+    transport = ssh_client.get_transport()
+    # Brokered sessions keep their host in the broker, where it outlives this process.
+    if hasattr(transport, "powershell_host"):
+        ssh_client.powershell_host = transport.powershell_host()
+    else:
+        ssh_client.powershell_host = host_for(transport)
+    return ssh_client
+
+
+def run_remote_powershell(ssh_client, ps_script):
+    host = powershell_host(ssh_client)
+    if host is not None:
+        return host.run(ps_script)
+    stdin, stdout, stderr = ssh_client.exec_command(powershell_command(ps_script))
+    out = stdout.read().decode(errors="ignore").strip()
+    err = stderr.read().decode(errors="ignore").strip()
+    exit_status = stdout.channel.recv_exit_status()
+    return out, err, exit_status
 
 
 def encode_args_for_ps(args):
@@ -156,37 +396,162 @@ def encode_args_for_ps(args):
     return base64.b64encode(json_blob.encode("utf-8")).decode("ascii")
 
 
-def parse_privacyfirst_output(stdout: str, stderr: str):
-    summary = {}
-    combined = "\n".join(filter(None, [stdout, stderr]))
-    if not combined:
+EXECUTION_COMPLETE_RE = re.compile(r"Execution complete:\s*(\d+)\s+succeeded,\s*(\d+)\s+failed")
+WARN_RE = re.compile(r"\[WARN\]\s*(.+)")
+ERROR_RE = re.compile(r"\[ERROR\]\s*(.+)")
+MISSING_RUNTIME_TEXT = "You must install .NET to run this application."
+HOSTFXR_MISSING_TEXT = "Failed to resolve hostfxr.dll"
+MAX_SUMMARY_SAMPLES = 50
+
+
+class OutputParser:
+    """Single-pass PrivacyFirst log parser fed one line at a time.
+
+    Warnings and errors keep the first ``max_samples`` messages; when more were
+    seen, ``warning_count``/``error_count`` report the totals.
+    """
+
+    def __init__(self, max_samples=MAX_SUMMARY_SAMPLES):
+        self.max_samples = max_samples
+        self.execution = None
+        self.warnings = []
+        self.errors = []
+        self.warning_count = 0
+        self.error_count = 0
+        self.missing_runtime = False
+        self.hostfxr_missing = False
+
+    def feed(self, line):
+        if self.execution is None and "Execution complete" in line:
+            match = EXECUTION_COMPLETE_RE.search(line)
+            if match:
+                self.execution = (int(match.group(1)), int(match.group(2)))
+        if "[WARN]" in line:
+            for match in WARN_RE.finditer(line):
+                self.warning_count += 1
+                if len(self.warnings) < self.max_samples:
+                    self.warnings.append(match.group(1))
+        if "[ERROR]" in line:
+            for match in ERROR_RE.finditer(line):
+                self.error_count += 1
+                if len(self.errors) < self.max_samples:
+                    self.errors.append(match.group(1))
+        if not self.missing_runtime and MISSING_RUNTIME_TEXT in line:
+            self.missing_runtime = True
+        if not self.hostfxr_missing and HOSTFXR_MISSING_TEXT in line:
+            self.hostfxr_missing = True
+
+    def feed_text(self, text):
+        start = 0
+        while start < len(text):
+            end = text.find("\n", start)
+            if end < 0:
+                end = len(text)
+            self.feed(text[start:end])
+            start = end + 1
+
+    def summary(self):
+        summary = {}
+        if self.execution is not None:
+            succeeded, failed = self.execution
+            summary["execution_summary"] = {
+                "succeeded": succeeded,
+                "failed": failed,
+            }
+            summary["overall_status"] = "pass" if failed == 0 else "fail"
+
+        if self.warnings:
+            summary["warnings"] = list(self.warnings)
+            if self.warning_count > len(self.warnings):
+                summary["warning_count"] = self.warning_count
+        if self.errors:
+            summary["errors"] = list(self.errors)
+            if self.error_count > len(self.errors):
+                summary["error_count"] = self.error_count
+            summary.setdefault("overall_status", "fail")
+
+        if self.missing_runtime:
+            summary["missing_runtime"] = True
+            summary.setdefault("overall_status", "fail")
+        if self.hostfxr_missing:
+            summary["runtime_error"] = "hostfxr_missing"
+            summary.setdefault("overall_status", "fail")
         return summary
 
-    match = re.search(r"Execution complete:\s*(\d+)\s+succeeded,\s*(\d+)\s+failed", combined)
-    if match:
-        succeeded = int(match.group(1))
-        failed = int(match.group(2))
-        summary["execution_summary"] = {
-            "succeeded": succeeded,
-            "failed": failed,
-        }
-        summary["overall_status"] = "pass" if failed == 0 else "fail"
-
-    warnings = re.findall(r"\[WARN\]\s*(.+)", combined)
-    errors = re.findall(r"\[ERROR\]\s*(.+)", combined)
-    if warnings:
-        summary["warnings"] = warnings
-    if errors:
-        summary["errors"] = errors
-        summary.setdefault("overall_status", "fail")
-
-    if "You must install .NET to run this application." in combined:
-        summary["missing_runtime"] = True
-        summary.setdefault("overall_status", "fail")
-    if "Failed to resolve hostfxr.dll" in combined:
-        summary["runtime_error"] = "hostfxr_missing"
-        summary.setdefault("overall_status", "fail")
-    return summary
+
+def parse_privacyfirst_output(stdout: str, stderr: str):
+    parser = OutputParser()
+    parser.feed_text(stdout or "")
+    parser.feed_text(stderr or "")
+    return parser.summary()
+
+
+def expand_bundle_ps(bundle_path):
+    return f"""
+$bundle = '{bundle_path}'
+if (-not (Test-Path $dest)) {{ New-Item -ItemType Directory -Path $dest -Force | Out-Null }}
+Add-Type -AssemblyName System.IO.Compression.FileSystem
+$zip = [System.IO.Compression.ZipFile]::OpenRead($bundle)
+try {{
+    foreach ($entry in $zip.Entries) {{
+        if ($entry.FullName.EndsWith('/')) {{ continue }}
+        $target = Join-Path $dest $entry.FullName
+        $parent = Split-Path -Parent $target
+        if (-not (Test-Path $parent)) {{ New-Item -ItemType Directory -Path $parent -Force | Out-Null }}
+        [System.IO.Compression.ZipFileExtensions]::ExtractToFile($entry, $target, $true)
+    }}
+}} finally {{
+    $zip.Dispose()
+}}
+Remove-Item -LiteralPath $bundle -Force
+"""
+
+
+def print_stream_line(stream_name, line):
+    print(line if stream_name == "stdout" else f"[stderr] {line}", flush=True)
+
+
+def stream_remote_powershell(ssh_client, ps_script, on_line, tail_lines=STREAM_TAIL_LINES):
+    parser = OutputParser()
+    tails = {"stdout": deque(maxlen=tail_lines), "stderr": deque(maxlen=tail_lines)}
+    counts = {"stdout": 0, "stderr": 0}
+    result = None
+
+    def handle(line):
+        nonlocal result
+        tag, _, text = line.partition("|")
+        if tag == "R":
+            result = json.loads(text)
+            return
+        stream_name = "stderr" if tag == "E" else "stdout"
+        if tag not in ("O", "E"):
+            text = line
+        counts[stream_name] += 1
+        tails[stream_name].append(text)
+        parser.feed(text)
+        on_line(stream_name, text)
+
+    host = powershell_host(ssh_client)
+    if host is not None:
+        _, err, exit_status = host.run(ps_script, on_line=handle)
+    else:
+        stdin, stdout, stderr = ssh_client.exec_command(powershell_command(ps_script))
+        reader = stdout.channel.makefile("rb")
+        for raw in iter(reader.readline, b""):
+            handle(raw.decode(errors="ignore").rstrip("\r\n"))
+        err = stderr.read().decode(errors="ignore").strip()
+        exit_status = stdout.channel.recv_exit_status()
+    if err:
+        print("[powershell stderr]\n" + err)
+    if result is None:
+        raise RuntimeError(f"Remote PowerShell exited with {exit_status} before reporting a result: {err}")
+    result["StdOut"] = "\n".join(tails["stdout"])
+    result["StdErr"] = "\n".join(tails["stderr"])
+    result["StdOutLines"] = counts["stdout"]
+    result["StdErrLines"] = counts["stderr"]
+    result["ParsedSummary"] = parser.summary()
+    result["ExitStatus"] = exit_status
+    return result
 
 
 def run_remote_executable(
@@ -197,14 +562,20 @@ def run_remote_executable(
     timeout=300,
     detach=False,
     post_launch_wait=10,
+    bundle_path=None,
+    stream=False,
+    on_line=None,
+    tail_lines=STREAM_TAIL_LINES,
 ):
     args_b64 = encode_args_for_ps(program_args)
     timeout_ms = -1 if timeout <= 0 else int(timeout) * 1000
     detach_flag = "$true" if detach else "$false"
+    stream_flag = "$true" if stream and not detach else "$false"
     post_launch = max(0, int(post_launch_wait))
     ps_script = f"""
 $ErrorActionPreference = 'Stop'
 $dest = '{remote_dir}'
+{expand_bundle_ps(bundle_path) if bundle_path else ''}
 $exePath = Join-Path $dest '{executable}'
 if (-not (Test-Path $exePath)) {{ throw "Executable not found: $exePath" }}
 $argsJson = [System.Text.Encoding]::UTF8.GetString([System.Convert]::FromBase64String('{args_b64}'))
@@ -254,7 +625,48 @@ if ({detach_flag}) {{
         StillRunning = $stillRunning
         TimedOut = $false
     }}
+}} elseif ({stream_flag}) {{
+    # Forward each line as soon as it is produced: "O|" for stdout, "E|" for stderr.
+    $console = [Console]::Out
+    $outTask = $process.StandardOutput.ReadLineAsync()
+    $errTask = $process.StandardError.ReadLineAsync()
+    $deadline = if ($timeoutMs -gt 0) {{ [DateTime]::UtcNow.AddMilliseconds($timeoutMs) }} else {{ [DateTime]::MaxValue }}
+    while ($null -ne $outTask -or $null -ne $errTask) {{
+        $pending = [System.Threading.Tasks.Task[]]@(@($outTask, $errTask) | Where-Object {{ $null -ne $_ }})
+        [void][System.Threading.Tasks.Task]::WaitAny($pending, 500)
+        if ($null -ne $outTask -and $outTask.IsCompleted) {{
+            $line = $outTask.Result
+            if ($null -eq $line) {{ $outTask = $null }} else {{
+                $console.WriteLine('O|' + $line)
+                $outTask = $process.StandardOutput.ReadLineAsync()
+            }}
+        }}
+        if ($null -ne $errTask -and $errTask.IsCompleted) {{
+            $line = $errTask.Result
+            if ($null -eq $line) {{ $errTask = $null }} else {{
+                $console.WriteLine('E|' + $line)
+                $errTask = $process.StandardError.ReadLineAsync()
+            }}
+        }}
+        $console.Flush()
+        if (-not $timedOut -and [DateTime]::UtcNow -gt $deadline) {{
+            try {{ $process.Kill() }} catch {{ }}
+            $timedOut = $true
+        }}
+    }}
+    $process.WaitForExit()
+    $result = [PSCustomObject]@{{
+        ExitCode = $process.ExitCode
+        StdOut = ''
+        StdErr = ''
+        ProcessId = $process.Id
+        StillRunning = $false
+        TimedOut = $timedOut
+    }}
 }} else {{
+    # Drain both pipes while waiting; a full pipe buffer would otherwise block the child forever.
+    $stdoutTask = $process.StandardOutput.ReadToEndAsync()
+    $stderrTask = $process.StandardError.ReadToEndAsync()
     if ($timeoutMs -gt 0) {{
         $completed = $process.WaitForExit($timeoutMs)
         if (-not $completed) {{
@@ -265,8 +677,8 @@ if ({detach_flag}) {{
     }} else {{
         $process.WaitForExit()
     }}
-    $stdout = $process.StandardOutput.ReadToEnd()
-    $stderr = $process.StandardError.ReadToEnd()
+    $stdout = $stdoutTask.Result
+    $stderr = $stderrTask.Result
     $result = [PSCustomObject]@{{
         ExitCode = $process.ExitCode
         StdOut = $stdout
@@ -279,15 +691,17 @@ if ({detach_flag}) {{
 try {{
     $process.Dispose()
 }} catch {{}} 
-$result | ConvertTo-Json -Depth 5
+if ({stream_flag}) {{
+    [Console]::Out.WriteLine('R|' + ($result | ConvertTo-Json -Depth 5 -Compress))
+    [Console]::Out.Flush()
+}} else {{
+    $result | ConvertTo-Json -Depth 5
+}}
 """
-    encoded = base64.b64encode(ps_script.encode("utf-16le")).decode("ascii")
-    command = f"powershell.exe -NoLogo -NoProfile -ExecutionPolicy Bypass -EncodedCommand {encoded}"
+    if stream and not detach:
+        return stream_remote_powershell(ssh_client, ps_script, on_line or print_stream_line, tail_lines)
 
-    stdin, stdout, stderr = ssh_client.exec_command(command)
-    out = stdout.read().decode(errors="ignore").strip()
-    err = stderr.read().decode(errors="ignore").strip()
-    exit_status = stdout.channel.recv_exit_status()
+    out, err, exit_status = run_remote_powershell(ssh_client, ps_script)
     if err:
         print("[powershell stderr]\n" + err)
     if exit_status != 0 and not out:
@@ -300,60 +714,145 @@ $result | ConvertTo-Json -Depth 5
     return result
 
 
-def main():
-    args = parse_args()
-
-    if not os.path.isdir(args.build_path):
-        raise FileNotFoundError(f"Build path not found: {args.build_path}")
-
+def resolve_remote_dir(args):
     remote_dir = args.remote_dir
     if not remote_dir:
         remote_dir = os.path.join(r"C:\Users", args.vm_user, "Documents", "PrivacyFirstPipeline")
         print(f"Remote directory not provided, defaulting to {remote_dir}")
+    return remote_dir
+
 
-    artifacts = [name for name in args.files if os.path.isfile(os.path.join(args.build_path, name))]
+def find_artifacts(build_path, files):
+    if not os.path.isdir(build_path):
+        raise FileNotFoundError(f"Build path not found: {build_path}")
+    artifacts = [name for name in files if os.path.isfile(os.path.join(build_path, name))]
     if not artifacts:
         raise FileNotFoundError("No artifacts found to deploy.")
+    return artifacts
 
-    proxmox = proxmoxer.ProxmoxAPI(
-        args.proxmox_host,
-        user=args.proxmox_user,
-        password=args.proxmox_password,
-        verify_ssl=False,
-    )
 
+def connect_proxmox(args):
+    with span("login", host=args.proxmox_host):
+        if not args.no_ticket_cache:
+            return connect_cached(args.proxmox_host, args.proxmox_user, args.proxmox_password, TicketCache(args.ticket_cache))
+        return proxmoxer.ProxmoxAPI(
+            args.proxmox_host,
+            user=args.proxmox_user,
+            password=args.proxmox_password,
+            verify_ssl=False,
+        )
+
+
+def lookup_node(proxmox):
     node = proxmox.nodes.get()[0]["node"]
     print(f"Using Proxmox node {node}")
+    return node
+
+
+def run_on_vm(proxmox, node, args, artifacts, remote_dir):
+    """Roll back, boot, deploy and execute on ``args.vmid``; return the remote result."""
+    prepare_vm(proxmox, node, args)
+    # Any session cached from before the rollback now points at a guest state that no longer exists.
+    return deploy_and_run(args, artifacts, remote_dir, fresh_session=True)
+
+
+def prepare_vm(proxmox, node, args):
+    """Roll ``args.vmid`` back to its snapshot and make sure it is running."""
+    if args.warm:
+        print(f"Resuming {warm_snapshot_name(args.snapshot)} ...")
+        with span("rollback", vmid=args.vmid, warm=True):
+            seconds = warm_resume(
+                ProxmoxerRest(proxmox),
+                node,
+                args.vmid,
+                args.snapshot,
+                # Authenticate directly so no brokered session ends up inside the saved RAM state.
+                wait_ready=lambda: wait_for_ssh(
+                    args.vm_ip, args.vm_user, args.vm_password, timeout=600, port=args.vm_ssh_port
+                ).close(),
+                refresh=args.refresh_warm,
+            )
+        print(f"VM resumed in {seconds:.1f}s")
+    else:
+        print("Rolling back snapshot ...")
+        with span("rollback", vmid=args.vmid):
+            task = proxmox.nodes(node).qemu(args.vmid).snapshot(args.snapshot).rollback.post()
+            upid = task["data"] if isinstance(task, dict) else task
+            wait_for_task(proxmox, node, upid)
+        print("Snapshot rollback complete")
 
-    print("Rolling back snapshot ...")
-    task = proxmox.nodes(node).qemu(args.vmid).snapshot(args.snapshot).rollback.post()
-    upid = task["data"] if isinstance(task, dict) else task
-    wait_for_task(proxmox, node, upid)
-    print("Snapshot rollback complete")
+        print("Ensuring VM is running ...")
+        with span("vm_start", vmid=args.vmid):
+            ensure_vm_running(proxmox, node, args.vmid)
 
-    print("Ensuring VM is running ...")
-    ensure_vm_running(proxmox, node, args.vmid)
 
+def connect_ssh(args, fresh_session=False):
     print("Waiting for SSH ...")
-    ssh_client = wait_for_ssh(args.vm_ip, args.vm_user, args.vm_password)
+    with span("transport", host=args.vm_ip, kind="ssh"):
+        ssh_client = wait_for_ssh(
+            args.vm_ip,
+            args.vm_user,
+            args.vm_password,
+            cipher=args.ssh_cipher,
+            compress=args.ssh_compress,
+            broker=args.ssh_broker,
+            port=args.vm_ssh_port,
+            fresh=fresh_session,
+        )
     print("SSH session established")
+    if args.ps_host:
+        attach_powershell_host(ssh_client)
+    return ssh_client
+
+
+def deploy_and_run(args, artifacts, remote_dir, fresh_session=False, ssh_client=None, on_line=None, manifest=None):
+    if ssh_client is None:
+        ssh_client = connect_ssh(args, fresh_session)
 
     try:
         print("Deploying artifacts ...")
-        deploy_artifacts(ssh_client, args.build_path, artifacts, remote_dir)
-        print("Launching remote executable ...")
-        result = run_remote_executable(
+        hash_cache = HashCache(args.hash_cache) if args.delta_sync else None
+        bundle_path = deploy_artifacts(
             ssh_client,
+            args.build_path,
+            artifacts,
             remote_dir,
-            args.executable,
-            args.program_args or [],
-            timeout=args.command_timeout,
-            detach=args.detach,
-            post_launch_wait=args.post_launch_wait,
+            hash_cache=hash_cache,
+            bundle=args.bundle,
+            channels=args.sftp_channels,
+            manifest=manifest,
         )
+        print("Launching remote executable ...")
+        with span("execute", executable=args.executable):
+            return run_remote_executable(
+                ssh_client,
+                remote_dir,
+                args.executable,
+                args.program_args or [],
+                timeout=args.command_timeout,
+                detach=args.detach,
+                post_launch_wait=args.post_launch_wait,
+                bundle_path=bundle_path,
+                stream=args.stream_output,
+                on_line=on_line,
+                tail_lines=args.stream_tail_lines,
+            )
     finally:
         ssh_client.close()
 
+
+def summarize_result(result):
+    # Streamed runs were parsed line by line while they ran; their StdOut is only a tail.
+    summary = result.pop("ParsedSummary", None)
+    if summary is None:
+        with span("parse"):
+            summary = parse_privacyfirst_output(result.get("StdOut") or "", result.get("StdErr") or "")
+    if "TimedOut" in result:
+        summary["timed_out"] = bool(result.get("TimedOut"))
+    return summary
+
+
+def print_result(result, summary):
     print("Exit code:", result.get("ExitCode"))
     print("STDOUT:\n" + (result.get("StdOut") or ""))
     print("STDERR:\n" + (result.get("StdErr") or ""))
@@ -370,9 +869,6 @@ def main():
     if "ApplicationPath" in result and result.get("ApplicationPath"):
         print("ApplicationPath:", result.get("ApplicationPath"))
 
-    summary = parse_privacyfirst_output(result.get("StdOut") or "", result.get("StdErr") or "")
-    if "TimedOut" in result:
-        summary["timed_out"] = bool(result.get("TimedOut"))
     if summary:
         print("Parsed Summary:")
         print(json.dumps(summary, indent=2))
@@ -381,6 +877,158 @@ def main():
         for line in result.get("Logs") or []:
             print("  " + line)
 
+
+def save_result(args, artifacts, entry, result=None, runner="ssh", manifest=None):
+    """Record one run in the result store; a broken store never fails the run."""
+    if args.no_results_db:
+        return None
+    try:
+        if manifest is None:
+            manifest = local_manifest(args.build_path, artifacts, HashCache(args.hash_cache)) if artifacts else {}
+        run_id = current_run_id()
+        run = ResultStore.shared(args.results_db).record_run(
+            entry,
+            run_id=run_id,
+            runner=runner,
+            executable=args.executable,
+            command_timeout=args.command_timeout,
+            manifest=manifest,
+            result=result,
+            phases=spans_for(run_id),
+        )
+    except Exception as exc:  # noqa: BLE001
+        print(f"Could not record the run in {args.results_db}: {exc}")
+        return None
+    print(f"Result stored as run {run} in {args.results_db}")
+    return run
+
+
+def cached_result(args):
+    """Stored passing run on this VM with the same artifact hashes, executable, snapshot, args and timeout, or None.
+
+    Like ``save_result``, a broken store never fails the run; it just runs on the VM.
+    """
+    if args.no_results_db or args.no_result_cache or args.detach:
+        return None
+    try:
+        artifacts = find_artifacts(args.build_path, args.files)
+    except FileNotFoundError:
+        return None  # the artifacts stage reports it
+    try:
+        with span("result_cache"):
+            manifest = local_manifest(args.build_path, artifacts, HashCache(args.hash_cache))
+            return ResultStore.shared(args.results_db).lookup(
+                manifest,
+                args.executable,
+                args.vmid,
+                args.snapshot,
+                args.program_args or [],
+                args.command_timeout,
+                since=parse_since(args.result_max_age),
+                include_failures=args.reuse_failed_results,
+            )
+    except Exception as exc:  # noqa: BLE001
+        print(f"Could not look up a stored result in {args.results_db}: {exc}")
+        return None
+
+
+def shutdown_vm(proxmox, node, vmid, action="shutdown", snapshot=None):
+    with span("shutdown", vmid=vmid, action=action):
+        upid = post_teardown(ProxmoxerRest(proxmox), node, vmid, action, snapshot)
+    print(f"VM {action}: {'started' if upid else 'already stopped'}")
+
+
+def hand_off_teardown(args, node, delay):
+    reply = schedule_teardown(
+        args.reaper,
+        args.proxmox_host,
+        args.proxmox_user,
+        args.proxmox_password,
+        node,
+        args.vmid,
+        args.teardown,
+        delay,
+        snapshot=args.snapshot,
+    )
+    due = time.strftime("%H:%M:%S", time.localtime(reply["due"]))
+    print(f"VM {args.teardown} handed to the reaper at {args.reaper}, due at {due}")
+
+
+def main():
+    args = parse_args()
+    timing = configure_timing(args.timings)
+
+    remote_dir = resolve_remote_dir(args)
+
+    cached = cached_result(args)
+    if cached is not None:
+        age = (time.time() - cached["started"]) / 60
+        print(f"Identical inputs ran as run {cached['id']} {age:.0f} minutes ago; reusing its result (--no-result-cache to rerun)")
+        print_result({"ExitCode": cached["exit_code"], "StdOut": cached["stdout"], "StdErr": cached["stderr"]}, cached["summary"])
+        timing.print_summary()
+        return
+
+    # Local preparation (artifact lookup, hashing) overlaps with login, rollback and boot.
+    graph = StageGraph()
+    graph.add("artifacts", lambda: find_artifacts(args.build_path, args.files))
+    if args.delta_sync:
+        graph.add(
+            "hashes",
+            lambda artifacts: local_manifest(args.build_path, artifacts, HashCache(args.hash_cache)),
+            deps=["artifacts"],
+        )
+    graph.add("proxmox", lambda: connect_proxmox(args))
+    graph.add("node", lookup_node, deps=["proxmox"])
+    if args.reaper:
+        # A teardown left pending by the previous run on this VM must not fire in the middle of this one.
+        graph.add("reaper", lambda: cancel_teardown(args.reaper, args.proxmox_host, args.vmid))
+    graph.add(
+        "vm",
+        lambda proxmox, node, *_: prepare_vm(proxmox, node, args),
+        deps=["proxmox", "node"] + (["reaper"] if args.reaper else []),
+    )
+    graph.add("ssh", lambda _: connect_ssh(args, fresh_session=True), deps=["vm"])
+    graph.add(
+        "run",
+        lambda ssh_client, artifacts, manifest=None: deploy_and_run(
+            args, artifacts, remote_dir, ssh_client=ssh_client, manifest=manifest
+        ),
+        deps=["ssh", "artifacts"] + (["hashes"] if args.delta_sync else []),
+    )
+    entry = {
+        "vmid": args.vmid,
+        "vm_ip": args.vm_ip,
+        "snapshot": args.snapshot,
+        "program_args": list(args.program_args or []),
+    }
+    started = time.time()
+    try:
+        results = graph.run()
+    except Exception as exc:
+        if graph.results.get("ssh") is not None:
+            graph.results["ssh"].close()
+        entry.update(status="error", error=str(exc), duration_seconds=round(time.time() - started, 1))
+        save_result(args, graph.results.get("artifacts"), entry, manifest=graph.results.get("hashes"))
+        raise
+    finally:
+        graph.report()
+    proxmox, node, result = results["proxmox"], results["node"], results["run"]
+    summary = summarize_result(result)
+    print_result(result, summary)
+    entry.update(
+        status=summary.get("overall_status", "unknown"),
+        exit_code=result.get("ExitCode"),
+        summary=summary,
+        duration_seconds=round(time.time() - started, 1),
+    )
+    save_result(args, results["artifacts"], entry, result, manifest=results.get("hashes"))
+
+    if args.reaper:
+        if args.auto_shutdown_seconds > 0 or args.shutdown_vm:
+            hand_off_teardown(args, node, args.keep_alive_seconds + args.auto_shutdown_seconds)
+        timing.print_summary()
+        return
+
     if args.keep_alive_seconds > 0:
         remaining = args.keep_alive_seconds
         print(f"Keeping session alive for {remaining} seconds ...")
@@ -402,11 +1050,12 @@ def main():
             remaining -= chunk
             if remaining > 0:
                 print(f"  {remaining} seconds remaining before shutdown ...")
-        print("Initiating VM shutdown ...")
-        proxmox.nodes(node).qemu(args.vmid).status.shutdown.post()
+        print(f"Initiating VM {args.teardown} ...")
+        shutdown_vm(proxmox, node, args.vmid, args.teardown, args.snapshot)
     elif args.shutdown_vm:
-        print("Shutting down VM ...")
-        proxmox.nodes(node).qemu(args.vmid).status.shutdown.post()
+        print(f"Tearing down VM ({args.teardown}) ...")
+        shutdown_vm(proxmox, node, args.vmid, args.teardown, args.snapshot)
+    timing.print_summary()
 
 
 if __name__ == "__main__":
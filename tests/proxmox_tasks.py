@@ -0,0 +1,129 @@
+import time
+
+
+def upid_node(upid: str, default=None):
+    # UPID:<node>:<pid>:<pstart>:<starttime>:<type>:<id>:<user>:
+    parts = upid.split(":")
+    if len(parts) > 2 and parts[0] == "UPID":
+        return parts[1]
+    return default
+
+
+def upid_label(upid: str) -> str:
+    parts = upid.split(":")
+    if len(parts) > 6 and parts[0] == "UPID":
+        return f"{parts[5]}:{parts[6]}" if parts[6] else parts[5]
+    return upid
+
+
+class TaskWaiter:
+    """Track one or more Proxmox tasks in a single loop, tailing their logs as they run.
+
+    Each task starts with tight polling (``min_interval``) that stretches by
+    ``backoff`` whenever a poll brings no new log output, capped at ``max_interval``.
+    ``client`` uses ProxmoxClient's path-based ``get`` (see ``ProxmoxerRest``).
+    """
+
+    def __init__(
+        self,
+        client,
+        node=None,
+        *,
+        min_interval: float = 0.25,
+        max_interval: float = 5.0,
+        backoff: float = 1.6,
+        show_log: bool = True,
+    ):
+        self.client = client
+        self.node = node
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.show_log = show_log
+        self._tasks = {}
+
+    def add(self, upid: str, label=None):
+        node = upid_node(upid, self.node)
+        if node is None:
+            raise ValueError(f"Cannot determine node for task {upid}")
+        self._tasks[upid] = {
+            "node": node,
+            "label": label or upid_label(upid),
+            "offset": 0,
+            "interval": self.min_interval,
+            "next_poll": 0.0,
+            "started": time.time(),
+            "state": None,
+            "done": False,
+        }
+        return self
+
+    def wait(self, timeout: int = 600, raise_on_failure: bool = True):
+        deadline = time.time() + timeout
+        while True:
+            pending = [task for task in self._tasks.values() if not task["done"]]
+            if not pending:
+                break
+            now = time.time()
+            if now >= deadline:
+                labels = ", ".join(task["label"] for task in pending)
+                raise TimeoutError(f"Proxmox task timed out: {labels}")
+            for upid, task in self._tasks.items():
+                if not task["done"] and task["next_poll"] <= now:
+                    self._poll(upid, task)
+            upcoming = [task["next_poll"] for task in self._tasks.values() if not task["done"]]
+            if upcoming:
+                time.sleep(max(0.0, min(min(upcoming), deadline) - time.time()))
+
+        results = {upid: self._result(task) for upid, task in self._tasks.items()}
+        failed = [result for result in results.values() if result["exitstatus"] != "OK"]
+        if raise_on_failure and failed:
+            details = "; ".join(f"{result['label']}: {result['exitstatus']}" for result in failed)
+            raise RuntimeError(f"Proxmox task failed: {details}")
+        return results
+
+    def _poll(self, upid: str, task):
+        base = f"/nodes/{task['node']}/tasks/{upid}"
+        status = self.client.get(f"{base}/status")
+        state = status.get("status")
+        if state != task["state"]:
+            print(f"  Proxmox task state: {state} ({task['label']})")
+            task["state"] = state
+        # Read the log after the status so the final lines of a stopped task are included.
+        got_output = self._tail_log(base, task)
+        if state == "stopped":
+            task["done"] = True
+            task["exitstatus"] = status.get("exitstatus", "OK")
+            task["finished"] = time.time()
+            return
+        if got_output:
+            task["interval"] = self.min_interval
+        else:
+            task["interval"] = min(self.max_interval, task["interval"] * self.backoff)
+        task["next_poll"] = time.time() + task["interval"]
+
+    def _tail_log(self, base: str, task) -> bool:
+        lines = self.client.get(f"{base}/log", params={"start": task["offset"], "limit": 500}) or []
+        # PVE answers an empty log with a single {"n": 1, "t": "no content"} placeholder.
+        lines = [entry for entry in lines if entry.get("t") != "no content"]
+        for entry in lines:
+            task["offset"] = max(task["offset"], int(entry.get("n", task["offset"])))
+            text = entry.get("t", "")
+            if self.show_log and text:
+                print(f"    [{task['label']}] {text}")
+        return bool(lines)
+
+    @staticmethod
+    def _result(task):
+        return {
+            "label": task["label"],
+            "exitstatus": task.get("exitstatus", "OK"),
+            "seconds": round(task.get("finished", time.time()) - task["started"], 2),
+        }
+
+
+def wait_for_tasks(client, node, upids, timeout: int = 600, raise_on_failure: bool = True, **kwargs):
+    waiter = TaskWaiter(client, node, **kwargs)
+    for upid in upids:
+        waiter.add(upid)
+    return waiter.wait(timeout=timeout, raise_on_failure=raise_on_failure)
@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+
+import proxmoxer
+from proxmoxer.backends.https import ProxmoxHTTPAuth, ProxmoxHTTPAuthBase
+
+DEFAULT_TICKET_CACHE = os.path.join(os.path.expanduser("~"), ".privacyfirst", "proxmox_tickets.json")
+# PVE tickets are valid for two hours; renew after one (as proxmoxer does) and never
+# hand out a ticket in its last five minutes.
+TICKET_LIFETIME = 7200
+TICKET_RENEW_AFTER = 3600
+TICKET_SAFETY_MARGIN = 300
+
+
+def ticket_age(entry) -> float:
+    return time.time() - entry["issued"]
+
+
+def needs_renewal(entry) -> bool:
+    return ticket_age(entry) >= TICKET_RENEW_AFTER
+
+
+class TicketCache:
+    """Proxmox auth tickets and CSRF tokens shared across runner processes via a JSON file."""
+
+    def __init__(self, path: str = DEFAULT_TICKET_CACHE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(host: str, user: str) -> str:
+        return f"{user}@{host}"
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            json.dump(entries, handle)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+
+    def get(self, host: str, user: str):
+        with self._lock:
+            entry = self._read().get(self._key(host, user))
+        if not entry or ticket_age(entry) >= TICKET_LIFETIME - TICKET_SAFETY_MARGIN:
+            return None
+        return entry
+
+    def put(self, host: str, user: str, ticket: str, csrf: str, issued=None):
+        entry = {"ticket": ticket, "csrf": csrf, "issued": issued or time.time()}
+        with self._lock:
+            entries = self._read()
+            entries[self._key(host, user)] = entry
+            self._write(entries)
+        return entry
+
+    def drop(self, host: str, user: str):
+        with self._lock:
+            entries = self._read()
+            if entries.pop(self._key(host, user), None) is not None:
+                self._write(entries)
+
+
+class CachedTicketAuth(ProxmoxHTTPAuth):
+    """proxmoxer ticket auth seeded from a cache entry instead of a ``/access/ticket`` login.
+
+    The first request goes out with the cached PVEAuthCookie. If PVE answers 401 (ticket
+    revoked, host restarted), one password login replaces the ticket and the request is
+    sent again. Every new ticket, renewals included, is written back to ``cache``.
+    """
+
+    def __init__(self, username, password, entry, cache, host, base_url="", **kwargs):
+        ProxmoxHTTPAuthBase.__init__(self, **kwargs)
+        self.base_url = base_url
+        self.username = username
+        self._password = password
+        self._cache = cache
+        self._host = host
+        self.pve_auth_ticket = entry["ticket"]
+        self.csrf_prevention_token = entry["csrf"]
+        self.birth_time = time.monotonic() - ticket_age(entry)
+
+    def _get_new_tokens(self, password=None, otp=None, otptype=None):
+        try:
+            super()._get_new_tokens(password=password, otp=otp, otptype=otptype)
+        except proxmoxer.AuthenticationError:
+            if password is not None:
+                raise
+            # Renewing from a ticket PVE no longer knows fails; log in again.
+            super()._get_new_tokens(password=self._password)
+        self._cache.put(self._host, self.username, self.pve_auth_ticket, self.csrf_prevention_token)
+
+    def __call__(self, req):
+        req = super().__call__(req)
+        req.register_hook("response", self._retry_on_401)
+        return req
+
+    def _retry_on_401(self, response, **kwargs):
+        if response.status_code != 401 or getattr(response.request, "_ticket_retried", False):
+            return response
+        self._cache.drop(self._host, self.username)
+        self._get_new_tokens(password=self._password)
+        response.close()
+        retry = response.request.copy()
+        retry._ticket_retried = True
+        retry.headers.pop("Cookie", None)
+        retry.prepare_cookies(self.get_cookies())
+        if retry.method != "GET":
+            retry.headers["CSRFPreventionToken"] = self.csrf_prevention_token
+        again = response.connection.send(retry, **kwargs)
+        again.history.append(response)
+        again.request = retry
+        return again
+
+
+def connect_cached(host, user, password, cache, verify_ssl=False):
+    """``proxmoxer.ProxmoxAPI`` for ``user`` on ``host`` that reuses a cached ticket without logging in.
+
+    Without a usable cache entry this is a plain password login whose ticket is then cached.
+    """
+    entry = cache.get(host, user)
+    if entry is None:
+        proxmox = proxmoxer.ProxmoxAPI(host, user=user, password=password, verify_ssl=verify_ssl)
+        ticket, csrf = proxmox.get_tokens()
+        cache.put(host, user, ticket, csrf)
+        return proxmox
+    # proxmoxer logs in while it builds a password-auth API, so build it with a placeholder
+    # API token (no request) and swap in the cached ticket before the first call.
+    proxmox = proxmoxer.ProxmoxAPI(host, user=user, token_name="cached", token_value="", verify_ssl=verify_ssl)
+    backend = proxmox._backend
+    auth = CachedTicketAuth(user, password, entry, cache, host, base_url=backend.get_base_url(), verify_ssl=verify_ssl)
+    backend.auth = auth
+    proxmox._store["session"].auth = auth
+    return proxmox
@@ -0,0 +1,85 @@
+import time
+
+from proxmox_tasks import TaskWaiter
+
+WARM_SUFFIX = "-warm"
+
+
+def warm_snapshot_name(snapshot: str) -> str:
+    return f"{snapshot}{WARM_SUFFIX}"
+
+
+def find_snapshot(client, node, vmid, name):
+    for entry in client.get(f"/nodes/{node}/qemu/{vmid}/snapshot") or []:
+        if entry.get("name") == name:
+            return entry
+    return None
+
+
+def warm_snapshot_is_current(client, node, vmid, snapshot: str) -> bool:
+    """True when the RAM-state snapshot exists, has vmstate and is newer than the cold one."""
+    warm = find_snapshot(client, node, vmid, warm_snapshot_name(snapshot))
+    if warm is None or not int(warm.get("vmstate", 0) or 0):
+        return False
+    cold = find_snapshot(client, node, vmid, snapshot)
+    return cold is None or int(warm.get("snaptime", 0)) >= int(cold.get("snaptime", 0))
+
+
+def _wait(client, node, upid, timeout=600):
+    TaskWaiter(client, node, show_log=False).add(upid).wait(timeout=timeout)
+
+
+def _wait_running(client, node, vmid, timeout=180):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if client.get(f"/nodes/{node}/qemu/{vmid}/status/current").get("status") == "running":
+            return
+        time.sleep(1)
+    raise TimeoutError(f"VM {vmid} failed to reach running state")
+
+
+def prepare_warm_snapshot(client, node, vmid, snapshot: str, wait_ready, timeout=1800):
+    """Boot ``snapshot`` once, wait until ``wait_ready()`` returns and save the running guest with RAM.
+
+    ``wait_ready`` blocks until the runner's transport (SSH, WinRM, ...) answers, so
+    a later rollback resumes a guest that is already listening.
+    """
+    warm = warm_snapshot_name(snapshot)
+    started = time.time()
+    print(f"  Building warm snapshot {warm} from {snapshot} ...")
+    _wait(client, node, client.post(f"/nodes/{node}/qemu/{vmid}/snapshot/{snapshot}/rollback"))
+    status = client.get(f"/nodes/{node}/qemu/{vmid}/status/current")
+    if status.get("status") != "running":
+        _wait(client, node, client.post(f"/nodes/{node}/qemu/{vmid}/status/start"))
+    wait_ready()
+    if find_snapshot(client, node, vmid, warm) is not None:
+        _wait(client, node, client.delete(f"/nodes/{node}/qemu/{vmid}/snapshot/{warm}"))
+    upid = client.post(
+        f"/nodes/{node}/qemu/{vmid}/snapshot",
+        data_body={
+            "snapname": warm,
+            "vmstate": 1,
+            "description": f"Running {snapshot} with RAM state, maintained by the PrivacyFirst runners",
+        },
+    )
+    _wait(client, node, upid, timeout=timeout)
+    print(f"  Warm snapshot {warm} saved after {time.time() - started:.0f}s")
+
+
+def warm_resume(client, node, vmid, snapshot: str, wait_ready, refresh: bool = False) -> float:
+    """Roll back to the RAM-state twin of ``snapshot`` (building it if missing or stale).
+
+    PVE resumes a guest restored from a vmstate snapshot on its own, so there is
+    no boot to wait for. Returns the seconds spent on the rollback itself.
+    """
+    if refresh or not warm_snapshot_is_current(client, node, vmid, snapshot):
+        prepare_warm_snapshot(client, node, vmid, snapshot, wait_ready)
+    started = time.time()
+    _wait(client, node, client.post(f"/nodes/{node}/qemu/{vmid}/snapshot/{warm_snapshot_name(snapshot)}/rollback"))
+    status = client.get(f"/nodes/{node}/qemu/{vmid}/status/current")
+    if status.get("status") != "running":
+        _wait(client, node, client.post(f"/nodes/{node}/qemu/{vmid}/status/start"))
+    elif status.get("qmpstatus") == "paused":
+        _wait(client, node, client.post(f"/nodes/{node}/qemu/{vmid}/status/resume"))
+    _wait_running(client, node, vmid)
+    return time.time() - started
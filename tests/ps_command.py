@@ -0,0 +1,22 @@
+import base64
+
+# Flags every runner starts Windows PowerShell with.
+POWERSHELL_FLAGS = ("-NoLogo", "-NoProfile", "-ExecutionPolicy", "Bypass")
+
+
+def encode_powershell(script: str) -> str:
+    """``script`` as ``-EncodedCommand`` takes it: base64 of its UTF-16LE bytes."""
+    return base64.b64encode(script.encode("utf-16le")).decode("ascii")
+
+
+def powershell_args(script: str, non_interactive=False) -> list:
+    """``powershell.exe`` arguments that run ``script``."""
+    flags = list(POWERSHELL_FLAGS)
+    if non_interactive:
+        flags.insert(2, "-NonInteractive")
+    return flags + ["-EncodedCommand", encode_powershell(script)]
+
+
+def powershell_command(script: str, non_interactive=False) -> str:
+    """One command line that runs ``script``, e.g. for an SSH exec request."""
+    return " ".join(["powershell.exe"] + powershell_args(script, non_interactive))
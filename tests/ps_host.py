@@ -0,0 +1,135 @@
+import hashlib
+import itertools
+import json
+import threading
+import weakref
+
+from ps_command import powershell_command
+
+# Long-lived PowerShell on the guest: one JSON request per stdin line, scripts compiled
+# once and kept by SHA-256. Lines a script writes straight to [Console]::Out (the "O|"
+# stream protocol) pass through as they happen; the reply follows as one "H|<json>" line.
+HOST_SCRIPT = r"""
+$scripts = @{}
+$stdin = [Console]::In
+$console = [Console]::Out
+while ($null -ne ($line = $stdin.ReadLine())) {
+    if (-not $line.Trim()) { continue }
+    $request = $line | ConvertFrom-Json
+    if ($request.op -eq 'exit') { break }
+    if ($request.script) { $scripts[$request.hash] = [ScriptBlock]::Create($request.script) }
+    $reply = @{ id = $request.id; missing = $false; exit = 0; output = ''; error = '' }
+    $block = $scripts[$request.hash]
+    if ($null -eq $block) {
+        $reply.missing = $true
+        $reply.exit = -1
+    } else {
+        try {
+            $items = @(& $block 2>&1)
+            $errors = @($items | Where-Object { $_ -is [System.Management.Automation.ErrorRecord] })
+            $reply.output = (@($items | Where-Object { $_ -isnot [System.Management.Automation.ErrorRecord] }) | Out-String).TrimEnd()
+            if ($errors.Count -gt 0) { $reply.error = ($errors | Out-String).TrimEnd() }
+        } catch {
+            $reply.error = $_.ToString()
+            $reply.exit = 1
+        }
+    }
+    $console.WriteLine('H|' + ($reply | ConvertTo-Json -Compress))
+    $console.Flush()
+}
+"""
+HOST_COMMAND = powershell_command(HOST_SCRIPT, non_interactive=True)
+HOST_MARKER = "$scripts[$request.hash]"
+
+
+def script_hash(ps_script: str) -> str:
+    return hashlib.sha256(ps_script.encode("utf-8")).hexdigest()
+
+
+class PowerShellHost:
+    """One PowerShell process per SSH transport that runs script after script without restarting.
+
+    ``run`` has the shape of a one-shot ``powershell.exe -EncodedCommand``: it returns
+    ``(stdout, stderr, exit_status)``. A script is sent in full only the first time;
+    later runs of the same text send its hash. Scripts run in a child scope, so they
+    must not call ``exit``. Requests on one host are served one at a time.
+    """
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._channel = None
+        self._reader = None
+        self._installed = set()
+        self.starts = 0
+
+    def _start(self):
+        channel = self._transport.open_session()
+        channel.exec_command(HOST_COMMAND)
+        self._channel = channel
+        self._reader = channel.makefile("rb")
+        self._installed.clear()
+        self.starts += 1
+
+    def _alive(self) -> bool:
+        return self._channel is not None and not self._channel.closed and not self._channel.exit_status_ready()
+
+    def run(self, ps_script, on_line=None):
+        """Run ``ps_script``; with ``on_line`` every stdout line is passed on as it arrives."""
+        digest = script_hash(ps_script)
+        lines = []
+        emit = on_line or lines.append
+        with self._lock:
+            if not self._alive():
+                self._start()
+            reply = self._request(digest, None if digest in self._installed else ps_script, emit)
+            if reply.get("missing"):
+                reply = self._request(digest, ps_script, emit)
+            self._installed.add(digest)
+        for line in (reply.get("output") or "").splitlines():
+            emit(line)
+        return "\n".join(lines), reply.get("error") or "", int(reply.get("exit", 0))
+
+    def _request(self, digest, ps_script, emit):
+        request = {"id": next(self._ids), "hash": digest}
+        if ps_script is not None:
+            request["script"] = ps_script
+        try:
+            self._channel.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            for raw in iter(self._reader.readline, b""):
+                line = raw.decode(errors="ignore").rstrip("\r\n")
+                if line.startswith("H|"):
+                    return json.loads(line[2:])
+                emit(line)
+        except OSError as exc:
+            self._channel = None
+            raise RuntimeError(f"PowerShell host connection failed: {exc}") from exc
+        err = b""
+        while self._channel.recv_stderr_ready():
+            err += self._channel.recv_stderr(65536)
+        self._channel = None
+        raise RuntimeError(f"PowerShell host exited: {err.decode(errors='ignore').strip()}")
+
+    def close(self):
+        with self._lock:
+            if self._alive():
+                try:
+                    self._channel.sendall(b'{"op": "exit"}\n')
+                except OSError:
+                    pass
+                self._channel.close()
+            self._channel = None
+
+
+_hosts = weakref.WeakKeyDictionary()
+_hosts_lock = threading.Lock()
+
+
+def host_for(transport) -> PowerShellHost:
+    """The PowerShell host of ``transport``, started on its first run and gone with the transport."""
+    with _hosts_lock:
+        host = _hosts.get(transport)
+        if host is None:
+            host = _hosts[transport] = PowerShellHost(transport)
+        return host
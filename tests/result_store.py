@@ -0,0 +1,350 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_RESULT_DB = os.path.join(os.path.expanduser("~"), ".privacyfirst", "results.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT,
+    runner TEXT,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    vmid INTEGER,
+    vm_ip TEXT,
+    snapshot TEXT,
+    executable TEXT,
+    program_args TEXT,
+    command_timeout INTEGER,
+    build_hash TEXT,
+    status TEXT,
+    exit_code INTEGER,
+    timed_out INTEGER,
+    runtime_error TEXT,
+    error TEXT,
+    summary TEXT,
+    stdout BLOB,
+    stderr BLOB
+);
+CREATE INDEX IF NOT EXISTS runs_build ON runs (build_hash, started);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status, started);
+CREATE INDEX IF NOT EXISTS runs_runtime_error ON runs (runtime_error, started);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts (run);
+CREATE INDEX IF NOT EXISTS artifacts_sha256 ON artifacts (sha256);
+CREATE TABLE IF NOT EXISTS phases (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    span TEXT NOT NULL,
+    start REAL,
+    seconds REAL,
+    ok INTEGER,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS phases_run ON phases (run);
+"""
+# Columns added after the first release; older databases get them on open.
+ADDED_COLUMNS = {"command_timeout": "INTEGER", "timed_out": "INTEGER"}
+SUMMARY_COLUMNS = ("id", "started", "runner", "vmid", "snapshot", "build_hash", "status", "runtime_error", "duration")
+
+
+def build_hash(manifest) -> str:
+    """One SHA-256 for a set of artifacts: hash of the sorted ``name:sha256`` lines."""
+    text = "\n".join(f"{name}:{digest}" for name, digest in sorted(manifest.items()))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compress_log(text):
+    return zlib.compress((text or "").encode("utf-8"), 6) if text else None
+
+
+def decompress_log(blob):
+    return zlib.decompress(blob).decode("utf-8", errors="replace") if blob else ""
+
+
+def runtime_error(summary) -> str:
+    if summary.get("runtime_error"):
+        return summary["runtime_error"]
+    if summary.get("missing_runtime"):
+        return "dotnet_missing"
+    return None
+
+
+def parse_since(text):
+    """Epoch seconds from ``7d``/``12h``/``30m`` ago or an ISO date such as ``2026-10-01``."""
+    if text is None:
+        return None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([dhm])", text)
+    if match:
+        seconds = float(match.group(1)) * {"d": 86400, "h": 3600, "m": 60}[match.group(2)]
+        return time.time() - seconds
+    return time.mktime(time.strptime(text, "%Y-%m-%d"))
+
+
+class ResultStore:
+    """Run results in one SQLite file; safe to share between the threads of one process."""
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=DEFAULT_RESULT_DB):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        # WAL lets the query CLI read while runners and the job daemon write.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(SCHEMA)
+        existing = {row["name"] for row in self._db.execute("PRAGMA table_info(runs)")}
+        with self._db:
+            for name, kind in ADDED_COLUMNS.items():
+                if name not in existing:
+                    self._db.execute(f"ALTER TABLE runs ADD COLUMN {name} {kind}")
+
+    @classmethod
+    def shared(cls, path=DEFAULT_RESULT_DB):
+        with cls._shared_lock:
+            store = cls._shared.get(path)
+            if store is None:
+                store = cls._shared[path] = cls(path)
+            return store
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record_run(
+        self, entry, *, run_id=None, runner=None, executable=None, command_timeout=None, manifest=None, result=None, phases=()
+    ):
+        """Store one run; ``entry`` is a matrix-style job entry (vmid, snapshot, status, summary, ...)."""
+        summary = entry.get("summary") or {}
+        result = result or {}
+        manifest = manifest or {}
+        finished = time.time()
+        duration = entry.get("duration_seconds")
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO runs (run_id, runner, started, finished, duration, vmid, vm_ip, snapshot, executable,"
+                " program_args, command_timeout, build_hash, status, exit_code, timed_out, runtime_error, error, summary,"
+                " stdout, stderr) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run_id,
+                    runner,
+                    finished - duration if duration is not None else None,
+                    finished,
+                    duration,
+                    entry.get("vmid"),
+                    entry.get("vm_ip"),
+                    entry.get("snapshot"),
+                    executable,
+                    json.dumps(entry.get("program_args") or []),
+                    command_timeout,
+                    build_hash(manifest) if manifest else None,
+                    entry.get("status"),
+                    entry.get("exit_code"),
+                    int(bool(summary.get("timed_out"))),
+                    runtime_error(summary),
+                    entry.get("error"),
+                    json.dumps(summary),
+                    compress_log(result.get("StdOut")),
+                    compress_log(result.get("StdErr")),
+                ),
+            )
+            run = cursor.lastrowid
+            self._db.executemany(
+                "INSERT INTO artifacts (run, name, sha256) VALUES (?, ?, ?)",
+                [(run, name, digest) for name, digest in sorted(manifest.items())],
+            )
+            self._db.executemany(
+                "INSERT INTO phases (run, span, start, seconds, ok, bytes) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (run, record["span"], record.get("start"), record.get("seconds"), int(record.get("ok", True)), record.get("bytes"))
+                    for record in phases
+                ],
+            )
+        return run
+
+    @staticmethod
+    def _filters(build=None, status=None, runtime_error=None, vmid=None, since=None, artifact=None):
+        clauses, params = [], []
+        if build:
+            # Prefix match on the hash keeps the build index usable.
+            clauses.append("build_hash >= ? AND build_hash < ?")
+            params += [build, build + "\uffff"]
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if runtime_error:
+            clauses.append("runtime_error = ?")
+            params.append(runtime_error)
+        if vmid is not None:
+            clauses.append("vmid = ?")
+            params.append(vmid)
+        if since is not None:
+            clauses.append("started >= ?")
+            params.append(since)
+        if artifact:
+            clauses.append("id IN (SELECT run FROM artifacts WHERE sha256 = ?)")
+            params.append(artifact)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(self, limit=50, **filters):
+        where, params = self._filters(**filters)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM runs{where} ORDER BY started DESC LIMIT ?",
+                params + [limit],
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def builds(self, limit=50, **filters):
+        where, params = self._filters(**filters)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT build_hash, COUNT(*) AS runs,"
+                " SUM(status = 'pass') AS passed, SUM(status != 'pass') AS failed,"
+                " MIN(started) AS first_seen, MAX(started) AS last_seen,"
+                " GROUP_CONCAT(DISTINCT runtime_error) AS runtime_errors"
+                f" FROM runs{where} GROUP BY build_hash ORDER BY last_seen DESC LIMIT ?",
+                params + [limit],
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def lookup(
+        self, manifest, executable, vmid, snapshot, program_args, command_timeout, since=None, include_failures=False
+    ):
+        """Newest passing run of exactly these inputs on VM ``vmid``, or None.
+
+        Runs that timed out, errored or ended unknown are never reused; ``include_failures`` also
+        accepts runs that completed with status ``fail``.
+        """
+        statuses = ("pass", "fail") if include_failures else ("pass",)
+        clauses = (
+            "build_hash = ? AND executable = ? AND vmid = ? AND snapshot = ? AND program_args = ? AND command_timeout = ?"
+            f" AND status IN ({', '.join('?' * len(statuses))}) AND timed_out = 0"
+        )
+        params = [build_hash(manifest), executable, vmid, snapshot, json.dumps(list(program_args)), command_timeout, *statuses]
+        if since is not None:
+            clauses += " AND started >= ?"
+            params.append(since)
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT id FROM runs WHERE {clauses} ORDER BY started DESC LIMIT 1", params
+            ).fetchone()
+        return self.get(row["id"]) if row else None
+
+    def prune(self, before):
+        """Delete runs started before ``before`` (epoch seconds); returns how many went."""
+        with self._lock, self._db:
+            return self._db.execute("DELETE FROM runs WHERE started < ?", (before,)).rowcount
+
+    def get(self, run):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM runs WHERE id = ?", (run,)).fetchone()
+            if row is None:
+                return None
+            artifacts = self._db.execute("SELECT name, sha256 FROM artifacts WHERE run = ? ORDER BY name", (run,)).fetchall()
+            phases = self._db.execute(
+                "SELECT span, seconds, ok, bytes FROM phases WHERE run = ? ORDER BY start", (run,)
+            ).fetchall()
+        data = dict(row)
+        data["program_args"] = json.loads(data["program_args"] or "[]")
+        data["summary"] = json.loads(data["summary"] or "{}")
+        data["stdout"] = decompress_log(data["stdout"])
+        data["stderr"] = decompress_log(data["stderr"])
+        data["artifacts"] = {item["name"]: item["sha256"] for item in artifacts}
+        data["phases"] = [dict(item) for item in phases]
+        return data
+
+
+def format_time(epoch):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(epoch)) if epoch else "-"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query stored PrivacyFirst run results")
+    parser.add_argument("--db", default=DEFAULT_RESULT_DB, help="Result database")
+    sub = parser.add_subparsers(dest="command_name", required=True)
+
+    def add_filters(target):
+        target.add_argument("--build", help="Build hash or prefix")
+        target.add_argument("--artifact", help="SHA-256 of one artifact")
+        target.add_argument("--status", help="pass, fail, error or unknown")
+        target.add_argument("--runtime-error", help="e.g. hostfxr_missing or dotnet_missing")
+        target.add_argument("--vmid", type=int)
+        target.add_argument("--since", help="7d, 12h, 30m or YYYY-MM-DD")
+        target.add_argument("--limit", type=int, default=50)
+        target.add_argument("--json", action="store_true", help="Print JSON instead of a table")
+
+    add_filters(sub.add_parser("query", help="List runs, newest first"))
+    add_filters(sub.add_parser("builds", help="Pass/fail counts per build hash"))
+    show = sub.add_parser("show", help="Print one run with its phases and logs")
+    show.add_argument("run", type=int)
+    prune = sub.add_parser("prune", help="Delete old runs so they are no longer reused or reported")
+    prune.add_argument("--older-than", required=True, help="7d, 12h, 30m or YYYY-MM-DD")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    store = ResultStore(args.db)
+    if args.command_name == "show":
+        data = store.get(args.run)
+        if data is None:
+            raise SystemExit(f"No run {args.run} in {args.db}")
+        stdout, stderr = data.pop("stdout"), data.pop("stderr")
+        print(json.dumps(data, indent=2))
+        print("STDOUT:\n" + stdout)
+        print("STDERR:\n" + stderr)
+        return
+    if args.command_name == "prune":
+        print(f"Deleted {store.prune(parse_since(args.older_than))} runs from {args.db}")
+        return
+    filters = {
+        "build": args.build,
+        "artifact": args.artifact,
+        "status": args.status,
+        "runtime_error": args.runtime_error,
+        "vmid": args.vmid,
+        "since": parse_since(args.since),
+    }
+    started = time.perf_counter()
+    if args.command_name == "query":
+        rows = store.query(limit=args.limit, **filters)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        for row in rows if not args.json else []:
+            print(
+                f"  {row['id']:>6} {format_time(row['started'])} {row['runner'] or '-':<7} vm {row['vmid'] or '-':<5} "
+                f"{(row['build_hash'] or '-')[:12]:<12} {row['status'] or '-':<7} {row['runtime_error'] or ''}"
+            )
+    else:
+        rows = store.builds(limit=args.limit, **filters)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        for row in rows if not args.json else []:
+            print(
+                f"  {(row['build_hash'] or '-')[:12]:<12} {row['runs']:>4} runs {row['passed']:>4} pass {row['failed']:>4} other"
+                f"  last {format_time(row['last_seen'])}  {row['runtime_errors'] or ''}"
+            )
+    if not args.json:
+        print(f"{len(rows)} rows in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+PHASES = ["login", "rollback", "vm_start", "transport", "upload", "execute", "parse", "shutdown"]
+DEFAULT_TOLERANCE = 0.2
+# Runners that can answer from the result store; bench makes them really run every iteration.
+RESULT_CACHE_RUNNERS = ("proxmox_ssh_runner.py",)
+
+
+class SpanRecorder:
+    """Collect named timing spans for one run and append them to a JSON lines file.
+
+    Each line is ``{"run", "span", "start", "seconds", "ok", ...attributes}``. Spans
+    may be opened from several threads at once (matrix runs, stage graphs).
+    """
+
+    def __init__(self, path=None, run_id=None):
+        self.path = path
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        record = {"run": getattr(_scope, "run_id", None) or self.run_id, "span": name, "start": time.time()}
+        record.update(attributes)
+        started = time.perf_counter()
+        try:
+            yield record
+            record["ok"] = True
+        except BaseException:
+            record["ok"] = False
+            raise
+        finally:
+            record["seconds"] = round(time.perf_counter() - started, 4)
+            if "bytes" in record and record["seconds"] > 0:
+                record["mb_per_s"] = round(record["bytes"] / 1048576 / record["seconds"], 2)
+            self._write(record)
+
+    def _write(self, record):
+        with self._lock:
+            self.spans.append(record)
+            if self.path:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as handle:
+                    handle.write(json.dumps(record) + "\n")
+
+    def print_summary(self):
+        if not self.spans:
+            return
+        print("Phase timings:")
+        for record in sorted(self.spans, key=lambda item: item["start"]):
+            extra = f", {record['mb_per_s']} MB/s" if "mb_per_s" in record else ""
+            status = "" if record["ok"] else " (failed)"
+            print(f"  {record['span']:<10} {record['seconds']:8.2f}s{extra}{status}")
+
+
+# The runners share one recorder per process; it only writes a file once configured.
+recorder = SpanRecorder()
+# Long-lived processes (the job daemon) file each job's spans under its own run id.
+_scope = threading.local()
+
+
+def configure(path=None, run_id=None):
+    global recorder
+    recorder = SpanRecorder(path, run_id)
+    return recorder
+
+
+def span(name: str, **attributes):
+    return recorder.span(name, **attributes)
+
+
+def current_run_id():
+    return getattr(_scope, "run_id", None) or recorder.run_id
+
+
+def spans_for(run_id):
+    with recorder._lock:
+        return [record for record in recorder.spans if record["run"] == run_id]
+
+
+@contextmanager
+def run_scope(run_id):
+    """Record spans opened by this thread under ``run_id`` instead of the process-wide run."""
+    previous = getattr(_scope, "run_id", None)
+    _scope.run_id = run_id
+    try:
+        yield
+    finally:
+        _scope.run_id = previous
+
+
+# ---------------- aggregation ----------------
+def load_spans(path):
+    with open(path, "r", encoding="utf-8") as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    # Linear interpolation between closest ranks.
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(spans):
+    """Per-phase p50/p95/max over runs; a phase entered several times in one run is summed."""
+    per_run = {}
+    for record in spans:
+        if not record.get("ok", True):
+            continue
+        phases = per_run.setdefault(record["run"], {})
+        phases[record["span"]] = phases.get(record["span"], 0.0) + record["seconds"]
+    samples = {}
+    for phases in per_run.values():
+        for name, seconds in phases.items():
+            samples.setdefault(name, []).append(seconds)
+    order = {name: index for index, name in enumerate(PHASES)}
+    return {
+        name: {
+            "runs": len(values),
+            "p50": round(percentile(values, 0.5), 3),
+            "p95": round(percentile(values, 0.95), 3),
+            "max": round(max(values), 3),
+        }
+        for name, values in sorted(samples.items(), key=lambda item: (order.get(item[0], len(order)), item[0]))
+    }
+
+
+def find_regressions(summary, baseline, tolerance=DEFAULT_TOLERANCE, min_seconds=0.5):
+    """Phases whose p50 or p95 grew by more than ``tolerance`` (and ``min_seconds``) over the baseline."""
+    regressions = []
+    for name, stats in summary.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        for key in ("p50", "p95"):
+            before, after = reference[key], stats[key]
+            if after - before > min_seconds and after > before * (1 + tolerance):
+                regressions.append({"phase": name, "stat": key, "baseline": before, "current": after})
+    return regressions
+
+
+def print_summary(summary):
+    print(f"  {'phase':<10} {'runs':>4} {'p50':>8} {'p95':>8} {'max':>8}")
+    for name, stats in summary.items():
+        print(f"  {name:<10} {stats['runs']:>4} {stats['p50']:>7.2f}s {stats['p95']:>7.2f}s {stats['max']:>7.2f}s")
+
+
+def report(summary, baseline_path=None, save_baseline=None, tolerance=DEFAULT_TOLERANCE):
+    print_summary(summary)
+    status = 0
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path, "r", encoding="utf-8") as handle:
+            baseline = json.load(handle)
+        regressions = find_regressions(summary, baseline, tolerance)
+        for item in regressions:
+            print(
+                f"  REGRESSION {item['phase']} {item['stat']}: "
+                f"{item['baseline']:.2f}s -> {item['current']:.2f}s"
+            )
+        if regressions:
+            status = 1
+        else:
+            print(f"  No regressions against {baseline_path} (tolerance {tolerance:.0%})")
+    if save_baseline:
+        with open(save_baseline, "w", encoding="utf-8") as handle:
+            json.dump(summary, handle, indent=2)
+        print(f"Baseline written to {save_baseline}")
+    return status
+
+
+def run_bench(args):
+    command = args.command[1:] if args.command and args.command[0] == "--" else args.command
+    if not command:
+        raise SystemExit("bench needs the runner command after --")
+    timings = args.timings or os.path.join(tempfile.mkdtemp(prefix="pf_bench_"), "timings.jsonl")
+    extra = ["--timings", timings]
+    if os.path.basename(command[0]) in RESULT_CACHE_RUNNERS:
+        extra.append("--no-result-cache")
+    failures = 0
+    for iteration in range(1, args.iterations + 1):
+        print(f"Iteration {iteration}/{args.iterations}: {' '.join(shlex.quote(part) for part in command)}")
+        started = time.time()
+        # Right after the script so a trailing argparse.REMAINDER (--program-args) cannot swallow it.
+        completed = subprocess.run([sys.executable, command[0]] + extra + command[1:])
+        print(f"  exit {completed.returncode} after {time.time() - started:.1f}s")
+        failures += completed.returncode != 0
+    print(f"Benchmark over {args.iterations} iterations ({failures} failed), spans in {timings}:")
+    status = report(summarize(load_spans(timings)), args.baseline, args.save_baseline, args.tolerance)
+    return 1 if failures else status
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Summarize runner phase timings and benchmark runners")
+    sub = parser.add_subparsers(dest="command_name", required=True)
+
+    def add_report_arguments(target):
+        target.add_argument("--baseline", help="Baseline summary JSON to compare against")
+        target.add_argument("--save-baseline", help="Write this summary as the new baseline")
+        target.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed growth, e.g. 0.2")
+
+    bench = sub.add_parser("bench", help="Run a runner N times and report p50/p95/max per phase")
+    bench.add_argument("--iterations", type=int, default=5)
+    bench.add_argument("--timings", help="JSON lines file to collect spans in (default: a temp file)")
+    add_report_arguments(bench)
+    bench.add_argument("command", nargs=argparse.REMAINDER, help="-- proxmox_ssh_runner.py --vmid ...")
+
+    summary = sub.add_parser("report", help="Summarize an existing timings file")
+    summary.add_argument("timings")
+    add_report_arguments(summary)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command_name == "bench":
+        raise SystemExit(run_bench(args))
+    raise SystemExit(report(summarize(load_spans(args.timings)), args.baseline, args.save_baseline, args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import argparse
+import os
+import queue
+import threading
+import time
+
+import paramiko
+
+DEFAULT_WINDOW_SIZE = 16 * 1024 * 1024
+DEFAULT_MAX_PACKET_SIZE = 256 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def connect_kwargs(cipher=None, compress=False):
+    """Extra ``SSHClient.connect`` arguments that pin the cipher and toggle compression."""
+    kwargs = {"compress": bool(compress)}
+    if cipher:
+
+        def transport_factory(sock, **options):
+            transport = paramiko.Transport(sock, **options)
+            security = transport.get_security_options()
+            if cipher not in security.ciphers:
+                transport.close()
+                raise ValueError(f"Unsupported cipher {cipher}; choose from {', '.join(security.ciphers)}")
+            security.ciphers = (cipher,)
+            return transport
+
+        kwargs["transport_factory"] = transport_factory
+    return kwargs
+
+
+def tune_transport(transport, window_size=DEFAULT_WINDOW_SIZE, max_packet_size=DEFAULT_MAX_PACKET_SIZE):
+    transport.default_window_size = window_size
+    transport.default_max_packet_size = max_packet_size
+    transport.set_keepalive(30)
+
+
+def open_sftp(transport, window_size=DEFAULT_WINDOW_SIZE, max_packet_size=DEFAULT_MAX_PACKET_SIZE):
+    return paramiko.SFTPClient.from_transport(transport, window_size=window_size, max_packet_size=max_packet_size)
+
+
+def put_pipelined(sftp, local_path, remote_path):
+    size = 0
+    with open(local_path, "rb") as source, sftp.open(remote_path, "wb", bufsize=READ_CHUNK_SIZE) as target:
+        target.set_pipelined(True)
+        for chunk in iter(lambda: source.read(READ_CHUNK_SIZE), b""):
+            target.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def ensure_parent_dirs(sftp, remote_paths):
+    """Create the missing parent directories of ``remote_paths``, stat-ing each one at most once."""
+    created = set()
+    for remote_path in remote_paths:
+        parent = remote_path.rsplit("/", 1)[0]
+        missing = []
+        while parent and parent not in created:
+            try:
+                sftp.stat(parent)
+                break
+            except IOError:
+                missing.append(parent)
+                parent = parent.rsplit("/", 1)[0]
+        for path in reversed(missing):
+            sftp.mkdir(path)
+            created.add(path)
+        created.add(remote_path.rsplit("/", 1)[0])
+
+
+def parallel_upload(
+    transport,
+    pairs,
+    channels=4,
+    window_size=DEFAULT_WINDOW_SIZE,
+    max_packet_size=DEFAULT_MAX_PACKET_SIZE,
+    verbose=True,
+    sftp=None,
+):
+    """Upload ``(local_path, remote_sftp_path)`` pairs over ``channels`` SFTP sessions of one transport.
+
+    The remote parent directories must already exist (see ``ensure_parent_dirs``). An open
+    ``sftp`` session is used as one of the channels. Every session is closed on return.
+    Returns ``(bytes_sent, seconds)``.
+    """
+    pending = queue.Queue()
+    # Largest files first so one big DLL does not end up alone at the tail.
+    for pair in sorted(pairs, key=lambda item: os.path.getsize(item[0]), reverse=True):
+        pending.put(pair)
+    totals = {"bytes": 0}
+    errors = []
+    lock = threading.Lock()
+
+    def worker(sftp):
+        try:
+            while True:
+                try:
+                    local_path, remote_path = pending.get_nowait()
+                except queue.Empty:
+                    return
+                if verbose:
+                    print(f"Uploading {os.path.basename(local_path)} ...")
+                sent = put_pipelined(sftp, local_path, remote_path)
+                with lock:
+                    totals["bytes"] += sent
+        except Exception as exc:  # noqa: BLE001
+            errors.append(exc)
+        finally:
+            sftp.close()
+
+    started = time.time()
+    # More sessions than files would only sit idle.
+    count = max(1, min(channels, len(pairs)))
+    sessions = [sftp] if sftp is not None else []
+    try:
+        while len(sessions) < count:
+            sessions.append(open_sftp(transport, window_size, max_packet_size))
+    except Exception:
+        for session in sessions:
+            session.close()
+        raise
+    threads = [threading.Thread(target=worker, args=(sftp,), daemon=True) for sftp in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError(f"SFTP upload failed: {errors[0]}") from errors[0]
+    return totals["bytes"], time.time() - started
+
+
+def parse_config(text):
+    config = {"channels": 1, "cipher": None, "compress": False}
+    for item in filter(None, text.split(",")):
+        key, _, value = item.partition("=")
+        if key == "channels":
+            config["channels"] = int(value)
+        elif key == "cipher":
+            config["cipher"] = value
+        elif key == "compress":
+            config["compress"] = value.lower() in ("1", "true", "yes")
+        elif key == "window":
+            config["window_size"] = int(value)
+        elif key == "packet":
+            config["max_packet_size"] = int(value)
+        else:
+            raise ValueError(f"Unknown benchmark setting: {key}")
+    return config
+
+
+def run_benchmark(args):
+    files = []
+    for root, _, names in os.walk(args.build_path):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), args.build_path))
+    total_size = sum(os.path.getsize(os.path.join(args.build_path, name)) for name in files)
+    print(f"Benchmarking {len(files)} files ({total_size / 1048576:.1f} MiB) against {args.host}")
+
+    results = []
+    for text in args.configs:
+        config = parse_config(text)
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            args.host,
+            username=args.user,
+            password=args.password,
+            timeout=15,
+            **connect_kwargs(config["cipher"], config["compress"]),
+        )
+        try:
+            transport = client.get_transport()
+            window_size = config.get("window_size", DEFAULT_WINDOW_SIZE)
+            max_packet_size = config.get("max_packet_size", DEFAULT_MAX_PACKET_SIZE)
+            tune_transport(transport, window_size, max_packet_size)
+            sftp = open_sftp(transport, window_size, max_packet_size)
+            remote_root = f"{sftp.normalize('.').rstrip('/')}/pf_sftp_bench"
+            pairs = [
+                (os.path.join(args.build_path, name), f"{remote_root}/{name.replace(os.sep, '/')}")
+                for name in files
+            ]
+            ensure_parent_dirs(sftp, [remote for _, remote in pairs])
+            sent, seconds = parallel_upload(
+                transport,
+                pairs,
+                channels=config["channels"],
+                window_size=window_size,
+                max_packet_size=max_packet_size,
+                verbose=False,
+                sftp=sftp,
+            )
+            cipher = transport.remote_cipher
+            client.exec_command(f'cmd /c rmdir /s /q "{remote_root.lstrip("/")}"')[1].channel.recv_exit_status()
+        finally:
+            client.close()
+        rate = sent / 1048576 / seconds if seconds else 0.0
+        results.append((text or "defaults", cipher, seconds, rate))
+        print(f"  {text or 'defaults'}: {seconds:.2f}s, {rate:.1f} MB/s ({cipher})")
+
+    print("Summary:")
+    for label, cipher, seconds, rate in sorted(results, key=lambda item: item[3], reverse=True):
+        print(f"  {rate:8.1f} MB/s  {seconds:7.2f}s  {label} [{cipher}]")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark SFTP upload settings against a Windows VM")
+    parser.add_argument("--host", required=True)
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--build-path", required=True, help="Directory to upload, e.g. publish\\win-x64")
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=["channels=1", "channels=4", "channels=8", "channels=4,compress=1", "channels=4,cipher=aes128-ctr"],
+        help="Comma-separated settings per run: channels, cipher, compress, window, packet",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    run_benchmark(parse_args())
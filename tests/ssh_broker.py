@@ -0,0 +1,534 @@
+import argparse
+import json
+import os
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import paramiko
+from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
+
+from ps_host import host_for
+from sftp_transfer import READ_CHUNK_SIZE, connect_kwargs, open_sftp, tune_transport
+
+DEFAULT_BROKER_ADDRESS = "127.0.0.1:8722"
+
+# Exec channels are framed as <tag:1><length:4><payload>. Broker -> client: O (stdout),
+# E (stderr), X (exit status). Client -> broker: I (stdin data), C (stdin closed).
+# "powershell" requests are answered the same way, by the session's PowerShell host.
+FRAME_HEADER = struct.Struct(">cI")
+# How long a channel that reached EOF or closed gets to deliver its exit status.
+EXIT_STATUS_GRACE = 2.0
+# Large enough that paramiko has more than 100 pipelined SFTP writes outstanding.
+CHECK_UPLOAD_SIZE = 5 * 1024 * 1024
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def send_frame(sock, tag, payload=b""):
+    sock.sendall(FRAME_HEADER.pack(tag, len(payload)) + payload)
+
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Broker connection closed")
+        data += chunk
+    return data
+
+
+def recv_line(sock):
+    # Byte at a time so nothing after the newline is consumed before the relay starts.
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(1)
+        if not chunk:
+            raise EOFError("Broker connection closed")
+        data += chunk
+    return json.loads(data.decode("utf-8"))
+
+
+def send_line(sock, payload):
+    sock.sendall(json.dumps(payload).encode("utf-8") + b"\n")
+
+
+class SessionPool:
+    """Authenticated SSH transports keyed by (host, port, user), reconnected when they drop."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, host, user, password, port=22, timeout=15, cipher=None, compress=False, fresh=False):
+        key = (host, int(port), user)
+        with self._lock:
+            entry = self._entries.setdefault(key, {"lock": threading.Lock(), "client": None, "password": None})
+        with entry["lock"]:
+            client = entry["client"]
+            if client is not None and entry["password"] != password:
+                raise PermissionError(f"Credentials do not match the cached session for {user}@{host}")
+            if client is not None and fresh:
+                # The guest was rolled back, so the old transport may still look active but is dead.
+                client.close()
+                client = None
+            transport = client.get_transport() if client is not None else None
+            if transport is None or not transport.is_active():
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(
+                    host,
+                    port=int(port),
+                    username=user,
+                    password=password,
+                    timeout=timeout,
+                    **connect_kwargs(cipher, compress),
+                )
+                tune_transport(client.get_transport())
+                entry["client"] = client
+                entry["password"] = password
+            return client
+
+    def close(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry["client"] is not None:
+                entry["client"].close()
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        try:
+            header = recv_line(sock)
+            client = self.server.pool.get(
+                header["host"],
+                header["user"],
+                header["password"],
+                port=header.get("port", 22),
+                timeout=header.get("timeout", 15),
+                cipher=header.get("cipher"),
+                compress=header.get("compress", False),
+                fresh=header.get("fresh", False),
+            )
+            kind = header.get("kind")
+            if kind == "connect":
+                send_line(sock, {"ok": True, "cipher": client.get_transport().remote_cipher})
+                return
+            if kind == "powershell":
+                host = host_for(client.get_transport())
+                send_line(sock, {"ok": True})
+                self._relay_powershell(sock, host, header["script"])
+                return
+            channel = client.get_transport().open_session(
+                window_size=header.get("window_size"),
+                max_packet_size=header.get("max_packet_size"),
+            )
+            if kind == "exec":
+                channel.exec_command(header["command"])
+            elif kind == "subsystem":
+                channel.invoke_subsystem(header["name"])
+            else:
+                raise ValueError(f"Unknown broker request: {kind}")
+        except Exception as exc:  # noqa: BLE001
+            try:
+                send_line(sock, {"ok": False, "error": f"{type(exc).__name__}: {exc}"})
+            except OSError:
+                pass
+            return
+        send_line(sock, {"ok": True})
+        try:
+            if kind == "exec":
+                self._relay_exec(sock, channel)
+            else:
+                self._relay_raw(sock, channel)
+        finally:
+            channel.close()
+
+    @staticmethod
+    def _relay_exec(sock, channel):
+        def pump_stdin():
+            try:
+                while True:
+                    tag, length = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+                    payload = recv_exact(sock, length) if length else b""
+                    if tag == b"I":
+                        channel.sendall(payload)
+                    elif tag == b"C":
+                        channel.shutdown_write()
+            except (EOFError, OSError):
+                pass
+
+        threading.Thread(target=pump_stdin, daemon=True).start()
+        while True:
+            select.select([channel], [], [], 1.0)
+            sent = False
+            while channel.recv_ready():
+                send_frame(sock, b"O", channel.recv(65536))
+                sent = True
+            while channel.recv_stderr_ready():
+                send_frame(sock, b"E", channel.recv_stderr(65536))
+                sent = True
+            if sent or channel.recv_ready() or channel.recv_stderr_ready():
+                continue
+            if channel.exit_status_ready():
+                break
+            if channel.closed or channel.eof_received:
+                # sshd usually sends the exit status right after EOF; a dropped session never does.
+                channel.status_event.wait(EXIT_STATUS_GRACE)
+                break
+        exit_status = channel.recv_exit_status() if channel.exit_status_ready() else -1
+        send_frame(sock, b"X", struct.pack(">i", exit_status))
+
+    @staticmethod
+    def _relay_powershell(sock, host, ps_script):
+        try:
+            _, err, exit_status = host.run(ps_script, on_line=lambda line: send_frame(sock, b"O", line.encode() + b"\n"))
+        except RuntimeError as exc:
+            err, exit_status = str(exc), 255
+        if err:
+            send_frame(sock, b"E", err.encode())
+        send_frame(sock, b"X", struct.pack(">i", exit_status))
+
+    @staticmethod
+    def _relay_raw(sock, channel):
+        def pump_upstream():
+            try:
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    channel.sendall(data)
+            except OSError:
+                pass
+            channel.close()
+
+        threading.Thread(target=pump_upstream, daemon=True).start()
+        while True:
+            data = channel.recv(65536)
+            if not data:
+                break
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _BrokerHandler)
+        self.pool = SessionPool()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+
+
+class BrokerChannel:
+    """Client end of one brokered channel; mimics the parts of paramiko.Channel the runners use."""
+
+    def __init__(self, transport, window_size=None, max_packet_size=None):
+        self._transport = transport
+        self._window_size = window_size
+        self._max_packet_size = max_packet_size
+        self._sock = None
+        self._framed = False
+        self._cond = threading.Condition()
+        self._stdout = bytearray()
+        self._stderr = bytearray()
+        self._exit_status = None
+        self._eof = False
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def get_name(self):
+        return f"broker:{self._transport.credentials['host']}"
+
+    def get_pty(self, *args, **kwargs):
+        raise NotImplementedError("Brokered channels do not support PTYs")
+
+    def update_environment(self, environment):
+        raise NotImplementedError("Brokered channels do not support environment variables")
+
+    def exec_command(self, command):
+        self._open({"kind": "exec", "command": command})
+        self._framed = True
+        threading.Thread(target=self._demux, daemon=True).start()
+
+    def invoke_subsystem(self, name):
+        self._open({"kind": "subsystem", "name": name})
+
+    def run_powershell(self, ps_script):
+        """Hand ``ps_script`` to the broker's PowerShell host; output arrives like an exec's."""
+        self._open({"kind": "powershell", "script": ps_script})
+        self._framed = True
+        threading.Thread(target=self._demux, daemon=True).start()
+
+    def _open(self, request):
+        request.update(window_size=self._window_size, max_packet_size=self._max_packet_size)
+        self._sock = self._transport.request(request)
+
+    def _demux(self):
+        try:
+            while True:
+                tag, length = FRAME_HEADER.unpack(recv_exact(self._sock, FRAME_HEADER.size))
+                payload = recv_exact(self._sock, length) if length else b""
+                with self._cond:
+                    if tag == b"O":
+                        self._stdout += payload
+                    elif tag == b"E":
+                        self._stderr += payload
+                    elif tag == b"X":
+                        self._exit_status = struct.unpack(">i", payload)[0]
+                    self._cond.notify_all()
+                if tag == b"X":
+                    break
+        except (EOFError, OSError):
+            pass
+        with self._cond:
+            self._eof = True
+            if self._exit_status is None:
+                self._exit_status = -1
+            self._cond.notify_all()
+
+    def _take(self, buffer, size):
+        with self._cond:
+            if not self._cond.wait_for(lambda: buffer or self._eof, timeout=self.timeout):
+                raise socket.timeout()
+            data = bytes(buffer[:size])
+            del buffer[:size]
+            return data
+
+    def recv(self, size):
+        if not self._framed:
+            return self._sock.recv(size)
+        return self._take(self._stdout, size)
+
+    def recv_stderr(self, size):
+        return self._take(self._stderr, size)
+
+    def recv_ready(self):
+        # Pipelined SFTP writes poll this to collect acknowledgements without blocking.
+        if not self._framed:
+            return bool(select.select([self._sock], [], [], 0)[0])
+        with self._cond:
+            return bool(self._stdout)
+
+    def recv_stderr_ready(self):
+        if not self._framed:
+            return False
+        with self._cond:
+            return bool(self._stderr)
+
+    def send(self, data):
+        if not self._framed:
+            return self._sock.send(data)
+        send_frame(self._sock, b"I", bytes(data))
+        return len(data)
+
+    def sendall(self, data):
+        if not self._framed:
+            self._sock.sendall(data)
+        else:
+            send_frame(self._sock, b"I", bytes(data))
+
+    def shutdown_write(self):
+        if self._framed:
+            send_frame(self._sock, b"C")
+        else:
+            self._sock.shutdown(socket.SHUT_WR)
+
+    def exit_status_ready(self):
+        return self._exit_status is not None
+
+    def recv_exit_status(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._exit_status is not None)
+            return self._exit_status
+
+    def makefile(self, *params):
+        return ChannelFile(*([self] + list(params)))
+
+    def makefile_stderr(self, *params):
+        return ChannelStderrFile(*([self] + list(params)))
+
+    def makefile_stdin(self, *params):
+        return ChannelStdinFile(*([self] + list(params)))
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BrokerTransport:
+    """Stands in for paramiko.Transport: every session is a new channel on the broker's transport."""
+
+    def __init__(self, broker_address, host, user, password, port=22, cipher=None, compress=False):
+        self.broker_address = parse_address(broker_address)
+        self.credentials = {
+            "host": host,
+            "port": port,
+            "user": user,
+            "password": password,
+            "cipher": cipher,
+            "compress": compress,
+        }
+        self.default_window_size = None
+        self.default_max_packet_size = None
+        self.remote_cipher = None
+
+    def request(self, payload, timeout=15):
+        sock = socket.create_connection(self.broker_address, timeout=timeout)
+        request = dict(self.credentials, timeout=timeout)
+        request.update(payload)
+        try:
+            send_line(sock, request)
+            sock.settimeout(max(timeout * 2, 60))
+            reply = recv_line(sock)
+        except Exception:
+            sock.close()
+            raise
+        if not reply.get("ok"):
+            sock.close()
+            raise paramiko.SSHException(f"Broker request failed: {reply.get('error')}")
+        sock.settimeout(None)
+        if payload.get("kind") == "connect":
+            self.remote_cipher = reply.get("cipher")
+            sock.close()
+            return None
+        return sock
+
+    def open_session(self, window_size=None, max_packet_size=None, timeout=None):
+        return BrokerChannel(
+            self,
+            window_size or self.default_window_size,
+            max_packet_size or self.default_max_packet_size,
+        )
+
+    def open_sftp_client(self):
+        return paramiko.SFTPClient.from_transport(self)
+
+    def set_keepalive(self, interval):
+        pass
+
+    def powershell_host(self):
+        return BrokerPowerShellHost(self)
+
+    def is_active(self):
+        return True
+
+    def close(self):
+        # The broker owns the real transport; nothing to tear down on this side.
+        pass
+
+
+class BrokerPowerShellHost:
+    """``PowerShellHost.run`` for brokered sessions; the host lives in the broker and outlasts this process."""
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def run(self, ps_script, on_line=None):
+        channel = self._transport.open_session()
+        try:
+            channel.run_powershell(ps_script)
+            lines = []
+            for raw in iter(channel.makefile("rb").readline, b""):
+                (on_line or lines.append)(raw.decode(errors="ignore").rstrip("\r\n"))
+            err = channel.makefile_stderr("rb").read().decode(errors="ignore").strip()
+            return "\n".join(lines), err, channel.recv_exit_status()
+        finally:
+            channel.close()
+
+
+class BrokeredSSHClient(paramiko.SSHClient):
+    def __init__(self, transport):
+        super().__init__()
+        self._transport = transport
+
+
+def connect_via_broker(
+    broker_address,
+    host,
+    user,
+    password,
+    port=22,
+    timeout=15,
+    cipher=None,
+    compress=False,
+    fresh=False,
+):
+    transport = BrokerTransport(broker_address, host, user, password, port=port, cipher=cipher, compress=compress)
+    started = time.time()
+    transport.request({"kind": "connect", "fresh": fresh}, timeout=timeout)
+    print(f"  Broker session to {host} ready in {(time.time() - started) * 1000:.0f} ms")
+    return BrokeredSSHClient(transport)
+
+
+def check_broker(broker_address, host, user, password, port=22, size=CHECK_UPLOAD_SIZE):
+    """Upload ``size`` bytes over pipelined SFTP through the broker, verify and remove them."""
+    client = connect_via_broker(broker_address, host, user, password, port=port)
+    data = os.urandom(size)
+    with open_sftp(client.get_transport()) as sftp:
+        remote_path = f"{sftp.normalize('.').rstrip('/')}/pf_broker_check.bin"
+        started = time.time()
+        with sftp.open(remote_path, "wb") as target:
+            target.set_pipelined(True)
+            for offset in range(0, size, READ_CHUNK_SIZE):
+                target.write(data[offset:offset + READ_CHUNK_SIZE])
+        seconds = time.time() - started
+        stored = sftp.stat(remote_path).st_size
+        sftp.remove(remote_path)
+    if stored != size:
+        raise RuntimeError(f"Broker upload check stored {stored} of {size} bytes")
+    print(f"  Uploaded {size} bytes through the broker in {seconds:.2f}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Keep SSH transports to VMs open and share them with runner processes")
+    parser.add_argument("--listen", default=DEFAULT_BROKER_ADDRESS, help="host:port to accept runner connections on")
+    parser.add_argument("--check", metavar="HOST", help="Instead of serving, check a running broker against HOST and exit")
+    parser.add_argument("--user", help="SSH user for --check")
+    parser.add_argument("--password", help="SSH password for --check")
+    parser.add_argument("--port", type=int, default=22, help="SSH port for --check")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.check:
+        check_broker(args.listen, args.check, args.user, args.password, port=args.port)
+        return
+    server = BrokerServer(parse_address(args.listen))
+    print(f"SSH broker listening on {args.listen}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import json
+import logging
+import os
+import queue
+import selectors
+import socket
+import stat
+import threading
+import time
+
+import paramiko
+from paramiko import SFTP_OK, SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+
+from proxmox_simulator import decode_powershell, emulate_powershell, windows_key
+from ps_host import HOST_MARKER
+
+
+def sftp_path(key: str) -> str:
+    """Canonical SFTP form of a guest path key, as Win32-OpenSSH reports it: /C:/Users/me."""
+    parts = key.split("\\")
+    if parts and parts[0].endswith(":"):
+        parts[0] = parts[0].upper()
+    return "/" + "/".join(parts)
+
+
+class MemoryHandle(SFTPHandle):
+    def __init__(self, vm, key, flags):
+        super().__init__(flags)
+        self.vm = vm
+        self.key = key
+        existing = b"" if flags & os.O_TRUNC else vm.files.get(key, b"")
+        self.buffer = bytearray(existing)
+        self.dirty = bool(flags & os.O_CREAT)
+
+    def read(self, offset, length):
+        return bytes(self.buffer[offset:offset + length])
+
+    def write(self, offset, data):
+        end = offset + len(data)
+        if end > len(self.buffer):
+            self.buffer.extend(b"\0" * (end - len(self.buffer)))
+        self.buffer[offset:end] = data
+        self.dirty = True
+        return SFTP_OK
+
+    def stat(self):
+        attributes = SFTPAttributes()
+        attributes.st_size = len(self.buffer)
+        attributes.st_mode = stat.S_IFREG | 0o644
+        return attributes
+
+    def close(self):
+        if self.dirty:
+            self.vm.write_file(self.key, self.buffer)
+        super().close()
+
+
+class MemorySFTPServer(SFTPServerInterface):
+    """SFTP over the simulated guest's in-memory file system."""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.vm = server.vm
+        self.home = server.home
+
+    def _key(self, path):
+        if path in ("", "."):
+            return self.home
+        if not path.startswith("/"):
+            return windows_key(f"{self.home}\\{path}")
+        return windows_key(path)
+
+    def canonicalize(self, path):
+        return sftp_path(self._key(path))
+
+    def stat(self, path):
+        key = self._key(path)
+        attributes = SFTPAttributes()
+        if key in self.vm.dirs:
+            attributes.st_mode = stat.S_IFDIR | 0o755
+            attributes.st_size = 0
+            return attributes
+        if key in self.vm.files:
+            attributes.st_mode = stat.S_IFREG | 0o644
+            attributes.st_size = len(self.vm.files[key])
+            return attributes
+        return paramiko.SFTP_NO_SUCH_FILE
+
+    lstat = stat
+
+    def mkdir(self, path, attr):
+        self.vm.make_dir(self._key(path))
+        return SFTP_OK
+
+    def remove(self, path):
+        key = self._key(path)
+        if key not in self.vm.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        self.vm.remove_tree(key)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        old, new = self._key(oldpath), self._key(newpath)
+        if old not in self.vm.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        self.vm.write_file(new, self.vm.files[old])
+        self.vm.remove_tree(old)
+        return SFTP_OK
+
+    def list_folder(self, path):
+        prefix = self._key(path) + "\\"
+        entries = []
+        for key, data in list(self.vm.files.items()):
+            if key.startswith(prefix) and "\\" not in key[len(prefix):]:
+                attributes = SFTPAttributes()
+                attributes.filename = key[len(prefix):]
+                attributes.st_mode = stat.S_IFREG | 0o644
+                attributes.st_size = len(data)
+                entries.append(attributes)
+        return entries
+
+    def open(self, path, flags, attr):
+        key = self._key(path)
+        if not flags & (os.O_WRONLY | os.O_RDWR) and key not in self.vm.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        if key.rsplit("\\", 1)[0] not in self.vm.dirs:
+            return paramiko.SFTP_NO_SUCH_FILE
+        return MemoryHandle(self.vm, key, flags)
+
+
+class GuestServer(paramiko.ServerInterface):
+    def __init__(self, simulator, vm):
+        self.simulator = simulator
+        self.vm = vm
+        self.home = None
+        self.username = None
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        config = self.simulator.cluster.config
+        time.sleep(config.latency("ssh_auth"))
+        if password != self.simulator.password or config.fails("ssh_auth"):
+            return paramiko.AUTH_FAILED
+        self.username = username
+        self.home = windows_key(f"C:\\Users\\{username}")
+        self.vm.write_dir(self.home)
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._exec, args=(channel, command.decode(errors="ignore")), daemon=True)
+        thread.start()
+        return True
+
+    def _exec(self, channel, command):
+        config = self.simulator.cluster.config
+        script = decode_powershell(command)
+        time.sleep(config.latency("powershell"))
+        if HOST_MARKER in script:
+            self._host(channel)
+            return
+        result = emulate_powershell(self.vm, config, script, self.username)
+        try:
+            if not self._send_lines(channel, result, result.stdout_lines):
+                return
+            if result.stderr:
+                channel.sendall_stderr((result.stderr + "\r\n").encode())
+            channel.send_exit_status(result.exitcode)
+            channel.close()
+        except (EOFError, OSError):
+            pass
+
+    def _send_lines(self, channel, result, lines):
+        config = self.simulator.cluster.config
+        for line in lines:
+            time.sleep(result.line_delay)
+            if config.fails("ssh_drop"):
+                channel.get_transport().close()
+                return False
+            channel.sendall((line + "\r\n").encode())
+        return True
+
+    def _host(self, channel):
+        """ps_host.HOST_SCRIPT: scripts by hash, console lines passed through, one H| reply each."""
+        config = self.simulator.cluster.config
+        scripts = {}
+        reader = channel.makefile("rb")
+        try:
+            for raw in iter(reader.readline, b""):
+                if not raw.strip():
+                    continue
+                request = json.loads(raw)
+                if request.get("op") == "exit":
+                    break
+                if request.get("script"):
+                    scripts[request["hash"]] = request["script"]
+                reply = {"id": request.get("id"), "missing": False, "exit": 0, "output": "", "error": ""}
+                script = scripts.get(request["hash"])
+                if script is None:
+                    reply.update(missing=True, exit=-1)
+                else:
+                    result = emulate_powershell(self.vm, config, script, self.username)
+                    console = [line for line in result.stdout_lines if line[:2] in ("O|", "E|", "R|")]
+                    if not self._send_lines(channel, result, console):
+                        return
+                    output = [line for line in result.stdout_lines if line[:2] not in ("O|", "E|", "R|")]
+                    time.sleep(result.line_delay * len(output))
+                    reply["output"] = "\n".join(output)
+                    reply["error"] = result.stderr
+                    reply["exit"] = 1 if result.exitcode else 0
+                channel.sendall(("H|" + json.dumps(reply) + "\r\n").encode())
+            channel.send_exit_status(0)
+            channel.close()
+        except (EOFError, OSError):
+            pass
+
+
+class SshSimulator:
+    """One fake sshd socket per simulated VM IP, all on ``port``, accepted from a single thread.
+
+    Connections to a guest that is not booted yet are closed before the banner,
+    the way a VM with its network up but sshd still starting looks to the probe.
+    """
+
+    def __init__(self, cluster, port, password, verbose=False):
+        # Readiness probes hang up right after the banner; paramiko would log each one as an error.
+        logging.getLogger("paramiko").setLevel(logging.DEBUG if verbose else logging.CRITICAL)
+        self.cluster = cluster
+        self.port = port
+        self.password = password
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.selector = selectors.DefaultSelector()
+        self._new = queue.Queue()
+        self._closed = threading.Event()
+        for vm in list(cluster.vms.values()):
+            self.listen_for(vm)
+
+    def listen_for(self, vm):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((vm.ip, self.port))
+        listener.listen(64)
+        listener.setblocking(False)
+        self._new.put((listener, vm.vmid))
+
+    def serve_forever(self):
+        while not self._closed.is_set():
+            while not self._new.empty():
+                listener, vmid = self._new.get()
+                self.selector.register(listener, selectors.EVENT_READ, vmid)
+            for key, _ in self.selector.select(timeout=0.2):
+                try:
+                    sock, _ = key.fileobj.accept()
+                except OSError:
+                    continue
+                sock.setblocking(True)
+                threading.Thread(target=self._session, args=(sock, key.data), daemon=True).start()
+
+    def _session(self, sock, vmid):
+        vm = self.cluster.vms.get(vmid)
+        if vm is None or not vm.guest_ready():
+            sock.close()
+            return
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", SFTPServer, MemorySFTPServer)
+        with vm.lock:
+            vm.sessions.add(transport)
+        try:
+            transport.start_server(server=GuestServer(self, vm))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def close(self):
+        self._closed.set()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
@@ -0,0 +1,113 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Stage:
+    def __init__(self, name: str, func, deps):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.started = None
+        self.finished = None
+
+    @property
+    def seconds(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class StageGraph:
+    """Run named stages as soon as the stages they depend on have finished.
+
+    ``func`` receives the results of ``deps`` as positional arguments, in order.
+    Independent stages run on separate threads, so local preparation (hashing,
+    bundling, serving) overlaps with slow remote steps such as rollback and boot.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.results = {}
+        self._origin = None
+
+    def add(self, name: str, func, deps=()):
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self.stages[name] = Stage(name, func, deps)
+        return self
+
+    def run(self):
+        self._origin = time.time()
+        pending = dict(self.stages)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=max(1, len(self.stages))) as pool:
+            while pending or running:
+                if error is None:
+                    for name, stage in list(pending.items()):
+                        if all(dep in self.results for dep in stage.deps):
+                            del pending[name]
+                            running[pool.submit(self._execute, stage)] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        value = future.result()
+                    except Exception as exc:  # noqa: BLE001
+                        if error is None:
+                            error = exc
+                            print(f"  Stage {stage.name} failed: {exc}")
+                        continue
+                    self.results[stage.name] = value
+        if error is not None:
+            raise error
+        return self.results
+
+    def _execute(self, stage: Stage):
+        stage.started = time.time()
+        try:
+            return stage.func(*(self.results[dep] for dep in stage.deps))
+        finally:
+            stage.finished = time.time()
+
+    def critical_path(self):
+        """Stages that determined the total run time, from first to last."""
+        finished = [stage for stage in self.stages.values() if stage.finished is not None]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda item: item.finished)
+        path = [stage]
+        while stage.deps:
+            stage = max((self.stages[dep] for dep in stage.deps), key=lambda item: item.finished or 0.0)
+            path.append(stage)
+        return list(reversed(path))
+
+    def slack(self, name: str):
+        """Seconds a stage finished before the first stage that needed it could start, or None."""
+        stage = self.stages[name]
+        dependents = [other for other in self.stages.values() if name in other.deps and other.started is not None]
+        if stage.finished is None or not dependents:
+            return None
+        return max(0.0, min(other.started for other in dependents) - stage.finished)
+
+    def report(self):
+        print("Stage timeline:")
+        for stage in sorted(self.stages.values(), key=lambda item: item.started or float("inf")):
+            if stage.started is None:
+                print(f"  {stage.name:<12} not run")
+                continue
+            slack = self.slack(stage.name)
+            slack_text = "" if slack is None else f"  slack {slack:5.1f}s"
+            print(
+                f"  {stage.name:<12} {stage.started - self._origin:6.1f}s -> "
+                f"{(stage.finished or time.time()) - self._origin:6.1f}s ({stage.seconds:5.1f}s){slack_text}"
+            )
+        path = self.critical_path()
+        if path:
+            total = path[-1].finished - self._origin
+            print(f"Critical path ({total:.1f}s): {' -> '.join(stage.name for stage in path)}")
@@ -0,0 +1,161 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import winrm
+from winrm.exceptions import WinRMOperationTimeoutError, WinRMTransportError, WSManFaultError
+
+from ps_command import powershell_command
+
+WINRM_PORT = 5985
+# Keep shells alive well past a long test run; WinRM closes them after this much inactivity.
+SHELL_IDLE_TIMEOUT = 1800
+
+
+class WinRMShell(winrm.Session):
+    """``winrm.Session`` that opens one remote shell and runs every command in it.
+
+    ``Session.run_cmd`` opens and closes a shell per call, and each open shell costs a round of
+    NTLM-authenticated WS-Man requests. Here the shell and the authenticated HTTP connection
+    stay up for the heartbeat, the deploy and the run, and output can be received while the
+    command is still going. Commands on one shell run one at a time.
+    """
+
+    def __init__(self, host, user, password, port=WINRM_PORT, transport="ntlm", **kwargs):
+        super().__init__(f"http://{host}:{port}/wsman", auth=(user, password), transport=transport, **kwargs)
+        self.host = host
+        self.shell_id = None
+        self.commands = 0
+        self._lock = threading.Lock()
+
+    def _shell(self):
+        if self.shell_id is None:
+            self.shell_id = self.protocol.open_shell(idle_timeout=SHELL_IDLE_TIMEOUT)
+        return self.shell_id
+
+    def run_cmd(self, command, args=(), on_line=None):
+        """Run ``command`` in the shared shell; ``on_line(stream_name, line)`` sees output as it arrives."""
+        with self._lock:
+            reused = self.shell_id is not None
+            try:
+                command_id = self.protocol.run_command(self._shell(), command, args)
+            except (WSManFaultError, WinRMTransportError):
+                if not reused:
+                    raise
+                # The server dropped an idle or broken shell; open a fresh one once.
+                self.shell_id = None
+                command_id = self.protocol.run_command(self._shell(), command, args)
+            try:
+                response = winrm.Response(self._receive(command_id, on_line))
+            finally:
+                self.protocol.cleanup_command(self.shell_id, command_id)
+            self.commands += 1
+            return response
+
+    def _receive(self, command_id, on_line):
+        stdout, stderr = [], []
+        pending = {"stdout": b"", "stderr": b""}
+        done = False
+        while not done:
+            try:
+                out, err, status_code, done = self.protocol.get_command_output_raw(self.shell_id, command_id)
+            except WinRMOperationTimeoutError:
+                continue  # nothing new within the operation timeout; the command is still running
+            stdout.append(out)
+            stderr.append(err)
+            if on_line is None:
+                continue
+            for stream_name, chunk in (("stdout", out), ("stderr", err)):
+                *lines, pending[stream_name] = (pending[stream_name] + chunk).split(b"\n")
+                for line in lines:
+                    on_line(stream_name, line.decode(errors="ignore").rstrip("\r"))
+        if on_line is not None:
+            for stream_name, rest in pending.items():
+                if rest.strip():
+                    on_line(stream_name, rest.decode(errors="ignore").rstrip("\r"))
+        return b"".join(stdout), b"".join(stderr), status_code
+
+    def run_ps(self, script, on_line=None):
+        response = self.run_cmd(powershell_command(script), on_line=on_line)
+        if response.std_err:
+            response.std_err = self._clean_error_msg(response.std_err)
+        return response
+
+    def heartbeat(self) -> bool:
+        return self.run_cmd("cmd", ["/c", "echo ok"]).status_code == 0
+
+    def close(self):
+        with self._lock:
+            if self.shell_id is not None:
+                try:
+                    self.protocol.close_shell(self.shell_id)
+                except Exception:  # noqa: BLE001
+                    pass
+                self.shell_id = None
+
+
+class WinRMPool:
+    """Open WinRM shells kept per VM for reuse, at most ``size`` per VM at a time."""
+
+    def __init__(self, user, password, size=2, port=WINRM_PORT):
+        self.user = user
+        self.password = password
+        self.size = size
+        self.port = port
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._open = {}
+
+    def acquire(self, host, timeout=None) -> WinRMShell:
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                idle = self._idle.get(host)
+                if idle:
+                    return idle.pop()
+                if self._open.get(host, 0) < self.size:
+                    self._open[host] = self._open.get(host, 0) + 1
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No WinRM shell to {host} became free")
+                self._cond.wait(remaining)
+        return WinRMShell(host, self.user, self.password, port=self.port)
+
+    def release(self, shell, discard=False):
+        """Return ``shell`` for reuse; ``discard`` closes it instead (after a failure or a rollback)."""
+        with self._cond:
+            if discard:
+                self._open[shell.host] -= 1
+            else:
+                self._idle.setdefault(shell.host, []).append(shell)
+            self._cond.notify()
+        if discard:
+            shell.close()
+
+    def discard_host(self, host):
+        """Drop the idle shells of ``host``; its guest was rolled back and they point at nothing."""
+        with self._cond:
+            shells = self._idle.pop(host, [])
+            self._open[host] = self._open.get(host, 0) - len(shells)
+            self._cond.notify_all()
+        for shell in shells:
+            shell.close()
+
+    @contextmanager
+    def session(self, host, timeout=None):
+        shell = self.acquire(host, timeout)
+        try:
+            yield shell
+        except Exception:
+            self.release(shell, discard=True)
+            raise
+        self.release(shell)
+
+    def close(self):
+        with self._cond:
+            shells = [shell for idle in self._idle.values() for shell in idle]
+            self._idle.clear()
+            self._open.clear()
+        for shell in shells:
+            shell.close()
@@ -1,17 +1,20 @@
-﻿import argparse
+import argparse
 import base64
 import json
 import os
-import socket
 import subprocess
 import sys
-import threading
 import time
 import urllib3
-from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 
 import requests
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+from guest_file_transfer import plan_chunks, push_files, run_guest_powershell  # noqa: E402
+from proxmox_tickets import DEFAULT_TICKET_CACHE, TICKET_RENEW_AFTER, TicketCache, needs_renewal  # noqa: E402
+from run_timing import configure as configure_timing, span  # noqa: E402
+from stage_graph import StageGraph  # noqa: E402
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 DEFAULT_FILES = [
@@ -35,76 +38,84 @@ def parse_args():
     parser.add_argument("--executable", default="PrivacyFirst.exe")
     parser.add_argument("--remote-dir", default=r"C:\\PrivacyFirstPipeline")
     parser.add_argument("--shutdown-vm", action="store_true")
-    parser.add_argument("--http-port", type=int, default=9910)
+    parser.add_argument("--transfer-workers", type=int, default=4, help="Concurrent agent/file-write requests")
+    parser.add_argument("--timings", help="Append per-phase timing spans to this JSON lines file")
+    parser.add_argument("--ticket-cache", default=DEFAULT_TICKET_CACHE, help="File caching Proxmox auth tickets")
+    parser.add_argument("--no-ticket-cache", action="store_true", help="Always log in with the password")
     return parser.parse_args()
 
 
-def get_local_ip(target):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        sock.connect((target, 80))
-        return sock.getsockname()[0]
-    except OSError:
-        return "127.0.0.1"
-    finally:
-        sock.close()
-
-
-class ArtifactServer(threading.Thread):
-    def __init__(self, directory, bind_ip, port):
-        super().__init__(daemon=True)
-        self.directory = directory
-        self.port = port
-        self.bind_ip = bind_ip
-        handler = type('Handler', (SimpleHTTPRequestHandler,), {'directory': directory})
-        self._server = ThreadingHTTPServer((bind_ip, port), handler)
-
-    def run(self):
-        self._server.serve_forever()
-
-    def stop(self):
-        self._server.shutdown()
-        self._server.server_close()
-
-
 class ProxmoxClient:
-    def __init__(self, host, user, password):
+    def __init__(self, host, user, password, tickets=None):
         self.base = f"https://{host}:8006/api2/json"
         self.session = requests.Session()
         self.session.verify = False
+        # Chunk uploads run concurrently; keep enough pooled connections for every worker.
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=16))
         self.user = user
         self.password = password
         self.host = host
         self.csrf = None
+        self.tickets = tickets
+        self.issued = None
 
     def login(self):
-        data = {"username": self.user, "password": self.password}
+        cached = self.tickets.get(self.host, self.user) if self.tickets else None
+        if cached and not needs_renewal(cached):
+            self._apply_ticket(cached["ticket"], cached["csrf"], cached["issued"])
+            return
+        payload = None
+        if cached:
+            try:
+                # A still-valid ticket can be exchanged for a fresh one without the password.
+                payload = self._request_ticket(cached["ticket"])
+            except requests.HTTPError:
+                payload = None
+        if payload is None:
+            payload = self._request_ticket(self.password)
+        issued = time.time()
+        self._apply_ticket(payload["ticket"], payload["CSRFPreventionToken"], issued)
+        if self.tickets:
+            self.tickets.put(self.host, self.user, payload["ticket"], payload["CSRFPreventionToken"], issued)
+
+    def _request_ticket(self, password):
+        data = {"username": self.user, "password": password}
         resp = self.session.post(f"{self.base}/access/ticket", data=data)
         resp.raise_for_status()
-        payload = resp.json()["data"]
-        ticket = payload["ticket"]
-        self.csrf = payload["CSRFPreventionToken"]
+        return resp.json()["data"]
+
+    def _apply_ticket(self, ticket, csrf, issued):
+        self.csrf = csrf
+        self.issued = issued
         self.session.cookies.set("PVEAuthCookie", ticket, domain=self.host, path="/")
 
     def _headers(self):
         return {"CSRFPreventionToken": self.csrf} if self.csrf else {}
 
-    def get(self, path, **kwargs):
-        resp = self.session.get(f"{self.base}{path}", headers=self._headers(), **kwargs)
+    def _request(self, method, path, **kwargs):
+        if self.issued is not None and time.time() - self.issued >= TICKET_RENEW_AFTER:
+            self.login()
+        resp = self.session.request(method, f"{self.base}{path}", headers=self._headers(), **kwargs)
+        if resp.status_code == 401 and self.tickets:
+            # The cached ticket was rejected (e.g. the cluster rotated its keys); log in once more.
+            self.tickets.drop(self.host, self.user)
+            self.login()
+            resp = self.session.request(method, f"{self.base}{path}", headers=self._headers(), **kwargs)
         resp.raise_for_status()
-        return resp.json()["data"]
+        return resp.json()["data"] if resp.content else None
+
+    def get(self, path, **kwargs):
+        return self._request("GET", path, **kwargs)
 
     def post(self, path, *, json_body=None, data_body=None, params=None):
-        kwargs = {"headers": self._headers()}
+        kwargs = {}
         if json_body is not None:
             kwargs["json"] = json_body
         if data_body is not None:
             kwargs["data"] = data_body
         if params is not None:
             kwargs["params"] = params
-        resp = self.session.post(f"{self.base}{path}", **kwargs)
-        resp.raise_for_status()
-        return resp.json()["data"] if resp.content else None
+        return self._request("POST", path, **kwargs)
 
 
 def wait_for_task(client, node, upid, timeout=600):
@@ -173,96 +184,90 @@ Start-Service WinRM
 
 
 
-def run_guest_command(client, node, vmid, command, args, timeout=300):
-    payload = {
-        "command": command,
-        "extra-args": args,
-    }
-    resp = client.post(f"/nodes/{node}/qemu/{vmid}/agent/exec", json_body=payload)
-    pid = resp["pid"]
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        status = client.get(f"/nodes/{node}/qemu/{vmid}/agent/exec-status", params={"pid": pid})
-        if status.get("exited"):
-            out_data = status.get("out-data")
-            err_data = status.get("err-data")
-            stdout = base64.b64decode(out_data).decode(errors="ignore") if out_data else ""
-            stderr = base64.b64decode(err_data).decode(errors="ignore") if err_data else ""
-            exitcode = status.get("exitcode")
-            return exitcode, stdout, stderr
-        time.sleep(2)
-    raise TimeoutError("Guest command timed out")
-
-
 def main():
     args = parse_args()
+    recorder = configure_timing(args.timings)
     if not os.path.isdir(args.build_path):
         raise FileNotFoundError(f"Build path not found: {args.build_path}")
 
-    files = [f for f in args.files if os.path.exists(os.path.join(args.build_path, f))]
-    if not files:
-        raise FileNotFoundError("None of the specified artifacts were found in the build directory")
-
-    client = ProxmoxClient(args.proxmox_host, args.proxmox_user, args.proxmox_password)
-    client.login()
-
-    node = client.get("/nodes")[0]["node"]
-
-    upid = client.post(f"/nodes/{node}/qemu/{args.vmid}/snapshot/{args.snapshot}/rollback")
-    wait_for_task(client, node, upid)
-
-    ensure_running(client, node, args.vmid)
-    wait_for_agent(client, node, args.vmid)
-
-    host_ip = get_local_ip(args.proxmox_host)
-    print(f"Using host IP {host_ip}")
-
-    server = ArtifactServer(args.build_path, host_ip, args.http_port)
-    server.start()
-    time.sleep(1)
+    tickets = None if args.no_ticket_cache else TicketCache(args.ticket_cache)
+    client = ProxmoxClient(args.proxmox_host, args.proxmox_user, args.proxmox_password, tickets=tickets)
+
+    def find_files():
+        files = [f for f in args.files if os.path.exists(os.path.join(args.build_path, f))]
+        if not files:
+            raise FileNotFoundError("None of the specified artifacts were found in the build directory")
+        return files
+
+    def login():
+        with span("login", host=args.proxmox_host):
+            client.login()
+
+    def prepare_vm(node):
+        with span("rollback", vmid=args.vmid):
+            upid = client.post(f"/nodes/{node}/qemu/{args.vmid}/snapshot/{args.snapshot}/rollback")
+            wait_for_task(client, node, upid)
+        with span("vm_start", vmid=args.vmid):
+            ensure_running(client, node, args.vmid)
+        with span("transport", kind="guest-agent"):
+            wait_for_agent(client, node, args.vmid)
+
+    def push(files, plan, node, _):
+        print(f"Pushing {len(files)} artifacts through the guest agent ...")
+        with span("upload", files=len(files)) as timing:
+            sent, seconds = push_files(
+                client,
+                node,
+                args.vmid,
+                args.build_path,
+                files,
+                args.remote_dir,
+                workers=args.transfer_workers,
+                plan=plan,
+            )
+            timing["bytes"] = sent
+        print(f"Transferred {sent / 1048576:.1f} MiB in {seconds:.1f}s, checksums verified")
+
+    # Hashing and chunk planning run while the VM rolls back and boots.
+    graph = StageGraph()
+    graph.add("files", find_files)
+    graph.add("plan", lambda files: plan_chunks(args.build_path, files), deps=["files"])
+    graph.add("login", login)
+    graph.add("node", lambda _: client.get("/nodes")[0]["node"], deps=["login"])
+    graph.add("vm", prepare_vm, deps=["node"])
+    graph.add("push", push, deps=["files", "plan", "node", "vm"])
+    try:
+        graph.run()
+    finally:
+        graph.report()
+    node = graph.results["node"]
 
-    ps_files = ', '.join(f"'{f}'" for f in files)
     ps_script = f"""
-Continue = 'Stop'
- = '{args.remote_dir}'
-if (-not (Test-Path )) {{ New-Item -ItemType Directory -Path  -Force | Out-Null }}
- = @({ps_files})
- = 'http://{host_ip}:{args.http_port}'
-foreach ( in ) {{
-     = "/"
-    Invoke-WebRequest -Uri  -OutFile (Join-Path  ) -UseBasicParsing -ErrorAction Stop
-}}
- = Join-Path  '{args.executable}'
-if (-not (Test-Path )) {{ throw "Executable not found: " }}
- = Start-Process -FilePath  -WorkingDirectory  -PassThru -Wait -NoNewWindow -RedirectStandardOutput (Join-Path  'stdout.txt') -RedirectStandardError (Join-Path  'stderr.txt')
- = [PSCustomObject]@{{
-    ExitCode = .ExitCode
-    StdOut = Get-Content (Join-Path  'stdout.txt') -Raw
-    StdErr = Get-Content (Join-Path  'stderr.txt') -Raw
+$ErrorActionPreference = 'Stop'
+$dest = '{args.remote_dir}'
+$exePath = Join-Path $dest '{args.executable}'
+if (-not (Test-Path $exePath)) {{ throw "Executable not found: $exePath" }}
+$proc = Start-Process -FilePath $exePath -WorkingDirectory $dest -PassThru -Wait -NoNewWindow -RedirectStandardOutput (Join-Path $dest 'stdout.txt') -RedirectStandardError (Join-Path $dest 'stderr.txt')
+$result = [PSCustomObject]@{{
+    ExitCode = $proc.ExitCode
+    StdOut = Get-Content (Join-Path $dest 'stdout.txt') -Raw
+    StdErr = Get-Content (Join-Path $dest 'stderr.txt') -Raw
 }}
- | ConvertTo-Json -Depth 5
+$result | ConvertTo-Json -Depth 5
 """
 
-    encoded = base64.b64encode(ps_script.encode('utf-16le')).decode()
-    args_list = [
-        "-NoLogo",
-        "-NoProfile",
-        "-ExecutionPolicy", "Bypass",
-        "-EncodedCommand", encoded,
-    ]
-
-    try:
-        exitcode, stdout, stderr = run_guest_command(client, node, args.vmid, "powershell.exe", args_list)
-    finally:
-        server.stop()
+    with span("execute", executable=args.executable):
+        exitcode, stdout, stderr = run_guest_powershell(client, node, args.vmid, ps_script)
 
     print("Exit code:", exitcode)
     print("STDOUT:\n" + stdout)
     print("STDERR:\n" + stderr)
 
     if args.shutdown_vm:
-        client.post(f"/nodes/{node}/qemu/{args.vmid}/status/shutdown")
+        with span("shutdown", vmid=args.vmid):
+            client.post(f"/nodes/{node}/qemu/{args.vmid}/status/shutdown")
         print("Shutdown requested")
+    recorder.print_summary()
 
 
 if __name__ == "__main__":